@@ -0,0 +1,346 @@
+'''
+Benchmarks for django-queryset-serialization.
+
+Runs against an in-memory SQLite database, with the same Person model
+the tests use. Every benchmark reports its throughput, in operations
+per second, as the best of a few rounds. Memory benchmarks report the
+memory left allocated, in KiB, where lower is better.
+    
+    python benchmarks/run.py
+    python benchmarks/run.py --save benchmarks/baseline.json
+    python benchmarks/run.py --compare benchmarks/baseline.json
+
+With --compare, the run fails if any benchmark's throughput is lower
+(or memory use higher) than the baseline's by more than --threshold
+(0.25 by default).
+
+Every run also measures `calibration`, a plain Python workload which
+doesn't touch dqs or Django. Throughputs are compared relative to it,
+so a baseline saved on another machine still means something: what is
+compared is how many times slower than the calibration every benchmark
+is. Memory use is compared as is.
+
+benchmarks/baseline.json was saved on the reference machine, a
+single core Intel Xeon VM with CPython 3.11 and Django 4.2. The saved
+file names the machine too. Save a new one whenever a change is meant
+to move the numbers.
+
+'''
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import django
+from django.conf import settings
+
+settings.configure(
+    INSTALLED_APPS=['dqs'],
+    DATABASES={'default':{
+        'ENGINE':'django.db.backends.sqlite3',
+        'NAME':':memory:',
+    }},
+    DEFAULT_AUTO_FIELD='django.db.models.AutoField',
+    USE_TZ=False,
+)
+django.setup()
+
+from django.db import connection, models
+
+from dqs import serialization
+
+GENDER_VALUES = {'male':1, 'female':2}
+
+
+
+class Person(models.Model):
+    gender = models.SmallIntegerField(null=True)
+    name = models.CharField(max_length=150, null=True)
+    best_friend = models.ForeignKey('Person', related_name='best_friend_of',
+        null=True, on_delete=models.SET_NULL)
+    friends = models.ManyToManyField('Person')
+    
+    class Meta:
+        app_label = 'dqs'
+
+
+
+def setup_database(rows=2000):
+    with connection.schema_editor() as editor:
+        editor.create_model(Person)
+    Person.objects.bulk_create([Person(name='person %d' % index,
+            gender=GENDER_VALUES['male'] if index % 2 else
+                GENDER_VALUES['female'])
+        for index in range(rows)])
+
+
+
+def bench_chain_building():
+    'Build a chain of 200 steps'
+    dqs = serialization.DjangoQuerysetSerialization()
+    def run():
+        serializer = dqs.make_serializer()
+        for index in range(100):
+            serializer = (serializer
+                .filter(name__icontains='n')
+                .exclude(gender=index))
+        return serializer
+    return run
+
+
+
+def bench_replay():
+    'get_queryset with 50 placeholders'
+    dqs = serialization.DjangoQuerysetSerialization()
+    serializer = dqs.make_serializer()
+    parameters = {}
+    for index in range(50):
+        serializer = serializer.exclude(name='$name%d' % index)
+        parameters['name%d' % index] = 'name %d' % index
+    s = dqs.register('replay', serializer, Person.objects.all())
+    return lambda: s.get_queryset(parameters)
+
+
+
+def bench_from_url():
+    'from_url dispatch with 5000 registered names'
+    dqs = serialization.DjangoQuerysetSerialization()
+    serializer = dqs.make_serializer().filter(name='$name', gender='$gender')
+    for index in range(5000):
+        dqs.register('people-%d' % index, serializer, Person.objects.all())
+    return lambda: dqs.from_url('/people-4321/someone/1')
+
+
+
+def bench_end_to_end():
+    'fetch 100 rows of 2000'
+    dqs = serialization.DjangoQuerysetSerialization()
+    s = dqs.register('end-to-end', dqs.make_serializer()
+            .filter(gender='$gender', name__startswith='$start')
+            .order_by('name'),
+        Person.objects.all())
+    parameters = {'gender':GENDER_VALUES['male'], 'start':'person 1'}
+    return lambda: s.fetch(parameters)
+
+
+
+def values_serialization(dqs):
+    return dqs.register('values', dqs.make_serializer()
+            .filter(gender='$gender')
+            .values('id', 'name', 'gender'),
+        Person.objects.all(), sql_cache=True)
+
+
+
+def bench_values_json():
+    'json.dumps of the values() rows of 1000 people'
+    s = values_serialization(serialization.DjangoQuerysetSerialization())
+    parameters = {'gender':GENDER_VALUES['male']}
+    return lambda: json.dumps(list(s.get_queryset(parameters)))
+
+
+
+def bench_export():
+    'columnar JSON export of the same rows'
+    s = values_serialization(serialization.DjangoQuerysetSerialization())
+    parameters = {'gender':GENDER_VALUES['male']}
+    return lambda: s.export(parameters)
+
+
+
+def bench_registry_memory():
+    '10000 registrations of equal chains, one per tenant'
+    dqs = serialization.DjangoQuerysetSerialization()
+    base_queryset = Person.objects.all()
+    for index in range(10000):
+        dqs.register('tenant-%d/people' % index, dqs.make_serializer()
+                .filter(gender='$gender')
+                .exclude(name='banned')
+                .order_by('name')
+                .values('name', 'gender'),
+            base_queryset)
+    return dqs
+
+
+
+def register_tenants(dqs, count=200):
+    for index in range(count):
+        dqs.register('tenant-%d/people' % index, dqs.make_serializer()
+                .filter(gender='$gender', name__startswith='$start')
+                .exclude(name='banned %d' % index)
+                .order_by('name')
+                .values('name', 'gender'),
+            Person.objects.all())
+    return dqs
+
+
+
+def bench_registry_build():
+    'register 200 chains by running the Python building them'
+    return lambda: register_tenants(
+        serialization.DjangoQuerysetSerialization())
+
+
+
+def bench_registry_load():
+    'load the same 200 chains from a dump, leaving them uncompiled'
+    saved = register_tenants(serialization.DjangoQuerysetSerialization()
+        ).dumps()
+    return lambda: serialization.DjangoQuerysetSerialization().loads(saved)
+
+
+
+def bench_registry_load_compiled():
+    'load the same 200 chains from a dump, and compile them all'
+    saved = register_tenants(serialization.DjangoQuerysetSerialization()
+        ).dumps()
+    def run():
+        dqs = serialization.DjangoQuerysetSerialization().loads(saved)
+        for name in list(dqs.keys()):
+            dqs[name]
+        return dqs
+    return run
+
+
+
+BENCHMARKS = [
+    ('chain_building', bench_chain_building),
+    ('replay', bench_replay),
+    ('from_url', bench_from_url),
+    ('end_to_end', bench_end_to_end),
+    ('values_json', bench_values_json),
+    ('export', bench_export),
+    ('registry_build', bench_registry_build),
+    ('registry_load', bench_registry_load),
+    ('registry_load_compiled', bench_registry_load_compiled),
+]
+
+MEMORY_BENCHMARKS = [
+    ('registry_memory', bench_registry_memory),
+]
+
+
+
+def calibration():
+    'A fixed amount of dict, string and sorting work'
+    rows = [{'name':'person %d' % index, 'gender':index % 3}
+        for index in range(500)]
+    rows.sort(key=lambda row:(row['gender'], row['name']))
+    return ','.join(row['name'] for row in rows)
+
+
+
+def measure(run, rounds=5, duration=0.2):
+    'Best throughput of `rounds` rounds lasting about `duration` each'
+    best = 0
+    for round in range(rounds):
+        operations = 0
+        start = time.perf_counter()
+        elapsed = 0
+        while elapsed < duration:
+            run()
+            operations += 1
+            elapsed = time.perf_counter() - start
+        best = max(best, operations / elapsed)
+    return best
+
+
+
+def measure_memory(build):
+    'KiB still allocated after `build` runs, while its result is kept'
+    tracemalloc.start()
+    try:
+        kept = build()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del kept
+    return size / 1024.0
+
+
+
+def compare(results, baseline, threshold):
+    'Print the comparison, and return the names which regressed'
+    memory = dict(MEMORY_BENCHMARKS)
+    speed = results['calibration'] / baseline['calibration']
+    print('This machine runs the calibration at %.1f%% of the baseline\'s '
+        'speed' % (speed * 100))
+    regressed = []
+    for name, value in results.items():
+        if name not in baseline or name == 'calibration':
+            continue
+        if name in memory:
+            ratio = baseline[name] / value
+            print('%-24s %12.1f KiB    %6.1f%% of baseline' % (name,
+                value, value / baseline[name] * 100))
+        else:
+            ratio = value / (baseline[name] * speed)
+            print('%-24s %12.1f ops/s  %6.1f%% of baseline' % (name,
+                value, ratio * 100))
+        if ratio < 1 - threshold:
+            regressed.append(name)
+    return regressed
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--compare', help='compare with this baseline file')
+    parser.add_argument('--threshold', type=float, default=0.25,
+        help='allowed throughput loss, as a fraction of the baseline')
+    parser.add_argument('--only', action='append',
+        help='only run this benchmark (can be repeated)')
+    args = parser.parse_args(argv)
+    
+    setup_database()
+    
+    results = {'calibration':measure(calibration)}
+    print('%-24s %12.1f ops/s' % ('calibration', results['calibration']))
+    for name, bench in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        results[name] = measure(bench())
+        print('%-24s %12.1f ops/s' % (name, results[name]))
+    
+    for name, bench in MEMORY_BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        results[name] = measure_memory(bench)
+        print('%-24s %12.1f KiB' % (name, results[name]))
+    
+    if args.save:
+        saved = dict((name, round(throughput, 1))
+            for name, throughput in results.items())
+        saved['machine'] = '%s, %s %s, Django %s' % (
+            platform.processor() or platform.machine(),
+            platform.python_implementation(), platform.python_version(),
+            django.get_version())
+        with open(args.save, 'w') as f:
+            json.dump(saved, f, indent=4, sort_keys=True)
+            f.write('\n')
+    
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if 'calibration' not in baseline:
+            print('%s has no calibration, save it again' % args.compare)
+            return 1
+        regressed = compare(results, baseline, args.threshold)
+        if regressed:
+            print('Regressed: %s' % ', '.join(regressed))
+            return 1
+    
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
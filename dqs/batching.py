@@ -0,0 +1,338 @@
+'''
+Evaluating one serialization for many parameter sets at once.
+
+When only one placeholder changes between the parameter sets, and it
+is the value of an equality lookup in a filter() call, the sets are
+coalesced into a single query using an __in lookup, and the rows are
+split back out by the value of the looked up field. Text fields are
+never coalesced on: under a case or accent insensitive collation the
+database matches values which aren't equal in Python, and the rows
+couldn't be split back out.
+
+Otherwise the querysets of every parameter set are combined with
+UNION ALL, with a discriminator column telling which set each row
+belongs to. Chains that can't be combined are evaluated one
+parameter set after the other.
+
+With a routing policy, the parameter sets are grouped by the database
+it chooses for them, and every group is batched on its database. Sets
+which run on every database are evaluated one by one.
+
+'''
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import (CharField, Count, F, IntegerField,
+    TextField, Value)
+
+from dqs import counting, utils
+
+LOOKUP_SEP = '__'
+
+'methods which never change which rows a chain returns, nor how many'
+NEUTRAL_METHODS = frozenset(['all', 'order_by', 'reverse', 'only',
+    'defer', 'using', 'select_related', 'prefetch_related'])
+
+COALESCABLE_METHODS = NEUTRAL_METHODS | frozenset(['filter', 'exclude'])
+
+KEY = '_dqs_key'
+SET = '_dqs_set'
+COUNT = '_dqs_count'
+
+
+
+def varying_placeholders(plan, parameter_sets):
+    'The placeholders whose values are not the same in every set'
+    first = parameter_sets[0]
+    return [placeholder for placeholder in plan.placeholders
+        if any(utils.freeze(parameters[placeholder])
+            != utils.freeze(first[placeholder])
+            for parameters in parameter_sets[1:])]
+
+
+
+def equality_field(plan, model, placeholder):
+    '''
+    If `placeholder` is the value of an equality lookup in a filter()
+    call, following only single valued relations, return the lookup
+    path and the field it ends in. Otherwise return None.
+    '''
+    
+    for step in plan.steps:
+        for position, slot_placeholder in step.value_slots:
+            if slot_placeholder != placeholder:
+                continue
+            if step.name != 'filter':
+                return None
+            
+            path = step.keys[position]
+            if path.endswith(LOOKUP_SEP + 'exact'):
+                path = path[:-len(LOOKUP_SEP + 'exact')]
+            
+            current, field = model, None
+            for part in path.split(LOOKUP_SEP):
+                if current is None:
+                    return None
+                try:
+                    field = current._meta.get_field(part)
+                except FieldDoesNotExist:
+                    return None
+                if field.many_to_many or field.one_to_many:
+                    return None
+                current = field.related_model if field.is_relation else None
+            
+            return path, field
+    
+    return None
+
+
+
+def normalize(field, value):
+    'Convert a parameter value to what the database gives back for field'
+    if hasattr(value, '_meta') and hasattr(value, 'pk'):
+        value = value.pk
+    return field.to_python(value)
+
+
+
+def coalesced_queryset(serialization, parameters, placeholder, path,
+        values, alias=None):
+    '''
+    Replay the chain, with the equality lookup of `placeholder` turned
+    into an __in lookup over `values`, on the `alias` database if given.
+    '''
+    queryset = serialization.base_queryset
+    for step in serialization.plan.steps:
+        positions = [position
+            for position, slot_placeholder in step.value_slots
+            if slot_placeholder == placeholder]
+        if not positions:
+            queryset = step.apply(queryset, parameters)
+            continue
+        args, kwargs = step.arguments(parameters)
+        del kwargs[step.keys[positions[0]]]
+        kwargs[path + LOOKUP_SEP + 'in'] = values
+        queryset = getattr(queryset, step.name)(*args, **kwargs)
+    if alias is not None:
+        queryset = queryset.using(alias)
+    return queryset
+
+
+
+def prepare_coalescing(serialization, parameter_sets):
+    '''
+    Find the placeholder to coalesce on. Returns (placeholder, path,
+    keys) where `keys` are the normalized values of the placeholder
+    for each set, or None.
+    '''
+    
+    plan = serialization.plan
+    if serialization.base_queryset.query.is_sliced:
+        return None
+    if any(step.name not in COALESCABLE_METHODS or step.key_slots
+            for step in plan.steps):
+        return None
+    
+    varying = varying_placeholders(plan, parameter_sets)
+    if len(varying) != 1:
+        return None
+    placeholder = varying[0]
+    
+    found = equality_field(plan, serialization.base_queryset.model,
+        placeholder)
+    if found is None:
+        return None
+    path, field = found
+    target = field.target_field if field.is_relation else field
+    if isinstance(target, (CharField, TextField)):
+        return None
+    
+    try:
+        keys = [normalize(field, parameters[placeholder])
+            for parameters in parameter_sets]
+        hash(tuple(keys))
+    except (ValidationError, TypeError, ValueError):
+        return None
+    if None in keys:
+        return None
+    
+    return placeholder, path, keys
+
+
+
+def union_parts(serialization, parameter_sets, alias=None):
+    '''
+    The querysets of each set, unordered, or None if they can't be
+    combined with UNION ALL.
+    '''
+    plan = serialization.plan
+    if serialization.base_queryset.query.is_sliced:
+        return None
+    if any(step.name not in COALESCABLE_METHODS
+            or step.name in ('select_related', 'prefetch_related')
+            for step in plan.steps):
+        return None
+    
+    return [serialization._build_queryset(parameters, alias).order_by()
+        for parameters in parameter_sets]
+
+
+
+def by_database(serialization, parameter_sets, batch, single):
+    '''
+    Group bound parameter sets by the database the serialization's
+    routing policy chooses, and call batch(sets, alias) for every
+    group. Sets with no database are given to single(parameters) one
+    by one. Returns the results in the order of the sets.
+    '''
+    
+    if serialization.routing is None:
+        return batch(parameter_sets, None)
+    
+    groups = {}
+    for index, parameters in enumerate(parameter_sets):
+        alias = serialization.routing.choose(parameters)
+        groups.setdefault(alias, []).append(index)
+    
+    results = [None] * len(parameter_sets)
+    for alias, indexes in groups.items():
+        sets = [parameter_sets[index] for index in indexes]
+        if alias is None:
+            group_results = [single(parameters) for parameters in sets]
+        else:
+            group_results = batch(sets, alias)
+        for index, result in zip(indexes, group_results):
+            results[index] = result
+    return results
+
+
+
+def get_many(serialization, parameter_sets):
+    'See Serialization.get_querysets_many'
+    
+    plan = serialization.plan
+    parameter_sets = [plan.bind(parameters) for parameters in parameter_sets]
+    return by_database(serialization, parameter_sets,
+        lambda sets, alias:fetch_batch(serialization, sets, alias),
+        serialization._fetch_through_cache)
+
+
+
+def fetch_batch(serialization, parameter_sets, alias):
+    'get_many, for bound parameter sets running on the `alias` database'
+    
+    if len(parameter_sets) < 2:
+        return [serialization._fetch_through_cache(parameters)
+            for parameters in parameter_sets]
+    
+    coalescing = prepare_coalescing(serialization, parameter_sets)
+    if coalescing is not None:
+        placeholder, path, keys = coalescing
+        queryset = coalesced_queryset(serialization, parameter_sets[0],
+            placeholder, path, list(set(keys)), alias)
+        if queryset._fields is None:
+            groups = dict((key, []) for key in keys)
+            for obj in queryset.annotate(**{KEY:F(path)}):
+                group = groups.get(getattr(obj, KEY))
+                if group is None:
+                    'the database matched a value Python doesn\'t'
+                    break
+                group.append(obj)
+                delattr(obj, KEY)
+            else:
+                return [list(groups[key]) for key in keys]
+    
+    ordering = get_union_ordering(serialization, parameter_sets[0], alias)
+    parts = ordering is not None and union_parts(serialization,
+        parameter_sets, alias)
+    if parts:
+        parts = [part.annotate(**{SET:Value(index,
+                output_field=IntegerField())})
+            for index, part in enumerate(parts)]
+        union = parts[0].union(*parts[1:], all=True).order_by(
+            SET, *ordering)
+        results = [[] for parameters in parameter_sets]
+        for obj in union:
+            results[getattr(obj, SET)].append(obj)
+            delattr(obj, SET)
+        return results
+    
+    return [serialization._fetch_through_cache(parameters)
+        for parameters in parameter_sets]
+
+
+
+def get_union_ordering(serialization, parameters, alias=None):
+    '''
+    The ordering of the chain as column names usable in the ORDER BY of
+    a UNION, or None if the chain's ordering can't be kept.
+    '''
+    queryset = serialization._build_queryset(parameters, alias)
+    query = queryset.query
+    if queryset._fields is not None or query.select_related:
+        return None
+    if query.deferred_loading != (frozenset(), True):
+        return None
+    
+    if query.extra_order_by:
+        return None
+    ordering = list(query.order_by)
+    if not ordering and query.default_ordering:
+        ordering = list(query.get_meta().ordering)
+    if not query.standard_ordering:
+        ordering = [name[1:] if name.startswith('-') else '-' + name
+            for name in ordering]
+    
+    for name in ordering:
+        if (not isinstance(name, str) or name == '?'
+                or LOOKUP_SEP in name):
+            return None
+    return ordering
+
+
+
+def count_many(serialization, parameter_sets):
+    'See Serialization.count_many'
+    
+    plan = serialization.plan
+    parameter_sets = [plan.bind(parameters) for parameters in parameter_sets]
+    return by_database(serialization, parameter_sets,
+        lambda sets, alias:count_batch(serialization, sets, alias),
+        serialization._count)
+
+
+
+def count_batch(serialization, parameter_sets, alias):
+    'count_many, for bound parameter sets running on the `alias` database'
+    
+    plan = serialization.plan
+    if len(parameter_sets) < 2:
+        return [counting.count_rows(serialization._build_queryset(
+                parameters, alias))
+            for parameters in parameter_sets]
+    
+    distinct = any(step.name == 'distinct' for step in plan.steps)
+    
+    coalescing = not distinct and prepare_coalescing(serialization,
+        parameter_sets)
+    if coalescing:
+        placeholder, path, keys = coalescing
+        queryset = coalesced_queryset(serialization, parameter_sets[0],
+            placeholder, path, list(set(keys)), alias)
+        counts = dict(queryset.order_by().values(path).annotate(
+            **{COUNT:Count('pk')}).values_list(path, COUNT))
+        return [counts.get(key, 0) for key in keys]
+    
+    parts = not distinct and union_parts(serialization, parameter_sets,
+        alias)
+    if parts:
+        parts = [part.values(**{SET:Value(index,
+                output_field=IntegerField())}).annotate(**{COUNT:Count('pk')})
+            for index, part in enumerate(parts)]
+        counts = dict(parts[0].union(*parts[1:], all=True).values_list(
+            SET, COUNT))
+        return [counts.get(index, 0)
+            for index in range(len(parameter_sets))]
+    
+    return [counting.count_rows(serialization._build_queryset(parameters,
+            alias))
+        for parameters in parameter_sets]
@@ -0,0 +1,278 @@
+'''
+Result caches for registered serializations.
+
+A result cache keeps the materialized results of Serialization.fetch(),
+keyed by the serialization's name and its normalized parameters. Pass
+one to register():
+    
+    dqs.register('people-search', serializer, Person.objects.all(),
+        cache=LocMemResultCache(max_size=500, ttl=30))
+
+Entries are invalidated when an instance of any model the chain
+touches is saved or deleted, or when a many-to-many relation the chain
+goes through changes. Every invalidation starts a new generation of
+the serialization's entries. Callers read the generation before
+running the query, and results of a query started before an
+invalidation are not stored.
+
+'''
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.apps import apps
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import F, Q, signals
+
+from dqs import utils
+
+MISSING = object()
+
+LOOKUP_SEP = '__'
+
+
+
+class ResultCache(object):
+    '''
+    Base class of the result caches. Subclasses implement generation,
+    get, set and invalidate.
+    '''
+    
+    def generation(self, name):
+        'The current generation of the entries of `name`'
+        raise NotImplementedError
+    
+    def get(self, name, parameters, generation=None):
+        'Return the cached results, or MISSING'
+        raise NotImplementedError
+    
+    def set(self, name, parameters, results, generation=None):
+        '''
+        Store results, unless `generation` was given and the entries
+        of `name` have been invalidated since it was read.
+        '''
+        raise NotImplementedError
+    
+    def invalidate(self, name):
+        'Forget every entry of the serialization called `name`'
+        raise NotImplementedError
+
+
+
+class LocMemResultCache(ResultCache):
+    '''
+    An in-process cache holding up to `max_size` entries for `ttl`
+    seconds. The least recently used entries are dropped first.
+    Results are kept as tuples, and handed out as new lists.
+    '''
+    
+    def __init__(self, max_size=1000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.lock = threading.Lock()
+    
+    def generation(self, name):
+        with self.lock:
+            return self.generations.get(name, 0)
+    
+    def get(self, name, parameters, generation=None):
+        with self.lock:
+            key = (name, self.generations.get(name, 0),
+                utils.parameters_key(parameters))
+            entry = self.entries.get(key, MISSING)
+            if entry is MISSING:
+                return MISSING
+            expires, results = entry
+            if expires < time.time():
+                del self.entries[key]
+                return MISSING
+            self.entries.move_to_end(key)
+            return list(results) if isinstance(results, tuple) else results
+    
+    def set(self, name, parameters, results, generation=None):
+        if isinstance(results, list):
+            results = tuple(results)
+        with self.lock:
+            current = self.generations.get(name, 0)
+            if generation is not None and generation != current:
+                return
+            key = (name, current, utils.parameters_key(parameters))
+            self.entries[key] = (time.time() + self.ttl, results)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+    
+    def invalidate(self, name):
+        with self.lock:
+            self.generations[name] = self.generations.get(name, 0) + 1
+            for key in [key for key in self.entries if key[0] == name]:
+                del self.entries[key]
+
+
+
+class DjangoResultCache(ResultCache):
+    '''
+    Keeps the results in one of Django's cache backends, given by
+    alias or as a cache object, for `ttl` seconds.
+    
+    The entries of a serialization are invalidated by bumping a
+    generation number kept in the same backend, so every process
+    sharing the backend sees the invalidation. Results stored with a
+    generation which is no longer current go under keys nobody reads.
+    '''
+    
+    def __init__(self, cache='default', ttl=60, key_prefix='dqs'):
+        if isinstance(cache, str):
+            from django.core.cache import caches
+            cache = caches[cache]
+        self.cache = cache
+        self.ttl = ttl
+        self.key_prefix = key_prefix
+    
+    def generation_key(self, name):
+        return '%s:generation:%s' % (self.key_prefix, name)
+    
+    def generation(self, name):
+        return self.cache.get(self.generation_key(name), 0)
+    
+    def make_key(self, name, parameters, generation=None):
+        if generation is None:
+            generation = self.generation(name)
+        digest = hashlib.sha1(repr(utils.parameters_key(parameters))
+            .encode('utf-8')).hexdigest()
+        return '%s:%s:%s:%s' % (self.key_prefix, name, generation, digest)
+    
+    def get(self, name, parameters, generation=None):
+        return self.cache.get(self.make_key(name, parameters, generation),
+            MISSING)
+    
+    def set(self, name, parameters, results, generation=None):
+        self.cache.set(self.make_key(name, parameters, generation), results,
+            self.ttl)
+    
+    def invalidate(self, name):
+        key = self.generation_key(name)
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            self.cache.set(key, 1, None)
+
+
+
+def query_models(query, tables=None):
+    '''
+    The models of the tables a Query joins, and of the subqueries its
+    WHERE clause holds.
+    '''
+    if not query.alias_map and not query.where:
+        return set()
+    if tables is None:
+        tables = dict((model._meta.db_table, model)
+            for model in apps.get_models(include_auto_created=True))
+    
+    models = set([tables[join.table_name]
+        for join in query.alias_map.values() if join.table_name in tables])
+    
+    nodes = [query.where]
+    while nodes:
+        node = nodes.pop()
+        nodes.extend(getattr(node, 'children', None) or [])
+        rhs = getattr(node, 'rhs', None)
+        rhs = getattr(rhs, 'query', rhs)
+        if hasattr(rhs, 'alias_map'):
+            models |= query_models(rhs, tables)
+    return models
+
+
+
+def collect_lookups(value, paths, models):
+    '''
+    Add the lookup paths of the Q objects and F expressions in an
+    argument value to `paths`, and the models of the querysets and
+    subqueries in it to `models`.
+    '''
+    if isinstance(value, F):
+        paths.append(value.name)
+    elif isinstance(value, Q):
+        for child in value.children:
+            if isinstance(child, tuple):
+                paths.append(child[0])
+                collect_lookups(child[1], paths, models)
+            else:
+                collect_lookups(child, paths, models)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            collect_lookups(item, paths, models)
+    elif hasattr(getattr(value, 'query', None), 'alias_map'):
+        'querysets, and Subquery and Exists expressions'
+        models |= query_models(value.query)
+    elif (hasattr(value, 'get_source_expressions')
+            and not isinstance(value, type)):
+        for expression in value.get_source_expressions():
+            collect_lookups(expression, paths, models)
+
+
+
+def touched_models(plan, model, queryset=None):
+    '''
+    Find the models a plan reads from, walking the lookup paths in the
+    keyword argument names and string arguments of its steps, and in
+    the Q objects and expressions of their arguments. Querysets and
+    subqueries given as arguments, and the joins of the base
+    `queryset`, add their models too. Many to many through models are
+    included.
+    
+    Returns None when a lookup path is itself a placeholder, and the
+    models can't be known in advance.
+    '''
+    
+    models = set([model])
+    if queryset is not None:
+        models |= query_models(queryset.query)
+    
+    for step in plan.steps:
+        if step.key_slots or step.arg_slots:
+            return None
+        paths = list(step.keys) + [arg for arg in step.args
+            if isinstance(arg, str)]
+        collect_lookups(list(step.args) + list(step.values), paths, models)
+        for path in paths:
+            current = model
+            for part in path.lstrip('-').split(LOOKUP_SEP):
+                try:
+                    field = current._meta.get_field(part)
+                except FieldDoesNotExist:
+                    break
+                if not field.is_relation or field.related_model is None:
+                    break
+                if field.many_to_many:
+                    through = (getattr(field, 'through', None)
+                        or field.remote_field.through)
+                    models.add(through)
+                current = field.related_model
+                models.add(current)
+    
+    return models
+
+
+
+def connect_invalidation(serialization, models):
+    '''
+    Invalidate the serialization's cache when any of `models` changes,
+    or when any model changes if `models` is None.
+    
+    The receivers are weak references to the serialization's bound
+    method, so they go away with the serialization.
+    '''
+    
+    receiver = serialization.invalidate_cache
+    uid = 'dqs-cache-%d' % id(serialization)
+    
+    for sender in (models or [None]):
+        for signal in (signals.post_save, signals.post_delete,
+                signals.m2m_changed):
+            signal.connect(receiver, sender=sender, dispatch_uid=uid)
@@ -0,0 +1,202 @@
+'''
+Change tokens for registered serializations.
+
+A change token is a cheap fingerprint of the results of a
+serialization for some parameters. It changes when the results may
+have changed, without fetching them, so it can be used as an HTTP
+ETag (see dqs.views). Tokens come from one of:
+ 
+ - with the `updated_field` option, an aggregate query over the
+ filtered chain: the count, the largest pk and the latest value of
+ that field, which must change whenever a row is saved. It also
+ gives the Last-Modified time when it is a date or datetime.
+ - with the `versions` option, a ModelVersions: version counters of
+ the models the chain touches, bumped by their save, delete and
+ many-to-many signals. No query is made at all.
+
+One of the two options is needed: without them, saving a row would
+leave the token unchanged.
+    
+    dqs.register('articles', serializer, Article.objects.all(),
+        updated_field='modified')
+    dqs.register('people', serializer, Person.objects.all(),
+        versions=ModelVersions(cache='default'))
+
+'''
+
+import datetime
+import hashlib
+import itertools
+import threading
+import uuid
+
+from django.db.models import Count, Max, signals
+
+from dqs import utils
+
+
+
+class ChangeToken(object):
+    '''
+    `etag` is a hex digest. `last_modified` is the time of the latest
+    change as a POSIX timestamp, or None when it isn't known.
+    '''
+    
+    __slots__ = ['etag', 'last_modified']
+    
+    def __init__(self, etag, last_modified=None):
+        self.etag = etag
+        self.last_modified = last_modified
+    
+    def __eq__(self, other):
+        return (isinstance(other, ChangeToken) and self.etag == other.etag
+            and self.last_modified == other.last_modified)
+    
+    def __repr__(self):
+        return '<ChangeToken: %s>' % self.etag
+
+
+
+def make_token(serialization, parameters, state, last_modified=None):
+    '''
+    The ChangeToken of a serialization, for bound parameters and some
+    state which changes along with the results.
+    '''
+    key = (serialization.cache_name,
+        getattr(serialization.serializer, 'fingerprint', None),
+        utils.parameters_key(parameters), state)
+    return ChangeToken(hashlib.sha1(repr(key).encode('utf-8')).hexdigest(),
+        last_modified)
+
+
+
+def timestamp(value):
+    '''
+    A POSIX timestamp for a date or datetime, or None for anything
+    else, like the value of a revision number field.
+    '''
+    if not isinstance(value, datetime.date):
+        return None
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime(value.year, value.month, value.day)
+    return int(value.timestamp())
+
+
+
+def aggregate_state(queryset, updated_field=None):
+    '''
+    Count the rows of a queryset, and find their largest pk and latest
+    `updated_field`, in one query. Returns (count, max pk, latest).
+    '''
+    aggregates = {'dqs_count':Count('pk'), 'dqs_max_pk':Max('pk')}
+    if updated_field is not None:
+        aggregates['dqs_updated'] = Max(updated_field)
+    state = queryset.aggregate(**aggregates)
+    return (state['dqs_count'], state['dqs_max_pk'],
+        state.get('dqs_updated'))
+
+
+
+def combine_states(states):
+    'Combine the aggregate states of several databases'
+    counts, pks, updates = zip(*states)
+    return (sum(counts),
+        max([pk for pk in pks if pk is not None], default=None),
+        max([updated for updated in updates if updated is not None],
+            default=None))
+
+
+
+def fresh_version():
+    'A random starting value for a version counter'
+    return uuid.uuid4().int % 2 ** 48
+
+
+
+class ModelVersions(object):
+    '''
+    Version counters of models, bumped when an instance is saved or
+    deleted, or a many-to-many relation changes. Tokens made from them
+    need no query.
+    
+    Only changes which send those signals are seen. QuerySet.update(),
+    bulk_create(), bulk_update() and raw SQL don't, so call bump()
+    with the model after using them. The models counted are those
+    dqs.caching.touched_models() finds in the chain; when a lookup
+    path is itself a placeholder, changes of any model count.
+    
+    Counters are kept in this process, unless `cache` (one of Django's
+    cache backends, by alias or object) is given, and then they are
+    shared by every process using that backend. In-process counters
+    only see the changes made in this process: with several worker
+    processes, a save handled by one of them leaves the tokens of the
+    others unchanged, and they answer 304 for changed results. Their
+    random epoch only keeps tokens of different processes apart. So
+    dqs.views refuses in-process counters unless settings.DEBUG is on,
+    or `single_process` says only one process serves the requests.
+    Counters missing from the cache start at a random value, so a
+    cleared cache doesn't hand out old tokens again.
+    '''
+    
+    def __init__(self, cache=None, key_prefix='dqs', single_process=False):
+        if isinstance(cache, str):
+            from django.core.cache import caches
+            cache = caches[cache]
+        self.cache = cache
+        self.key_prefix = key_prefix
+        self.single_process = single_process
+        self.epoch = uuid.uuid4().hex
+        self.versions = {}
+        self.connected = set()
+        self.counter = itertools.count(1)
+        self.lock = threading.Lock()
+    
+    def label(self, model):
+        return model._meta.label_lower if model is not None else '*'
+    
+    def key(self, label):
+        return '%s:version:%s' % (self.key_prefix, label)
+    
+    def connect(self, models):
+        '''
+        Start counting changes of `models`, or of every model when
+        `models` is None.
+        '''
+        for sender in (models or [None]):
+            with self.lock:
+                if sender in self.connected:
+                    continue
+                self.connected.add(sender)
+            uid = 'dqs-versions-%d-%s' % (id(self), self.label(sender))
+            for signal in (signals.post_save, signals.post_delete,
+                    signals.m2m_changed):
+                signal.connect(self.bump, sender=sender, dispatch_uid=uid)
+    
+    def bump(self, sender=None, **kwargs):
+        'Bump the versions of the model, and of "any model"'
+        for label in set([self.label(sender), '*']):
+            if self.cache is None:
+                with self.lock:
+                    self.versions[label] = next(self.counter)
+                continue
+            key = self.key(label)
+            try:
+                self.cache.incr(key)
+            except ValueError:
+                self.cache.add(key, fresh_version(), None)
+    
+    def get(self, models):
+        'The versions of `models`, or of any model when it is None'
+        labels = sorted(set([self.label(model)
+            for model in (models or [None])]))
+        if self.cache is None:
+            with self.lock:
+                return (self.epoch,) + tuple([self.versions.get(label, 0)
+                    for label in labels])
+        keys = [self.key(label) for label in labels]
+        versions = self.cache.get_many(keys)
+        for key in keys:
+            if key not in versions:
+                self.cache.add(key, fresh_version(), None)
+                versions[key] = self.cache.get(key)
+        return tuple([versions[key] for key in keys])
@@ -0,0 +1,112 @@
+'''
+Request coalescing for registered serializations.
+
+When many threads fetch the same serialization with the same
+parameters at once, a SingleFlight lets only the first one run the
+query. The others wait for it, and get a copy of its results (or its
+exception). Pass one to register():
+    
+    dqs.register('people-search', serializer, Person.objects.all(),
+        coalesce=SingleFlight(timeout=5))
+
+Callers waiting longer than `timeout` seconds stop waiting and run the
+query themselves. With a timeout of None they wait for as long as it
+takes.
+
+A SingleFlight can be shared by serializations. It counts, by
+serialization name (serializations made by bind() count as the one
+they were made from, and unnamed ones together, like in
+dqs.instrumentation):
+ 
+ - executions: how many queries were run by the first caller.
+ - shared: how many callers got the results of another caller's
+ query. These are the database round trips saved.
+ - timeouts: how many callers stopped waiting.
+
+'''
+
+import threading
+
+from dqs import utils
+
+
+
+class Flight(object):
+    'One execution in progress, and its outcome'
+    
+    __slots__ = ['done', 'results', 'error']
+    
+    def __init__(self):
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+
+class SingleFlight(object):
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.flights = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+    
+    def fetch(self, serialization, parameters, function):
+        '''
+        Call `function(parameters)`, unless another thread is already
+        calling it for the same serialization and bound parameters, in
+        which case wait for its results.
+        '''
+        
+        key = (serialization.cache_name, utils.parameters_key(parameters))
+        name = serialization.stats_name
+        
+        with self.lock:
+            counters = self.counters.get(name)
+            if counters is None:
+                counters = self.counters[name] = {
+                    'executions':0, 'shared':0, 'timeouts':0}
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+                counters['executions'] += 1
+        
+        if leader:
+            try:
+                flight.results = function(parameters)
+            except Exception as error:
+                flight.error = error
+                raise
+            finally:
+                with self.lock:
+                    if self.flights.get(key) is flight:
+                        del self.flights[key]
+                flight.done.set()
+            return flight.results
+        
+        if not flight.done.wait(self.timeout):
+            with self.lock:
+                counters['timeouts'] += 1
+            return function(parameters)
+        
+        with self.lock:
+            counters['shared'] += 1
+        if flight.error is not None:
+            raise flight.error
+        return list(flight.results)
+    
+    def forget(self, name):
+        '''
+        Let later callers of the serialization called `name` start a
+        new execution instead of waiting for the ones in progress,
+        whose results may be out of date.
+        '''
+        with self.lock:
+            for key in [key for key in self.flights if key[0] == name]:
+                del self.flights[key]
+    
+    def stats(self):
+        'A copy of the counters, by serialization name'
+        with self.lock:
+            return dict((name, dict(counters))
+                for name, counters in self.counters.items())
@@ -0,0 +1,189 @@
+'''
+Typed placeholders.
+
+A placeholder can be given a type after a colon, like `$id:int` or
+`$day:date`. String values given for it are validated and converted
+by the type's converter when the parameters are bound, before any
+queryset is built. Values which aren't strings are left as they are.
+    
+    serializer.filter(pk='$id:int', created__date='$day:date')
+
+List placeholders are typed with the type of their items followed by
+[], like `$ids:int[]`, or as `$names:list`, a list of strings. Their
+values are lists, or comma separated strings. See dqs.lists.
+
+New types can be added with register_converter().
+
+'''
+
+import datetime
+import decimal
+import re
+import uuid
+
+from django.utils import dateparse
+
+from dqs import lists
+
+
+
+class InvalidParameter(ValueError):
+    'A parameter value is not valid for the type of its placeholder'
+
+
+
+class Converter(object):
+    '''
+    Validates string values against `regex`, then converts them with
+    to_python(), which may raise ValueError.
+    '''
+    
+    regex = '.*'
+    
+    def __init__(self):
+        self.pattern = re.compile(self.regex)
+    
+    def to_python(self, value):
+        return value
+    
+    def convert(self, placeholder, value):
+        if not isinstance(value, str):
+            return value
+        if self.pattern.fullmatch(value) is None:
+            raise InvalidParameter('Invalid value for $%s: %r'
+                % (placeholder, value))
+        try:
+            return self.to_python(value)
+        except (ValueError, ArithmeticError):
+            raise InvalidParameter('Invalid value for $%s: %r'
+                % (placeholder, value))
+
+
+
+class StringConverter(Converter):
+    regex = '[^/]+'
+
+
+
+class SlugConverter(Converter):
+    regex = '[-a-zA-Z0-9_]+'
+
+
+
+class IntConverter(Converter):
+    regex = '-?[0-9]+'
+    
+    def to_python(self, value):
+        return int(value)
+
+
+
+class FloatConverter(Converter):
+    regex = r'-?[0-9]+(\.[0-9]+)?'
+    
+    def to_python(self, value):
+        return float(value)
+
+
+
+class DecimalConverter(Converter):
+    regex = r'-?[0-9]+(\.[0-9]+)?'
+    
+    def to_python(self, value):
+        return decimal.Decimal(value)
+
+
+
+class BooleanConverter(Converter):
+    regex = 'true|false|1|0'
+    
+    def to_python(self, value):
+        return value in ('true', '1')
+
+
+
+class UUIDConverter(Converter):
+    regex = '[0-9a-fA-F]{8}-?([0-9a-fA-F]{4}-?){3}[0-9a-fA-F]{12}'
+    
+    def to_python(self, value):
+        return uuid.UUID(value)
+
+
+
+class DateConverter(Converter):
+    regex = '[0-9]{4}-[0-9]{2}-[0-9]{2}'
+    
+    def to_python(self, value):
+        return datetime.date.fromisoformat(value)
+
+
+
+class DateTimeConverter(Converter):
+    regex = r'[0-9]{4}-[0-9]{2}-[0-9]{2}[T ][0-9:.]+(Z|[+-][0-9:]+)?'
+    
+    def to_python(self, value):
+        parsed = dateparse.parse_datetime(value)
+        if parsed is None:
+            raise ValueError(value)
+        return parsed
+
+
+
+class ListConverter(Converter):
+    'Converts lists, or comma separated strings, item by item'
+    
+    def __init__(self, item):
+        self.item = item
+    
+    def convert(self, placeholder, value):
+        if isinstance(value, str):
+            value = value.split(',') if value else []
+        elif not isinstance(value, (list, tuple, set, frozenset)):
+            raise InvalidParameter('Invalid value for $%s: %r'
+                % (placeholder, value))
+        return lists.ListParameter([self.item.convert(placeholder, item)
+            for item in value])
+
+CONVERTERS = {
+    'str':StringConverter(),
+    'slug':SlugConverter(),
+    'int':IntConverter(),
+    'float':FloatConverter(),
+    'decimal':DecimalConverter(),
+    'bool':BooleanConverter(),
+    'uuid':UUIDConverter(),
+    'date':DateConverter(),
+    'datetime':DateTimeConverter(),
+}
+
+
+
+def register_converter(name, converter):
+    'Make a Converter instance available as the `name` placeholder type'
+    CONVERTERS[name] = converter
+
+
+
+def get_converter(name):
+    if name == 'list':
+        return ListConverter(CONVERTERS['str'])
+    if name.endswith('[]'):
+        return ListConverter(get_converter(name[:-2]))
+    try:
+        return CONVERTERS[name]
+    except KeyError:
+        raise ValueError('Unknown placeholder type: %s' % name)
+
+
+
+def convert(converters, parameters):
+    '''
+    Convert the values of bound parameters, given a dict mapping
+    placeholders to their converters.
+    '''
+    converted = dict(parameters)
+    for placeholder, converter in converters.items():
+        if placeholder in converted:
+            converted[placeholder] = converter.convert(placeholder,
+                converted[placeholder])
+    return converted
@@ -0,0 +1,128 @@
+'''
+Counting the rows of registered serializations.
+
+Exact counts replay the chain without the steps which can't change
+the number of rows, like order_by(). When values() rows are annotated
+with aggregates, Django adds the ordering to the GROUP BY, and there
+the ordering is kept. QuerySet.count() drops it anyway, so grouped
+querysets are counted by wrapping their SQL in a COUNT(*). Estimated counts ask the
+database planner instead of counting: EXPLAIN on PostgreSQL, and the
+sqlite_stat1 table, filled by ANALYZE, on SQLite. When no estimate is
+available the count is exact, and flagged as such.
+
+'''
+
+import json
+from collections import namedtuple
+
+from django.core.exceptions import EmptyResultSet
+from django.db import DatabaseError, connections
+
+'steps which never change how many rows a chain has'
+COUNT_NEUTRAL_METHODS = ('order_by', 'reverse', 'select_related',
+    'prefetch_related')
+
+'steps which may be part of the GROUP BY, and change the count then'
+ORDERING_METHODS = ('order_by', 'reverse')
+
+Estimate = namedtuple('Estimate', ['count', 'approximate'])
+
+
+
+def groups_by_ordering(plan, base_queryset):
+    '''
+    Whether the ordering may be part of the GROUP BY: when values() or
+    values_list() is followed by annotate() or aggregate().
+    '''
+    if base_queryset.query.group_by is not None:
+        return True
+    shaped = base_queryset._fields is not None
+    for step in plan.steps:
+        if step.name in ('values', 'values_list'):
+            shaped = True
+        elif step.name in ('annotate', 'aggregate') and shaped:
+            return True
+    return False
+
+
+
+def count_queryset(plan, base_queryset, parameters):
+    '''
+    The queryset to count: the chain without the count neutral steps.
+    With distinct() the ordering may change which rows are distinct,
+    so those chains are replayed unchanged.
+    '''
+    if base_queryset.query.is_sliced or any(step.name == 'distinct'
+            for step in plan.steps):
+        return plan.replay(base_queryset, parameters)
+    skip = COUNT_NEUTRAL_METHODS
+    if groups_by_ordering(plan, base_queryset):
+        skip = [name for name in skip if name not in ORDERING_METHODS]
+    return plan.replay(base_queryset, parameters, skip=skip)
+
+
+
+def count_rows(queryset):
+    '''
+    Count the rows of a queryset. Grouped querysets are counted as the
+    SQL which fetches them, with the ordering in the GROUP BY.
+    '''
+    if queryset.query.group_by is None:
+        return queryset.count()
+    try:
+        sql, params = queryset.query.sql_with_params()
+    except EmptyResultSet:
+        return 0
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute('SELECT COUNT(*) FROM (%s) dqs_counted' % sql, params)
+        return cursor.fetchone()[0]
+
+
+
+def estimate(queryset):
+    'Estimate the rows of a queryset, returning an Estimate'
+    
+    connection = connections[queryset.db]
+    try:
+        if connection.vendor == 'postgresql':
+            count = estimate_postgresql(queryset, connection)
+        elif connection.vendor == 'sqlite':
+            count = estimate_sqlite(queryset, connection)
+        else:
+            count = None
+    except DatabaseError:
+        count = None
+    
+    if count is None:
+        return Estimate(count_rows(queryset), False)
+    return Estimate(count, True)
+
+
+
+def estimate_postgresql(queryset, connection):
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        explained = cursor.fetchone()[0]
+    if isinstance(explained, str):
+        explained = json.loads(explained)
+    return int(explained[0]['Plan']['Plan Rows'])
+
+
+
+def estimate_sqlite(queryset, connection):
+    '''
+    sqlite_stat1 only knows the number of rows of whole tables, so only
+    unfiltered querysets can be estimated.
+    '''
+    query = queryset.query
+    if (query.where or query.is_sliced or query.distinct
+            or query.group_by is not None or len(query.alias_map) > 1):
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s',
+            [queryset.model._meta.db_table])
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    return int(row[0].split()[0])
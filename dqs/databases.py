@@ -0,0 +1,264 @@
+'''
+Database routing policies for registered serializations.
+
+Pass one to register() as the `routing` option, and the querysets of
+the serialization are sent to the database it chooses:
+ 
+ - RoundRobin(aliases) takes turns between read replicas.
+ - LeastLatency(aliases) picks the replica whose fetches have been
+ fastest lately, trying the others again now and then.
+ - ShardKey(placeholder, shards) picks the shard holding the rows
+ from the value of a parameter.
+    
+    dqs.register('orders', serializer, Order.objects.all(),
+        routing=ShardKey('tenant', ['shard-0', 'shard-1', 'shard-2']))
+
+When choose() gives no database, like a ShardKey whose parameter is
+not given, fetch() and count() run on every database of fan_out(), in
+parallel in a thread pool if the policy is `parallel`, as ShardKey is
+by default. The results are merged in the order of the chain's
+order_by(). Worker threads have their own
+connections, so they don't see the uncommitted changes of the calling
+thread. Strings are merged in Python's order, which may differ from
+the collation of the database.
+
+'''
+
+import heapq
+import itertools
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections
+
+from dqs import counting, pagination
+
+
+
+executor_lock = threading.Lock()
+
+
+
+class RoutingPolicy(object):
+    '''
+    Base class of the routing policies. choose() returns the alias of
+    the database to use for some bound parameters, or None when the
+    query must run on every database given by fan_out().
+    
+    map() runs the queries on every database, one after the other, or
+    with `parallel`, in a pool of up to `max_workers` threads.
+    '''
+    
+    parallel = False
+    max_workers = None
+    executor = None
+    
+    def choose(self, parameters):
+        raise NotImplementedError
+    
+    def fan_out(self, parameters):
+        'The aliases to run on, when choose() returns None'
+        return ()
+    
+    def record(self, alias, seconds):
+        'Called with the duration of every fetch'
+    
+    def map(self, function, aliases):
+        'Call function(alias) for every alias, and return the results'
+        if not self.parallel:
+            return [function(alias) for alias in aliases]
+        
+        with executor_lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix='dqs-databases')
+        
+        def run(alias):
+            try:
+                return function(alias)
+            finally:
+                close_old_connections()
+        
+        return list(self.executor.map(run, aliases))
+
+
+
+class RoundRobin(RoutingPolicy):
+    def __init__(self, aliases):
+        self.aliases = list(aliases)
+        self.cycle = itertools.cycle(self.aliases)
+        self.lock = threading.Lock()
+    
+    def choose(self, parameters):
+        with self.lock:
+            return next(self.cycle)
+
+
+
+class LeastLatency(RoutingPolicy):
+    '''
+    Picks the database with the lowest moving average of fetch
+    durations. Databases without any measurement are tried first.
+    `weight` is how much every new measurement counts.
+    
+    Every `explore`th choice goes to the database measured the longest
+    time ago instead, so a slow database which got faster is noticed.
+    '''
+    
+    def __init__(self, aliases, weight=0.2, explore=20):
+        self.aliases = list(aliases)
+        self.weight = weight
+        self.explore = explore
+        self.latencies = {}
+        self.measured = {}
+        self.choices = itertools.count(1)
+        self.lock = threading.Lock()
+    
+    def choose(self, parameters):
+        latencies = self.latencies
+        for alias in self.aliases:
+            if alias not in latencies:
+                return alias
+        if self.explore and next(self.choices) % self.explore == 0:
+            return min(self.aliases, key=self.measured.get)
+        return min(self.aliases, key=latencies.get)
+    
+    def record(self, alias, seconds):
+        with self.lock:
+            self.measured[alias] = time.monotonic()
+            previous = self.latencies.get(alias)
+            self.latencies[alias] = (seconds if previous is None
+                else previous + self.weight * (seconds - previous))
+
+
+
+class ShardKey(RoutingPolicy):
+    '''
+    Picks a shard from the value of the `placeholder` parameter.
+    `shards` is a list of aliases, which values are hashed into, a dict
+    mapping values to aliases, or a function taking the value and
+    returning the alias.
+    
+    Values are hashed, and looked up in the dict, as strings, so the
+    int 1 and the '1' of an untyped URL segment go to the same shard.
+    
+    Without a value for the placeholder, queries run on every shard,
+    using up to `max_workers` threads, or one after the other in the
+    calling thread if `parallel` is False.
+    '''
+    
+    def __init__(self, placeholder, shards, parallel=True, max_workers=None):
+        self.placeholder = placeholder.lstrip('$')
+        self.shards = shards
+        if isinstance(shards, dict):
+            self.shards = dict((str(value), alias)
+                for value, alias in shards.items())
+        self.parallel = parallel
+        self.max_workers = max_workers
+    
+    def aliases(self):
+        if isinstance(self.shards, dict):
+            return sorted(set(self.shards.values()))
+        if callable(self.shards):
+            raise ValueError('Can\'t list the shards of a shard function')
+        return list(self.shards)
+    
+    def choose(self, parameters):
+        if parameters.get(self.placeholder) is None:
+            return None
+        value = parameters[self.placeholder]
+        
+        if isinstance(self.shards, dict):
+            try:
+                return self.shards[str(value)]
+            except KeyError:
+                raise ValueError('No shard for %s=%r' % (self.placeholder,
+                    value))
+        if callable(self.shards):
+            return self.shards(value)
+        
+        index = zlib.crc32(str(value).encode('utf-8'))
+        return self.shards[index % len(self.shards)]
+    
+    def fan_out(self, parameters):
+        return self.aliases()
+
+
+
+class SortKey(object):
+    'Compares lists of ordering key values, like the database would'
+    
+    __slots__ = ['values', 'descending']
+    
+    def __init__(self, values, descending):
+        self.values = values
+        self.descending = descending
+    
+    def __lt__(self, other):
+        for mine, theirs, descending in zip(self.values, other.values,
+                self.descending):
+            if mine == theirs:
+                continue
+            'NULLs go last when ascending, first when descending'
+            if mine is None:
+                return descending
+            if theirs is None:
+                return not descending
+            return (mine > theirs) if descending else (mine < theirs)
+        return False
+
+
+
+def timed(policy, alias, function):
+    'Call function, recording its duration for the policy'
+    start = time.perf_counter()
+    result = function()
+    policy.record(alias, time.perf_counter() - start)
+    return result
+
+
+
+def fetch_with_keys(queryset, ordering):
+    '''
+    Evaluate a queryset in `ordering`, as a list of (row, key values)
+    pairs for merge(). Just the rows when ordering is None.
+    '''
+    if ordering is None:
+        return list(queryset)
+    queryset, flat = pagination.annotate_keys(pagination.order(queryset,
+        ordering), ordering)
+    return [pagination.split_keys(row, len(ordering), flat)
+        for row in queryset]
+
+
+
+def merge(parts, ordering):
+    'Merge the results of fetch_with_keys() in `ordering`'
+    if ordering is None:
+        return list(itertools.chain(*parts))
+    
+    descending = [descending for path, descending in ordering]
+    return [row for row, values in heapq.merge(*parts,
+        key=lambda part:SortKey(part[1], descending))]
+
+
+
+def fan_out(serialization, parameters, aliases):
+    '''
+    Fetch the results of a serialization on every alias, and merge
+    them in the order of its order_by(), if it has one.
+    '''
+    ordering = serialization.keyset_ordering
+    return merge(serialization.routing.map(lambda alias:fetch_with_keys(
+        serialization._build_queryset(parameters, alias), ordering),
+        aliases), ordering)
+
+
+
+def fan_out_count(serialization, queryset, aliases):
+    'Count the rows of a queryset on every alias'
+    return sum(serialization.routing.map(
+        lambda alias:counting.count_rows(queryset.using(alias)), aliases))
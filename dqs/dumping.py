@@ -0,0 +1,237 @@
+'''
+Saving chains and registries, and loading them back.
+
+Chains are dumped to compact JSON. Every operation is a list of its
+method name, positional arguments and keyword argument pairs, with
+placeholders written like they were given ('$id:int'). Values JSON
+doesn't have are tagged objects, like {"~":"date","v":"2020-01-31"}:
+tuples, dicts, sets, dates and times, decimals, UUIDs, Q and F
+objects, and model instances, which are saved as their model and pk.
+
+Loaded model instances are not fetched from the database. They only
+have their pk, which is all filters need.
+
+'''
+
+import datetime
+import decimal
+import json
+import uuid
+
+from django.apps import apps
+from django.db.models import F, Q
+
+from dqs import utils
+
+VERSION = 1
+
+CHAIN_FORMAT = 'dqs-chain'
+REGISTRY_FORMAT = 'dqs-registry'
+
+'Serialization options which are saved in registries'
+OPTIONS = ['query_template', 'sql_cache', 'count_ttl', 'keyset',
+    'max_specializations', 'defaults', 'updated_field']
+
+'Options holding live objects, which can\'t be saved in registries'
+UNSAVED_OPTIONS = ['routing', 'refresher', 'snapshots', 'coalesce',
+    'versions']
+
+
+
+def encode(value):
+    'Turn an argument value into something JSON can hold'
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, list):
+        return [encode(item) for item in value]
+    if isinstance(value, tuple):
+        return {'~':'tuple', 'v':[encode(item) for item in value]}
+    if isinstance(value, (set, frozenset)):
+        return {'~':'set', 'v':[encode(item) for item in value]}
+    if isinstance(value, dict):
+        return {'~':'dict', 'v':[[encode(key), encode(val)]
+            for key, val in value.items()]}
+    if isinstance(value, datetime.datetime):
+        return {'~':'datetime', 'v':value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'~':'date', 'v':value.isoformat()}
+    if isinstance(value, datetime.time):
+        return {'~':'time', 'v':value.isoformat()}
+    if isinstance(value, datetime.timedelta):
+        return {'~':'timedelta', 'v':[value.days, value.seconds,
+            value.microseconds]}
+    if isinstance(value, decimal.Decimal):
+        return {'~':'decimal', 'v':str(value)}
+    if isinstance(value, uuid.UUID):
+        return {'~':'uuid', 'v':str(value)}
+    if isinstance(value, Q):
+        return {'~':'q', 'v':[value.connector, value.negated,
+            [encode(child) for child in value.children]]}
+    if isinstance(value, F):
+        return {'~':'f', 'v':value.name}
+    if hasattr(value, '_meta') and hasattr(value, 'pk'):
+        if value.pk is None:
+            raise ValueError('Unsaved model instances can\'t be dumped')
+        return {'~':'model', 'v':[value._meta.label_lower, encode(value.pk)]}
+    raise ValueError('Values of type %s can\'t be dumped'
+        % type(value).__name__)
+
+
+
+def decode_tagged(obj):
+    'json object_hook, turning tagged objects back into values'
+    tag = obj.get('~')
+    value = obj.get('v')
+    if tag == 'tuple':
+        return tuple(value)
+    if tag == 'set':
+        return set(value)
+    if tag == 'dict':
+        return dict((utils.freeze(key), val) for key, val in value)
+    if tag == 'datetime':
+        return datetime.datetime.fromisoformat(value)
+    if tag == 'date':
+        return datetime.date.fromisoformat(value)
+    if tag == 'time':
+        return datetime.time.fromisoformat(value)
+    if tag == 'timedelta':
+        return datetime.timedelta(*value)
+    if tag == 'decimal':
+        return decimal.Decimal(value)
+    if tag == 'uuid':
+        return uuid.UUID(value)
+    if tag == 'q':
+        connector, negated, children = value
+        return Q(*children, _connector=connector, _negated=negated)
+    if tag == 'f':
+        return F(value)
+    if tag == 'model':
+        label, pk = value
+        instance = apps.get_model(label)(pk=pk)
+        instance._state.adding = False
+        return instance
+    return obj
+
+
+
+def escape(value, slots, position, kind, types):
+    '''
+    Write an argument of an operation like it was given to the chain:
+    placeholders as '$name' or '$name:type', and strings starting
+    with $ escaped with another $.
+    '''
+    placeholder = slots.get((kind, position))
+    if placeholder is not None:
+        type = types.get(placeholder)
+        return '$' + placeholder + (':' + type if type else '')
+    if isinstance(value, str) and value.startswith('$'):
+        return '$' + value
+    return encode(value)
+
+
+
+def dump_chain(chain):
+    'The operations of a chain, as a list JSON can hold'
+    operations = []
+    for operation in chain._operations():
+        slots = dict(((kind, position), placeholder)
+            for kind, position, placeholder in operation.slots)
+        types = dict(operation.types)
+        operations.append([operation.name,
+            [escape(arg, slots, position, 'arg', types)
+                for position, arg in enumerate(operation.args)],
+            [[escape(key, slots, position, 'key', types),
+                    escape(val, slots, position, 'value', types)]
+                for position, (key, val) in enumerate(operation.kwargs)]])
+    return operations
+
+
+
+def load_chain(operations, chain):
+    'Apply dumped operations to a chain, usually an empty one'
+    for name, args, kwargs in operations:
+        chain = chain.method(name, *args, **dict(kwargs))
+    return chain
+
+
+
+def check_format(data, format):
+    if data.get('format') != format:
+        raise ValueError('Not a %s dump' % format)
+    if data.get('version') != VERSION:
+        raise ValueError('Unsupported %s version: %r' % (format,
+            data.get('version')))
+
+
+
+def dumps_chain(chain):
+    return json.dumps({'format':CHAIN_FORMAT, 'version':VERSION,
+        'operations':dump_chain(chain)}, separators=(',', ':'))
+
+
+
+def loads_chain(data, chain):
+    data = json.loads(data, object_hook=decode_tagged)
+    check_format(data, CHAIN_FORMAT)
+    return load_chain(data['operations'], chain)
+
+
+
+def dump_registry(registry):
+    '''
+    Dump the serializations of a DjangoQuerysetSerialization. Their
+    base querysets must be the default manager's all(), and result
+    caches are not saved. Serializations with any of UNSAVED_OPTIONS
+    can't be dumped; pass those to load_registry() instead.
+    '''
+    
+    serializations = []
+    for name in registry:
+        serialization = registry[name]
+        model = serialization.base_queryset.model
+        if (str(serialization.base_queryset.query)
+                != str(model._default_manager.all().query)):
+            raise ValueError(('The base queryset of %s can\'t be dumped. '
+                + 'Move its filters to the chain') % name)
+        unsaved = [option for option in UNSAVED_OPTIONS
+            if getattr(serialization, option) is not None]
+        if unsaved:
+            raise ValueError('The %s option of %s can\'t be dumped'
+                % (', '.join(unsaved), name))
+        options = serialization.options()
+        serializations.append({
+            'name':name,
+            'model':model._meta.label_lower,
+            'operations':dump_chain(serialization.serializer),
+            'options':dict((key, encode(options[key])) for key in OPTIONS),
+        })
+    
+    return json.dumps({'format':REGISTRY_FORMAT, 'version':VERSION,
+        'serializations':serializations}, separators=(',', ':'))
+
+
+
+def load_registry(data, registry, **options):
+    '''
+    Register the serializations of a dump in a DjangoQuerysetSerialization.
+    Keyword options are passed on to every Serialization, overriding
+    the saved ones.
+    
+    The chains are rebuilt from the dump, but the serializations are
+    not compiled here: each one is compiled on first use, or by
+    warmup(). Loading and compiling everything costs about as much as
+    registering the chains in Python (compare the registry_build and
+    registry_load_compiled benchmarks); loading only moves the
+    compilation out of startup.
+    '''
+    
+    data = json.loads(data, object_hook=decode_tagged)
+    check_format(data, REGISTRY_FORMAT)
+    
+    for saved in data['serializations']:
+        chain = load_chain(saved['operations'], registry.make_serializer())
+        model = apps.get_model(saved['model'])
+        registry.register(saved['name'], chain,
+            model._default_manager.all(), compile=False,
+            **dict(saved['options'], **options))
+    return registry
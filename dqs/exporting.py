@@ -0,0 +1,181 @@
+'''
+Exporting values() and values_list() chains without building rows.
+
+The SQL of the queryset is run through a raw cursor, and the rows are
+read in fetchmany() batches. Every batch is turned into columns, and
+only the columns which need it are converted, with converters chosen
+once from the field types: the database backend's own converters,
+then one making the values JSON friendly (dates and times, decimals,
+UUIDs and durations become strings, like DjangoJSONEncoder does).
+
+The payload is either columnar JSON, mapping every field name to the
+list of its values:
+    
+    {"name":["a","b"],"gender":[1,2]}
+
+or CSV, with a header row.
+
+'''
+
+import csv
+import io
+import json
+
+from django.core.exceptions import EmptyResultSet
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+
+FORMATS = ('json', 'csv')
+
+'fields whose values DjangoJSONEncoder turns into strings'
+ENCODED_TYPES = frozenset(['DateField', 'DateTimeField', 'TimeField',
+    'DurationField', 'DecimalField', 'UUIDField'])
+
+
+
+def column_converter(converters, expression, connection, encode):
+    '''
+    Compose the backend converters of a column and the JSON encoding
+    of its field into one function. Returns None when the values can
+    be used as they are.
+    '''
+    
+    steps = [(lambda value, converter=converter:
+            converter(value, expression, connection))
+        for converter in converters]
+    if encode:
+        default = DjangoJSONEncoder().default
+        steps.append(lambda value:None if value is None else default(value))
+    
+    if not steps:
+        return None
+    if len(steps) == 1:
+        return steps[0]
+    
+    def convert(value):
+        for step in steps:
+            value = step(value)
+        return value
+    return convert
+
+
+
+def converters_for(compiler, select, alias):
+    'The converter (or None) of every selected column'
+    connection = connections[alias]
+    backend = compiler.get_converters([column for column, sql, name
+        in select])
+    converters = []
+    for index, (column, sql, name) in enumerate(select):
+        try:
+            internal_type = column.output_field.get_internal_type()
+        except AttributeError:
+            internal_type = None
+        converters.append(column_converter(
+            backend[index][0] if index in backend else [], column,
+            connection, internal_type in ENCODED_TYPES))
+    return converters
+
+
+
+def compile_export(queryset):
+    '''
+    Compile a values() or values_list() queryset. Returns the SQL, its
+    parameters, the field names and a converter (or None) by column.
+    Raises EmptyResultSet when the queryset can't match anything.
+    '''
+    
+    if getattr(queryset, '_fields', None) is None:
+        raise ValueError('Only values() and values_list() chains can be '
+            + 'exported')
+    
+    query = queryset.query
+    compiler = query.get_compiler(using=queryset.db)
+    sql, params = compiler.as_sql()
+    
+    select = compiler.select[:compiler.col_count]
+    if len(field_names(query)) != len(select):
+        raise ValueError('Unsupported values() columns')
+    
+    return sql, params, field_names(query), converters_for(compiler, select,
+        queryset.db)
+
+
+
+def field_names(query):
+    return (list(query.extra_select) + list(query.values_select)
+        + list(query.annotation_select))
+
+
+
+def batches(alias, sql, params, batch_size):
+    'Yield the rows of the SQL, fetchmany() batch by batch'
+    with connections[alias].cursor() as cursor:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+
+
+
+def to_columns(rows, count, converters):
+    'Transpose a batch of rows, and convert the columns which need it'
+    columns = list(zip(*rows)) if rows else [()] * count
+    return [list(column) if converter is None
+            else [converter(value) for value in column]
+        for column, converter in zip(columns[:count], converters)]
+
+
+
+def export(queryset, format='json', batch_size=2000):
+    'Export a values() or values_list() queryset as JSON or CSV'
+    try:
+        sql, params, names, converters = compile_export(queryset)
+    except EmptyResultSet:
+        names = field_names(queryset.query)
+        return write([], names, [None] * len(names), format)
+    
+    return write(batches(queryset.db, sql, params, batch_size), names,
+        converters, format)
+
+
+
+def export_compiled(compiled, params, format='json', batch_size=2000):
+    '''
+    Export the rows of a dqs.sqlcache.CompiledQuery, given its bound
+    SQL parameters. Its converters are kept on it.
+    '''
+    if compiled.export_converters is None:
+        compiled.export_converters = converters_for(
+            compiled.query.get_compiler(using=compiled.alias),
+            compiled.select[:compiled.col_count], compiled.alias)
+    
+    return write(batches(compiled.alias, compiled.sql, params, batch_size),
+        compiled.names, compiled.export_converters, format)
+
+
+
+def write(rows, names, converters, format):
+    'Encode batches of rows'
+    
+    if format not in FORMATS:
+        raise ValueError('Unknown export format: %s' % format)
+    
+    count = len(names)
+    
+    if format == 'json':
+        columns = [[] for name in names]
+        for batch in rows:
+            for column, values in zip(columns, to_columns(batch, count,
+                    converters)):
+                column.extend(values)
+        return json.dumps(dict(zip(names, columns)), separators=(',', ':'))
+    
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(names)
+    for batch in rows:
+        writer.writerows(zip(*to_columns(batch, count, converters)))
+    return output.getvalue()
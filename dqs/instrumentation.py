@@ -0,0 +1,200 @@
+'''
+Per-serialization statistics.
+
+Disabled by default. Once enabled, every call to get_queryset,
+fetch, get_querysets_many, count, count_many, get_page and export of
+a serialization is measured:
+ 
+ - calls: how many times it was called.
+ - replay_time: microseconds spent replaying the chain, in
+get_queryset.
+ - query_time: microseconds spent running database queries.
+ - queries: how many database queries a call made.
+ - rows: how many rows fetch, get_querysets_many and get_page
+returned.
+
+get_queryset, from_url and stream return lazy querysets or
+iterators, so only their replay is measured, not the queries run
+when they are evaluated. Serializations made by bind() are counted
+as their parent, and those without a name together, as UNNAMED.
+
+Measurements go into fixed size histograms, so memory use doesn't
+grow with traffic. Get them with dqs.stats(), or export every
+measurement as it is made by adding a hook:
+    
+    from dqs import instrumentation
+    instrumentation.enable()
+    instrumentation.add_hook(lambda name, event: statsd.timing(
+        'dqs.%s.query' % name, event.get('query_time', 0) / 1000.0))
+
+When disabled, the only cost is checking `instruments.enabled`.
+
+'''
+
+import contextlib
+import threading
+import time
+
+from django.db import connections
+
+BUCKETS = 32
+
+'The stats name of serializations which weren\'t registered'
+UNNAMED = '<unnamed>'
+
+
+
+class Histogram(object):
+    '''
+    Counts values in power of two buckets. Bucket n holds the values
+    below 2**n, and at least 2**(n - 1).
+    '''
+    
+    __slots__ = ['buckets', 'count', 'total', 'min', 'max']
+    
+    def __init__(self):
+        self.buckets = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+    
+    def add(self, value):
+        value = int(value)
+        self.buckets[min(BUCKETS - 1, value.bit_length())] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+    
+    def percentile(self, fraction):
+        'The upper bound of the bucket holding the percentile'
+        if not self.count:
+            return None
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= fraction * self.count:
+                return min(2 ** index, self.max)
+        return self.max
+    
+    def snapshot(self):
+        return {
+            'count':self.count,
+            'sum':self.total,
+            'min':self.min,
+            'max':self.max,
+            'mean':self.total / self.count if self.count else None,
+            'p50':self.percentile(0.5),
+            'p90':self.percentile(0.9),
+            'p99':self.percentile(0.99),
+        }
+
+
+
+class SerializationStats(object):
+    METRICS = ('replay_time', 'query_time', 'queries', 'rows')
+    
+    def __init__(self):
+        self.calls = 0
+        self.histograms = dict((metric, Histogram())
+            for metric in self.METRICS)
+    
+    def snapshot(self):
+        snapshot = dict((metric, histogram.snapshot())
+            for metric, histogram in self.histograms.items())
+        snapshot['calls'] = self.calls
+        return snapshot
+
+
+
+class Instruments(object):
+    def __init__(self):
+        self.enabled = False
+        self.stats = {}
+        self.hooks = []
+        self.lock = threading.Lock()
+    
+    def record(self, name, event):
+        'Add the measurements of one call to the stats of `name`'
+        with self.lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = SerializationStats()
+            stats.calls += 1
+            for metric, value in event.items():
+                stats.histograms[metric].add(value)
+        for hook in self.hooks:
+            hook(name, event)
+    
+    def snapshot(self, names=None):
+        with self.lock:
+            return dict((name, stats.snapshot())
+                for name, stats in self.stats.items()
+                if names is None or name in names)
+    
+    @contextlib.contextmanager
+    def measure(self, name, queries=False):
+        '''
+        Measure a call. The event dict is yielded, so that the caller
+        can add measurements, like rows. With `queries`, the database
+        queries are counted and timed.
+        '''
+        event = {}
+        with contextlib.ExitStack() as stack:
+            if queries:
+                counter = QueryCounter(event)
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(
+                        counter))
+            yield event
+        self.record(name, event)
+
+
+
+class QueryCounter(object):
+    'A database execute_wrapper counting and timing queries'
+    
+    def __init__(self, event):
+        self.event = event
+        event['queries'] = 0
+        event['query_time'] = 0
+    
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.event['queries'] += 1
+            self.event['query_time'] += int(
+                (time.perf_counter() - start) * 1000000)
+
+
+
+def timer():
+    'Microseconds, for measuring durations'
+    return int(time.perf_counter() * 1000000)
+
+instruments = Instruments()
+
+def enable():
+    instruments.enabled = True
+
+def disable():
+    instruments.enabled = False
+
+def add_hook(hook):
+    '''
+    Call hook(name, event) after every measured call, where event is a
+    dict of the measurements.
+    '''
+    instruments.hooks.append(hook)
+
+def remove_hook(hook):
+    instruments.hooks.remove(hook)
+
+def reset():
+    with instruments.lock:
+        instruments.stats.clear()
@@ -0,0 +1,135 @@
+'''
+Fingerprints and interning of FilterChains.
+
+Every operation of a chain has a fingerprint: a SHA-1 hex digest of
+its method name, its arguments, where its placeholders are, and the
+fingerprint of the operation before it. Chains with the same
+operations have the same fingerprint, in any process, so it can be
+used as a cache key. Chains compare equal, and hash, by fingerprint.
+
+Argument values are fingerprinted by content: the values dqs.dumping
+can save, Q objects, anything with a deconstruct() method, like
+Django's expressions, and querysets, by their SQL and parameters,
+without running them. Other values are fingerprinted by identity, so
+they are only equal to themselves, and chains holding them are only
+stable within one process.
+
+DjangoQuerysetSerialization interns the chains given to register(),
+so registering the same chain many times keeps one copy of it, and
+chains sharing a prefix share its operation nodes.
+
+'''
+
+import hashlib
+import json
+import threading
+import weakref
+
+from django.core.exceptions import EmptyResultSet
+from django.db.models import Q
+from django.db.models.query import QuerySet
+
+from dqs import dumping
+
+EMPTY_FINGERPRINT = hashlib.sha1(b'[]').hexdigest()
+
+
+
+def json_key(value):
+    return json.dumps(value, sort_keys=True)
+
+
+
+def canonical(value):
+    'A JSON-able form of an argument value, the same for equal values'
+    if isinstance(value, list):
+        return [canonical(item) for item in value]
+    if isinstance(value, tuple):
+        return {'~':'tuple', 'v':[canonical(item) for item in value]}
+    if isinstance(value, (set, frozenset)):
+        return {'~':'set', 'v':sorted([canonical(item) for item in value],
+            key=json_key)}
+    if isinstance(value, dict):
+        return {'~':'dict', 'v':sorted([[canonical(key), canonical(val)]
+            for key, val in value.items()], key=json_key)}
+    if isinstance(value, Q):
+        return {'~':'q', 'v':[value.connector, value.negated,
+            [canonical(child) for child in value.children]]}
+    if isinstance(value, QuerySet):
+        return {'~':'queryset', 'v':[value.model._meta.label_lower,
+            value.db, query_content(value.query)]}
+    try:
+        return dumping.encode(value)
+    except ValueError:
+        pass
+    if hasattr(value, 'deconstruct') and not isinstance(value, type):
+        path, args, kwargs = value.deconstruct()
+        return {'~':'object', 'v':[path, canonical(list(args)),
+            canonical(dict(kwargs))]}
+    'the operation node keeps the value alive, so its id is not reused'
+    return {'~':'id', 'v':'%s.%s:%d' % (type(value).__module__,
+        type(value).__name__, id(value))}
+
+
+
+def query_content(query):
+    '''
+    The SQL and parameters of a query, compiled but not run. Queries
+    which can't match anything have no SQL.
+    '''
+    try:
+        sql, params = query.sql_with_params()
+    except EmptyResultSet:
+        return None
+    return [sql, canonical(list(params))]
+
+
+
+def fingerprint(operation):
+    'The fingerprint of an operation node'
+    parent = (operation.parent.fingerprint if operation.parent is not None
+        else EMPTY_FINGERPRINT)
+    content = [parent, operation.name, canonical(list(operation.args)),
+        [[key, canonical(val)] for key, val in operation.kwargs],
+        operation.slots, operation.types]
+    return hashlib.sha1(json_key(content).encode('utf-8')).hexdigest()
+
+
+
+class Interner(object):
+    '''
+    Keeps one copy of every chain and operation node, by fingerprint.
+    Only weak references are kept, so chains which are no longer used
+    anywhere are let go.
+    '''
+    
+    def __init__(self):
+        self.chains = weakref.WeakValueDictionary()
+        self.operations = weakref.WeakValueDictionary()
+        self.lock = threading.Lock()
+    
+    def intern(self, chain):
+        'The interned chain equal to `chain`'
+        
+        with self.lock:
+            interned = self.chains.get(chain.fingerprint)
+            if interned is not None:
+                return interned
+            
+            parent = None
+            for operation in chain._operations():
+                found = self.operations.get(operation.fingerprint)
+                if found is None:
+                    found = (operation if operation.parent is parent
+                        else operation.with_parent(parent))
+                    self.operations[operation.fingerprint] = found
+                parent = found
+            
+            if chain._tail is not parent:
+                chain = chain.__class__()
+                chain._tail = parent
+            self.chains[chain.fingerprint] = chain
+            return chain
+    
+    def stats(self):
+        return {'chains':len(self.chains), 'operations':len(self.operations)}
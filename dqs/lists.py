@@ -0,0 +1,143 @@
+'''
+List placeholders for __in lookups.
+
+Placeholders typed as lists, like `$ids:int[]` or `$names:list`, take
+a list, or a comma separated string in URLs. Their items are converted
+with the item type. When such a placeholder is the value of an __in
+lookup of filter(), the list is bound in the way that suits the
+database and its size:
+ 
+ - on PostgreSQL, as one array parameter: `pk = ANY(%s)`.
+ - on SQLite, lists longer than SQLITE_JSON_MIN are one JSON
+ parameter: `pk IN (SELECT value FROM json_each(%s))`.
+ - on other databases, lists longer than half their parameter limit
+ are split into chunks. fetch() runs one query per chunk, and merges
+ the results in the order of the chain's order_by(). Only lists given
+ to filter() alone are chunked, since the rows excluded by one chunk
+ would come back in the results of the others.
+ - otherwise, as a plain IN list.
+
+The lookup's path must be a field path F() understands. exclude()
+lookups are always plain IN lists: Django excludes across
+multi-valued relations with a subquery, which a rewritten lookup
+would lose.
+
+Chains are always replayed for list parameters, so the query template
+and the SQL cache are not used for them.
+
+'''
+
+import json
+
+from django.db import connections
+from django.db.models import F, Lookup
+
+from dqs import databases
+
+SQLITE_JSON_MIN = 100
+
+REWRITTEN_METHODS = frozenset(['filter'])
+
+
+
+class ListParameter(list):
+    'The value of a list placeholder, once converted'
+
+
+
+class ArrayIn(Lookup):
+    'lhs = ANY(%s), with the values as a single array parameter'
+    
+    lookup_name = 'dqs_array_in'
+    prepare_rhs = False
+    
+    def prepared_values(self, connection):
+        field = self.lhs.output_field
+        return [field.get_db_prep_value(value, connection, prepared=False)
+            for value in self.rhs]
+    
+    def as_sql(self, compiler, connection):
+        lhs_sql, lhs_params = self.process_lhs(compiler, connection)
+        return ('%s = ANY(%%s)' % lhs_sql,
+            list(lhs_params) + [self.prepared_values(connection)])
+
+
+
+class JSONIn(ArrayIn):
+    'lhs IN the values of a single JSON array parameter, for SQLite'
+    
+    lookup_name = 'dqs_json_in'
+    
+    def as_sql(self, compiler, connection):
+        lhs_sql, lhs_params = self.process_lhs(compiler, connection)
+        values = json.dumps(self.prepared_values(connection), default=str)
+        return ('%s IN (SELECT value FROM json_each(%%s))' % lhs_sql,
+            list(lhs_params) + [values])
+
+LOOKUPS = {'array':ArrayIn, 'json':JSONIn}
+
+
+
+def strategy(connection, size):
+    'How to bind a list of `size` values: array, json, chunks or in'
+    if connection.vendor == 'postgresql':
+        return 'array'
+    if connection.vendor == 'sqlite':
+        return 'json' if size > SQLITE_JSON_MIN else 'in'
+    limit = connection.features.max_query_params
+    if limit and size > limit // 2:
+        return 'chunks'
+    return 'in'
+
+
+
+def rewrite(queryset, args, kwargs):
+    '''
+    Replace the __in lookups of list parameters in the arguments of a
+    filter() call with the lookup of their strategy.
+    '''
+    connection = None
+    for key, value in list(kwargs.items()):
+        if not isinstance(value, ListParameter) or not key.endswith('__in'):
+            continue
+        connection = connection or connections[queryset.db]
+        lookup = LOOKUPS.get(strategy(connection, len(value)))
+        if lookup is not None:
+            del kwargs[key]
+            args.append(lookup(F(key[:-len('__in')]), value))
+    return args, kwargs
+
+
+
+def chunked(plan, parameters, connection):
+    '''
+    Find a list parameter too long to be bound on this database, used
+    only by filter() steps, and return its placeholder and its chunks.
+    None if there isn't one.
+    '''
+    for placeholder, value in parameters.items():
+        if (isinstance(value, ListParameter)
+                and strategy(connection, len(value)) == 'chunks'
+                and only_filtered(plan, placeholder)):
+            size = connection.features.max_query_params // 2
+            values = list(dict.fromkeys(value))
+            return placeholder, [ListParameter(values[start:start + size])
+                for start in range(0, len(values), size)]
+    return None
+
+
+
+def only_filtered(plan, placeholder):
+    'Whether every step using the placeholder is a filter()'
+    return all(step.name == 'filter' for step in plan.steps
+        if placeholder in [slot[1] for slot in step.value_slots])
+
+
+
+def fetch_chunked(serialization, parameters, placeholder, chunks):
+    'Fetch the results for every chunk, merged in order'
+    ordering = serialization.keyset_ordering
+    return databases.merge([databases.fetch_with_keys(
+            serialization._build_queryset(dict(parameters,
+                **{placeholder:chunk})), ordering)
+        for chunk in chunks], ordering)
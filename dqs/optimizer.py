@@ -0,0 +1,101 @@
+'''
+Optimizing execution plans before they are run.
+
+optimize() rewrites the steps of a plan without changing the
+queryset it builds:
+ 
+ - all() steps are dropped.
+ - order_by() steps followed by a later order_by() are dropped, since
+ the later one replaces their ordering. reverse() steps are kept.
+ - consecutive filter() calls are merged into one, as long as their
+ lookups don't go through multi-valued relations. Across those,
+ filter(a).filter(b) and filter(a, b) join differently.
+
+Serialization also applies the steps before the first placeholder to
+the base queryset once, when it is compiled.
+
+'''
+
+from django.core.exceptions import FieldDoesNotExist
+
+from dqs import plan as plans
+
+LOOKUP_SEP = '__'
+
+
+
+def is_multi_valued(model, path):
+    'Whether a lookup path goes through a many to many or reverse relation'
+    current = model
+    for part in path.split(LOOKUP_SEP):
+        try:
+            field = current._meta.get_field(part)
+        except FieldDoesNotExist:
+            return False
+        if field.many_to_many or field.one_to_many:
+            return True
+        if not field.is_relation or field.related_model is None:
+            return False
+        current = field.related_model
+    return False
+
+
+
+def can_merge(model, first, second):
+    '''
+    Whether two steps are filter() calls with keyword arguments only,
+    different keys, and no multi-valued lookups, and either both or
+    none of them have placeholders.
+    '''
+    if (first.call is None) != (second.call is None):
+        'keep the steps without placeholders apart, so they can be applied once'
+        return False
+    for step in (first, second):
+        if step.name != 'filter' or step.args or step.key_slots:
+            return False
+        if any(is_multi_valued(model, key) for key in step.keys):
+            return False
+    return not set(first.keys) & set(second.keys)
+
+
+
+def merge(first, second):
+    offset = len(first.keys)
+    kwargs = tuple(zip(first.keys, first.values)) + tuple(
+        zip(second.keys, second.values))
+    slots = tuple([('value', position, placeholder)
+            for position, placeholder in first.value_slots]
+        + [('value', position + offset, placeholder)
+            for position, placeholder in second.value_slots])
+    return plans.Step(plans.Operation('filter', (), kwargs, slots))
+
+
+
+def optimize(plan, model):
+    'Return an optimized copy of the plan, for querysets of `model`'
+    
+    steps = [step for step in plan.steps if step.name != 'all']
+    
+    last_order_by = max([index for index, step in enumerate(steps)
+        if step.name == 'order_by'] or [-1])
+    steps = [step for index, step in enumerate(steps)
+        if step.name != 'order_by' or index == last_order_by]
+    
+    merged = []
+    for step in steps:
+        if merged and can_merge(model, merged[-1], step):
+            merged[-1] = merge(merged[-1], step)
+        else:
+            merged.append(step)
+    
+    return plans.ExecutionPlan.from_steps(plan.placeholders, merged,
+        plan.converters, plan.defaults)
+
+
+
+def placeholder_free_prefix(plan):
+    'How many steps at the start of the plan have no placeholders'
+    for index, step in enumerate(plan.steps):
+        if step.call is None:
+            return index
+    return len(plan.steps)
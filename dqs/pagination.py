@@ -0,0 +1,189 @@
+'''
+Keyset (seek) pagination for registered serializations.
+
+Instead of skipping rows with OFFSET, every page after the first one
+is filtered to the rows that sort after the last row of the previous
+page. The ordering is the chain's last order_by(), with the primary
+key added as a tie-breaker so that it is total. NULLs are sorted
+last in ascending order and first in descending order on every
+backend, so they can be sought past too.
+
+The continuation token is the sort keys of the last row, as JSON in
+URL-safe base64. Values JSON doesn't have are tagged like dqs.dumping
+does it, so datetimes keep their microseconds and come back as
+datetimes, decimals as decimals, and so on.
+
+'''
+
+import base64
+import datetime
+import decimal
+import json
+import uuid
+
+from django.db.models import F, Q
+from django.db.models.query import FlatValuesListIterable, ValuesListIterable
+
+from dqs import dumping
+
+KEY = '_dqs_seek_%d'
+
+'Types of the sort keys a token may hold'
+KEY_TYPES = (type(None), bool, int, float, str, datetime.date,
+    datetime.time, datetime.timedelta, decimal.Decimal, uuid.UUID)
+
+
+
+def keyset_ordering(plan, model):
+    '''
+    The (path, descending) pairs the chain is ordered by, ending with
+    the primary key. None if the chain has no deterministic ordering:
+    no order_by(), random ordering, expressions, or placeholders in
+    the ordering.
+    '''
+    
+    ordering = None
+    reverse = False
+    for step in plan.steps:
+        if step.name == 'order_by':
+            if step.arg_slots:
+                return None
+            ordering = step.args
+            reverse = False
+        elif step.name == 'reverse':
+            reverse = not reverse
+    
+    if not ordering:
+        return None
+    
+    pairs = []
+    for name in ordering:
+        if not isinstance(name, str) or name == '?':
+            return None
+        descending = name.startswith('-')
+        pairs.append((name.lstrip('-'), descending != reverse))
+    
+    if not any(path in ('pk', model._meta.pk.name) for path, d in pairs):
+        pairs.append(('pk', reverse))
+    
+    return pairs
+
+
+
+def encode_token(values):
+    data = json.dumps(dumping.encode(list(values)), separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+
+def decode_token(token, ordering):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(
+            token.encode('ascii')).decode('utf-8'),
+            object_hook=dumping.decode_tagged)
+    except (ValueError, TypeError, UnicodeError, LookupError,
+            ArithmeticError):
+        raise ValueError('Invalid continuation token')
+    if (not isinstance(values, list) or len(values) != len(ordering)
+            or not all(isinstance(value, KEY_TYPES) for value in values)):
+        raise ValueError('Invalid continuation token')
+    return values
+
+
+
+def seek(ordering, values):
+    '''
+    Build the predicate matching the rows which sort after `values`.
+    Descending keys put NULLs first, ascending ones put them last.
+    '''
+    
+    predicate = Q(pk__in=[])
+    equal = Q()
+    for (path, descending), value in zip(ordering, values):
+        if value is None:
+            after = (Q(**{path + '__isnull':False}) if descending
+                else Q(pk__in=[]))
+            same = Q(**{path + '__isnull':True})
+        elif descending:
+            after = Q(**{path + '__lt':value})
+            same = Q(**{path:value})
+        else:
+            after = (Q(**{path + '__gt':value})
+                | Q(**{path + '__isnull':True}))
+            same = Q(**{path:value})
+        predicate |= equal & after
+        equal &= same
+    return predicate
+
+
+
+def order(queryset, ordering):
+    '''
+    Order a queryset by `ordering` explicitly. Descending keys put
+    NULLs first, ascending ones put them last.
+    '''
+    if not queryset.query.standard_ordering:
+        'the ordering already takes reverse() into account'
+        queryset = queryset.reverse()
+    return queryset.order_by(*[
+        F(path).desc(nulls_first=True) if descending
+            else F(path).asc(nulls_last=True)
+        for path, descending in ordering])
+
+
+
+def annotate_keys(queryset, ordering):
+    '''
+    Annotate the values of the ordering keys on the rows. Returns the
+    queryset, and whether it was a flat values_list(), which
+    split_keys() needs to know.
+    '''
+    keys = dict((KEY % index, F(path))
+        for index, (path, descending) in enumerate(ordering))
+    
+    flat = queryset._iterable_class is FlatValuesListIterable
+    queryset = queryset.annotate(**keys)
+    if flat:
+        queryset._iterable_class = ValuesListIterable
+    return queryset, flat
+
+
+
+def split_keys(row, count, flat):
+    '''
+    Take the `count` ordering keys annotated by annotate_keys() off a
+    row. Returns the row and the list of key values.
+    '''
+    if isinstance(row, dict):
+        return row, [row.pop(KEY % index) for index in range(count)]
+    if isinstance(row, tuple):
+        return (row[0] if flat else row[:-count]), list(row[-count:])
+    values = [getattr(row, KEY % index) for index in range(count)]
+    for index in range(count):
+        delattr(row, KEY % index)
+    return row, values
+
+
+
+def get_page(queryset, ordering, after=None, size=20):
+    '''
+    Get a page of `queryset`, ordered by `ordering`, and a token for
+    the next page, or None if this is the last one.
+    '''
+    
+    if after is not None:
+        queryset = queryset.filter(seek(ordering, decode_token(after,
+            ordering)))
+    
+    queryset, flat = annotate_keys(order(queryset, ordering), ordering)
+    
+    rows = list(queryset[:size + 1])
+    more = len(rows) > size
+    
+    results = []
+    last = None
+    for row in rows[:size]:
+        row, last = split_keys(row, len(ordering), flat)
+        results.append(row)
+    
+    return results, (encode_token(last) if more else None)
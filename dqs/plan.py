@@ -0,0 +1,190 @@
+import operator
+
+from dqs import converters, lists, utils
+
+
+
+class Operation(object):
+    '''
+    What a Step is built from, when it doesn't come from a FilterChain
+    node. `kwargs` is a tuple of (key, value) pairs, and `slots` a tuple
+    of (kind, position, placeholder).
+    '''
+    
+    def __init__(self, name, args, kwargs, slots):
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+        self.slots = slots
+
+
+
+class Step(object):
+    '''
+    One queryset method call of an ExecutionPlan.
+    
+    The arguments are kept as templates, and the placeholder slots
+    are known by position, so applying the step only has to copy the
+    templates and fill in the slots. Steps without placeholders are
+    bound once to a methodcaller, unless bind() filled in a list
+    parameter, which has to be rewritten for the database every time
+    (see dqs.lists).
+    
+    '''
+    
+    __slots__ = ['name', 'args', 'keys', 'values', 'arg_slots',
+        'key_slots', 'value_slots', 'call']
+    
+    def __init__(self, operation):
+        self.name = operation.name
+        self.args = operation.args
+        self.keys = tuple([key for key, val in operation.kwargs])
+        self.values = tuple([val for key, val in operation.kwargs])
+        
+        slots = {'arg':[], 'key':[], 'value':[]}
+        for kind, position, placeholder in operation.slots:
+            slots[kind].append((position, placeholder))
+        self.arg_slots = tuple(slots['arg'])
+        self.key_slots = tuple(slots['key'])
+        self.value_slots = tuple(slots['value'])
+        
+        if operation.slots or (self.name in lists.REWRITTEN_METHODS and any(
+                isinstance(value, lists.ListParameter)
+                for value in self.values)):
+            self.call = None
+        else:
+            self.call = operator.methodcaller(self.name, *self.args,
+                **dict(operation.kwargs))
+    
+    def apply(self, queryset, parameters):
+        if self.call is not None:
+            return self.call(queryset)
+        
+        args, kwargs = self.arguments(parameters)
+        if self.name in lists.REWRITTEN_METHODS:
+            args, kwargs = lists.rewrite(queryset, args, kwargs)
+        method = getattr(queryset, self.name)
+        return method(*args, **kwargs)
+    
+    def arguments(self, parameters):
+        'The positional and keyword arguments, with the slots filled'
+        args = list(self.args)
+        for position, placeholder in self.arg_slots:
+            args[position] = parameters[placeholder]
+        
+        keys = self.keys
+        if self.key_slots:
+            keys = list(keys)
+            for position, placeholder in self.key_slots:
+                keys[position] = parameters[placeholder]
+        
+        values = self.values
+        if self.value_slots:
+            values = list(values)
+            for position, placeholder in self.value_slots:
+                values[position] = parameters[placeholder]
+        
+        return args, dict(zip(keys, values))
+    
+    def specialize(self, parameters):
+        '''
+        A copy of this step with the slots of the placeholders in
+        `parameters` filled in, and the other slots left as they are.
+        '''
+        args, keys, values = list(self.args), list(self.keys), list(self.values)
+        slots = []
+        for kind, kind_slots, target in (('arg', self.arg_slots, args),
+                ('key', self.key_slots, keys),
+                ('value', self.value_slots, values)):
+            for position, placeholder in kind_slots:
+                if placeholder in parameters:
+                    target[position] = parameters[placeholder]
+                else:
+                    slots.append((kind, position, placeholder))
+        
+        return Step(Operation(self.name, tuple(args),
+            tuple(zip(keys, values)), tuple(slots)))
+
+
+
+class ExecutionPlan(object):
+    '''
+    A compiled FilterChain. Created by FilterChain.compile(), and
+    kept by Serialization objects when they are registered.
+    
+    `converters` maps typed placeholders to their converters, and
+    `defaults` gives values to placeholders which can be left out.
+    '''
+    
+    __slots__ = ['placeholders', 'steps', 'converters', 'defaults']
+    
+    def __init__(self, operations):
+        self.placeholders = (operations[-1].placeholders
+            if operations else ())
+        self.steps = tuple([Step(operation) for operation in operations])
+        self.converters = dict((placeholder, converters.get_converter(type))
+            for operation in operations
+            for placeholder, type in operation.types)
+        self.defaults = {}
+    
+    @classmethod
+    def from_steps(cls, placeholders, steps, converters=None, defaults=None):
+        plan = cls([])
+        plan.placeholders = tuple(placeholders)
+        plan.steps = tuple(steps)
+        plan.converters = converters or {}
+        plan.defaults = defaults or {}
+        return plan
+    
+    def specialize(self, parameters):
+        '''
+        A plan with the placeholders in `parameters` filled in. Its
+        placeholders are the remaining ones.
+        '''
+        return ExecutionPlan.from_steps(
+            [placeholder for placeholder in self.placeholders
+                if placeholder not in parameters],
+            [step.specialize(parameters) if step.call is None else step
+                for step in self.steps],
+            self.converters, self.defaults)
+    
+    def bind(self, parameters):
+        '''
+        Unescape the parameter names, fill in the defaults, make sure
+        every placeholder has a value and convert the values of typed
+        placeholders.
+        '''
+        parameters = utils.unescape_parameters(parameters)
+        if self.defaults:
+            parameters = dict(self.defaults, **parameters)
+        
+        missing_params = [placeholder for placeholder in self.placeholders
+            if placeholder not in parameters]
+        
+        if missing_params:
+            raise Exception('Parameters are missing: %s' % ', '.join(
+                missing_params))
+        
+        return self.convert(parameters)
+    
+    def convert(self, parameters):
+        'Convert the values given for typed placeholders'
+        if not self.converters:
+            return parameters
+        return converters.convert(self.converters, parameters)
+    
+    def execute(self, base_queryset, parameters):
+        return self.replay(base_queryset, self.bind(parameters))
+    
+    def replay(self, base_queryset, parameters, skip=(), start=0):
+        '''
+        Apply the steps to the base queryset, with bound parameters,
+        leaving out the steps whose method is in `skip`, and the steps
+        before `start`.
+        '''
+        queryset = base_queryset
+        for step in self.steps[start:]:
+            if step.name not in skip:
+                queryset = step.apply(queryset, parameters)
+        
+        return queryset
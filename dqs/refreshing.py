@@ -0,0 +1,143 @@
+'''
+Stale-while-revalidate refreshing of hot serializations.
+
+A Refresher keeps the last results of the (serialization, parameters)
+pairs it sees, and hands them out right away:
+ 
+ - results younger than `refresh_after` seconds are fresh.
+ - older results are still handed out, up to `max_stale` seconds old,
+ but they are evaluated again in the background.
+ - older ones are evaluated again while the request waits.
+
+Pairs asked for with get_queryset() or from_url() at least `hot_hits`
+times are loaded in the background too, so the querysets come back
+already evaluated. Pass a refresher to register():
+    
+    refresher = Refresher(refresh_after=5, max_stale=60)
+    dqs.register('front-page', serializer, Article.objects.all(),
+        refresher=refresher)
+
+Refreshes run in a pool of `max_workers` threads, shared by the
+serializations using the refresher, and at most `concurrency` of them
+run at once for the same serialization. Up to `max_entries` pairs are
+kept, dropping the least recently used first.
+
+'''
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections
+
+from dqs import caching, utils
+
+
+
+class Entry(object):
+    __slots__ = ['results', 'computed', 'hits', 'refreshing']
+    
+    def __init__(self):
+        self.results = caching.MISSING
+        self.computed = 0
+        self.hits = 0
+        self.refreshing = False
+
+
+
+class Refresher(object):
+    def __init__(self, refresh_after=10, max_stale=60, max_entries=1000,
+            max_workers=4, concurrency=1, hot_hits=2):
+        self.refresh_after = refresh_after
+        self.max_stale = max_stale
+        self.max_entries = max_entries
+        self.max_workers = max_workers
+        self.concurrency = concurrency
+        self.hot_hits = hot_hits
+        self.entries = OrderedDict()
+        self.running = {}
+        self.lock = threading.Lock()
+        self.executor = None
+    
+    def get(self, serialization, parameters, load=False):
+        '''
+        Get the last results for bound parameters, or MISSING if there
+        are none, or they are too stale. Refreshes them in the
+        background when they are stale, and with `load`, loads them in
+        the background when the pair is hot.
+        '''
+        
+        key = (serialization.cache_name, utils.parameters_key(parameters))
+        
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = Entry()
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            else:
+                self.entries.move_to_end(key)
+            entry.hits += 1
+            
+            age = time.time() - entry.computed
+            if entry.results is not caching.MISSING:
+                if age < self.refresh_after:
+                    return entry.results
+                if age < self.max_stale:
+                    self.schedule(serialization, parameters, entry)
+                    return entry.results
+            
+            if load and entry.hits >= self.hot_hits:
+                self.schedule(serialization, parameters, entry)
+            return caching.MISSING
+    
+    def set(self, serialization, parameters, results):
+        key = (serialization.cache_name, utils.parameters_key(parameters))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry.results = results
+                entry.computed = time.time()
+    
+    def expire(self, name):
+        'Make the results of the serialization called `name` too stale to use'
+        with self.lock:
+            for key, entry in self.entries.items():
+                if key[0] == name:
+                    entry.computed = 0
+    
+    def schedule(self, serialization, parameters, entry):
+        'Refresh an entry in the pool, if allowed. Called with the lock held'
+        
+        name = serialization.cache_name
+        if entry.refreshing or self.running.get(name, 0) >= self.concurrency:
+            return
+        entry.refreshing = True
+        self.running[name] = self.running.get(name, 0) + 1
+        
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                thread_name_prefix='dqs-refresher')
+        self.executor.submit(self.refresh, serialization, parameters, entry)
+    
+    def refresh(self, serialization, parameters, entry):
+        results = caching.MISSING
+        cache = serialization.result_cache
+        try:
+            generation = (cache.generation(serialization.cache_name)
+                if cache is not None else None)
+            results = serialization._fetch(parameters)
+            if cache is not None:
+                cache.set(serialization.cache_name, parameters, results,
+                    generation)
+        except Exception:
+            'keep handing out the last results. the next request retries'
+        finally:
+            close_old_connections()
+            with self.lock:
+                if results is not caching.MISSING:
+                    entry.results = results
+                    entry.computed = time.time()
+                entry.refreshing = False
+                self.running[serialization.cache_name] -= 1
@@ -0,0 +1,76 @@
+'''
+The route table of DjangoQuerysetSerialization.from_url().
+
+Registered names may contain slashes, like 'people/search'. They are
+indexed by segment, so resolving a URL walks the index one segment at
+a time and stops at the first segment no name starts with. URLs for
+unknown names are rejected without looking at their parameters.
+
+'''
+
+
+
+class RouteTable(object):
+    '''
+    An index of names by their slash separated segments. Every node
+    is a dict of its child nodes by segment, and the name ending there
+    under the None key.
+    '''
+    
+    def __init__(self):
+        self.root = {}
+    
+    def add(self, name):
+        node = self.root
+        for segment in name.strip('/').split('/'):
+            node = node.setdefault(segment, {})
+        node[None] = name
+    
+    def remove(self, name):
+        path = [self.root]
+        for segment in name.strip('/').split('/'):
+            node = path[-1].get(segment)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].pop(None, None)
+        
+        'prune the nodes left empty'
+        segments = name.strip('/').split('/')
+        for node, segment in reversed(list(zip(path[:-1], segments))):
+            if node[segment]:
+                break
+            del node[segment]
+    
+    def resolve(self, url):
+        '''
+        Find the names the URL can start with, and return them as
+        (name, parameter segments) pairs, longest name first. Raises
+        ValueError for URLs with empty segments.
+        '''
+        
+        url = url.strip().strip('/')
+        matches = []
+        node = self.root
+        start = 0
+        length = len(url)
+        
+        while start <= length:
+            end = url.find('/', start)
+            if end == -1:
+                end = length
+            node = node.get(url[start:end])
+            if node is None:
+                break
+            if None in node:
+                matches.append((node[None], end + 1))
+            start = end + 1
+        
+        resolved = []
+        for name, start in reversed(matches):
+            rest = url[start:]
+            segments = rest.split('/') if rest else []
+            if '' in segments:
+                raise ValueError('Malformed URL: %s' % url)
+            resolved.append((name, segments))
+        return resolved
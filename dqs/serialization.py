@@ -1,13 +1,244 @@
-import copy
+import asyncio
+import hashlib
+import threading
+import time
+from collections import OrderedDict
 
-from dqs import utils
+from asgiref.sync import sync_to_async
+from django.db import connections
+from django.utils.module_loading import import_string
+
+from dqs import (batching, caching, changes, coalescing, converters,
+    counting, databases, dumping, exporting, instrumentation, interning,
+    lists, optimizer, pagination, plan, routes, snapshots, sqlcache,
+    streaming, templating, utils)
+
+'guards what serializations only make once it is needed, shared by all'
+lazy_lock = threading.Lock()
 
 
 
 class Serialization():
-    def __init__(self, serializer, base_queryset):
+    '''
+    A serializer registered against a base queryset.
+    
+    Options:
+     - query_template: build the query once, with sentinels in place
+    of the parameters, and substitute the values into a clone of it
+    on every call. See dqs.templating.
+     - sql_cache: also cache the compiled SQL of the query template,
+    and run it directly in fetch(). See dqs.sqlcache.
+     - cache: a dqs.caching.ResultCache keeping the results of fetch().
+     - count_ttl: how long count(mode='cached') keeps counts, in
+    seconds.
+     - keyset: make sure the chain can be paginated with get_page(),
+    raising ValueError when it is registered otherwise.
+     - max_specializations: how many serializations made by bind()
+    are kept for reuse.
+     - defaults: values for placeholders which can be left out. In
+    URLs, the trailing segments of placeholders with defaults are
+    optional.
+     - routing: a dqs.databases.RoutingPolicy choosing the database
+    of every query, for read replicas and shards.
+     - refresher: a dqs.refreshing.Refresher, handing out the last
+    results of hot parameters right away while it refreshes them in
+    the background.
+     - snapshots: a dqs.snapshots.SnapshotStore. get_queryset() then
+    returns a SnapshotList, from a snapshot of the matching primary
+    keys.
+     - coalesce: a dqs.coalescing.SingleFlight. Identical concurrent
+    fetches then share the results of one query.
+     - updated_field: a field holding when rows were last changed,
+    used by change_token().
+     - versions: a dqs.changes.ModelVersions. change_token() then uses
+    its version counters instead of querying. See dqs.changes.
+    
+    The serializer and the base queryset can also be given lazily, as
+    dotted paths or zero argument factories. They are resolved when
+    the serialization is compiled. A dotted path to a model or manager
+    stands for its all().
+    
+    '''
+    
+    def __init__(self, serializer, base_queryset, name=None,
+            query_template=False, sql_cache=False, cache=None,
+            count_ttl=60, keyset=False, max_specializations=100,
+            defaults=None, routing=None, refresher=None, snapshots=None,
+            coalesce=None, updated_field=None, versions=None):
         self.base_queryset = base_queryset
         self.serializer = serializer
+        self.name = name
+        self.parent_name = None
+        self.plan = None
+        self.source_plan = None
+        self.prepared_queryset = None
+        self.prepared_steps = 0
+        self.use_query_template = query_template or sql_cache
+        self.query_template = None
+        self.use_sql_cache = sql_cache
+        self.sql_cache = None
+        self.result_cache = cache
+        self.count_ttl = count_ttl
+        self._count_cache = None
+        self.keyset = keyset
+        self.keyset_ordering = None
+        self.touched_models = None
+        self.max_specializations = max_specializations
+        self.specializations = None
+        self.defaults = utils.unescape_parameters(defaults)
+        self.routing = routing
+        self.refresher = refresher
+        self.snapshots = snapshots
+        self.coalesce = coalesce
+        self.updated_field = updated_field
+        self.versions = versions
+    
+    cache_name = property(lambda s:s.name or 'dqs-%d' % id(s))
+    
+    '''
+    statistics of serializations made by bind() go to their parent, and
+    those of unnamed ones are counted together
+    '''
+    stats_name = property(lambda s:s.parent_name or s.name
+        or instrumentation.UNNAMED)
+    
+    @property
+    def count_cache(self):
+        'The cache of count(mode=\'cached\'), made when first used'
+        if self._count_cache is None:
+            with lazy_lock:
+                if self._count_cache is None:
+                    self._count_cache = caching.LocMemResultCache(
+                        ttl=self.count_ttl)
+        return self._count_cache
+    
+    def compile(self):
+        '''
+        Precompute the execution plan of the serializer, optimize it
+        (see dqs.optimizer) and apply the steps before the first
+        placeholder to the base queryset. This is done by
+        DjangoQuerysetSerialization.register(), and otherwise on the
+        first call to get_queryset.
+        
+        If it raises, the serialization is left uncompiled.
+        '''
+        serializer = resolve_serializer(self.serializer)
+        base_queryset = resolve_queryset(self.base_queryset)
+        source_plan = serializer.compile()
+        if self.defaults:
+            source_plan = plan.ExecutionPlan.from_steps(
+                source_plan.placeholders, source_plan.steps,
+                source_plan.converters, self.defaults)
+        
+        self.serializer = serializer
+        self.base_queryset = base_queryset
+        self.source_plan = source_plan
+        self.prepare(optimizer.optimize(source_plan, base_queryset.model))
+        return self.plan
+    
+    def prepare(self, plan):
+        '''
+        Set up everything that depends on the plan, and then make it
+        this serialization's plan. Nothing is changed if it raises, so
+        a plan is only ever seen fully prepared.
+        '''
+        
+        'apply the steps without placeholders once, here'
+        prepared_steps = optimizer.placeholder_free_prefix(plan)
+        prepared_queryset = self.base_queryset
+        for step in plan.steps[:prepared_steps]:
+            prepared_queryset = step.call(prepared_queryset)
+        
+        keyset_ordering = pagination.keyset_ordering(plan,
+            self.base_queryset.model)
+        if self.keyset and keyset_ordering is None:
+            raise ValueError('Keyset pagination needs a chain ending with a '
+                + 'deterministic order_by()')
+        if self.snapshots is not None:
+            snapshots.check_plan(plan)
+        query_template = sql_cache = None
+        if self.use_query_template:
+            query_template = templating.QueryTemplate.build(plan,
+                self.base_queryset)
+        if (self.use_sql_cache and query_template is not None
+                and sqlcache.is_cacheable(plan, self.base_queryset)):
+            sql_cache = sqlcache.SQLCache(query_template)
+        
+        self.prepared_steps = prepared_steps
+        self.prepared_queryset = prepared_queryset
+        self.keyset_ordering = keyset_ordering
+        self.query_template = query_template
+        self.sql_cache = sql_cache
+        self.touched_models = caching.touched_models(plan,
+            self.base_queryset.model, self.base_queryset)
+        if (self.result_cache is not None or self.refresher is not None
+                or self.snapshots is not None or self.coalesce is not None):
+            caching.connect_invalidation(self, self.touched_models)
+        if self.versions is not None:
+            self.versions.connect(self.touched_models)
+        self.plan = plan
+    
+    placeholders = property(lambda s:list((s.plan or s.compile()).placeholders))
+    
+    def options(self):
+        'The options of this serialization, except for the result cache'
+        return {
+            'query_template':self.use_query_template,
+            'sql_cache':self.use_sql_cache,
+            'count_ttl':self.count_ttl,
+            'keyset':self.keyset,
+            'max_specializations':self.max_specializations,
+            'defaults':self.defaults,
+            'updated_field':self.updated_field,
+        }
+    
+    def bind(self, parameters):
+        '''
+        Get a Serialization with some of the placeholders filled in.
+        Its placeholders are the remaining ones, and the steps which
+        don't need them anymore are applied once to its base queryset.
+        
+        Specializations are kept for reuse, keyed by the bound values,
+        up to max_specializations of them.
+        '''
+        
+        plan = self.plan or self.compile()
+        parameters = utils.unescape_parameters(parameters)
+        parameters = plan.convert(dict((placeholder, parameters[placeholder])
+            for placeholder in plan.placeholders if placeholder in parameters))
+        key = utils.parameters_key(parameters)
+        
+        with lazy_lock:
+            specialization = (self.specializations or {}).get(key)
+            if specialization is not None:
+                self.specializations.move_to_end(key)
+                return specialization
+        
+        specialization = Serialization(self.serializer, self.base_queryset,
+            name='%s:%s' % (self.cache_name, hashlib.sha1(repr(key)
+                .encode('utf-8')).hexdigest()[:16]),
+            query_template=self.use_query_template,
+            sql_cache=self.use_sql_cache, cache=self.result_cache,
+            keyset=self.keyset, max_specializations=self.max_specializations,
+            defaults=self.defaults, routing=self.routing,
+            refresher=self.refresher, snapshots=self.snapshots,
+            coalesce=self.coalesce, updated_field=self.updated_field,
+            versions=self.versions)
+        specialization._count_cache = self.count_cache
+        specialization.parent_name = self.stats_name
+        specialization.source_plan = self.source_plan.specialize(parameters)
+        specialization.prepare(optimizer.optimize(
+            specialization.source_plan, self.base_queryset.model))
+        
+        with lazy_lock:
+            if self.specializations is None:
+                self.specializations = OrderedDict()
+            specialization = self.specializations.setdefault(key,
+                specialization)
+            self.specializations.move_to_end(key)
+            while len(self.specializations) > self.max_specializations:
+                self.specializations.popitem(last=False)
+        return specialization
     
     def get_queryset(self, parameters={}):
         '''
@@ -21,14 +252,438 @@ class Serialization():
         
         '''
         
-        return self.serializer.get_queryset(self.base_queryset,
-            parameters)
+        plan = self.plan or self.compile()
+        if self.snapshots is not None:
+            parameters = plan.bind(parameters)
+            return snapshots.SnapshotList(self, parameters,
+                self.snapshots.get(self, parameters))
+        if self.refresher is not None:
+            return self._refreshed_queryset(plan.bind(parameters))
+        
+        instruments = instrumentation.instruments
+        if not instruments.enabled:
+            return self._build_queryset(plan.bind(parameters))
+        
+        with instruments.measure(self.stats_name) as event:
+            start = instrumentation.timer()
+            queryset = self._build_queryset(plan.bind(parameters))
+            event['replay_time'] = instrumentation.timer() - start
+        return queryset
+    
+    def _refreshed_queryset(self, parameters):
+        '''
+        get_queryset with a refresher. When it has results for these
+        parameters, the queryset is given them as its result cache,
+        and is already evaluated.
+        '''
+        queryset = self._build_queryset(parameters)
+        results = self.refresher.get(self, parameters, load=True)
+        if results is not caching.MISSING:
+            queryset._result_cache = list(results)
+            queryset._prefetch_done = True
+        return queryset
+    
+    def _build_queryset(self, parameters, alias=None):
+        '''
+        get_queryset, given bound parameters. The queryset uses the
+        database `alias`, or the one the routing policy chooses.
+        '''
+        if alias is None and self.routing is not None:
+            alias = self._choose_database(parameters)
+        
+        queryset = None
+        if self.query_template is not None:
+            queryset = self.query_template.execute(parameters)
+        
+        if queryset is None:
+            queryset = self.plan.replay(self.prepared_queryset, parameters,
+                start=self.prepared_steps)
+            if queryset is self.prepared_queryset:
+                'never hand out the prepared queryset, or its result cache'
+                queryset = queryset.all()
+        
+        if alias is not None:
+            queryset = queryset.using(alias)
+        return queryset
+    
+    def _choose_database(self, parameters):
+        alias = self.routing.choose(parameters)
+        if alias is None:
+            raise ValueError('No database was chosen for these '
+                + 'parameters. Only fetch() and count() can run on '
+                + 'every shard')
+        return alias
+    
+    def fetch(self, parameters={}):
+        '''
+        Evaluate the queryset for these parameters, and return the
+        results as a list of model instances, or of values() rows.
+        
+        With the sql_cache option, the cached SQL is run directly when
+        possible. With the cache option, the results are kept in the
+        result cache.
+        '''
+        
+        plan = self.plan or self.compile()
+        parameters = plan.bind(parameters)
+        return self._measured(lambda:self._fetch_through_cache(parameters),
+            len)
+    
+    def _measured(self, call, rows=None):
+        '''
+        Return call(), counting and timing its queries when
+        dqs.instrumentation is enabled. `rows(results)` is how many
+        rows the call returned.
+        '''
+        instruments = instrumentation.instruments
+        if not instruments.enabled:
+            return call()
+        
+        with instruments.measure(self.stats_name, queries=True) as event:
+            results = call()
+            if rows is not None:
+                event['rows'] = rows(results)
+        return results
+    
+    def _fetch_through_cache(self, parameters):
+        'fetch, given bound parameters'
+        if self.refresher is not None:
+            results = self.refresher.get(self, parameters)
+            if results is not caching.MISSING:
+                return results
+        
+        if self.result_cache is None:
+            results = self._fetch_once(parameters)
+        else:
+            generation = self.result_cache.generation(self.cache_name)
+            results = self.result_cache.get(self.cache_name, parameters,
+                generation)
+            if results is caching.MISSING:
+                results = self._fetch_once(parameters)
+                self.result_cache.set(self.cache_name, parameters, results,
+                    generation)
+        
+        if self.refresher is not None:
+            self.refresher.set(self, parameters, results)
+        return results
+    
+    def _fetch_once(self, parameters):
+        'fetch, sharing the results of identical concurrent fetches'
+        if self.coalesce is None:
+            return self._fetch(parameters)
+        return self.coalesce.fetch(self, parameters, self._fetch)
+    
+    def _fetch(self, parameters):
+        'fetch, given bound parameters, without the result cache'
+        if self.snapshots is not None:
+            return list(snapshots.SnapshotList(self, parameters,
+                self.snapshots.get(self, parameters)))
+        if self.routing is not None:
+            return self._fetch_routed(parameters)
+        
+        chunked = lists.chunked(self.plan, parameters,
+            connections[self.base_queryset.db])
+        if chunked is not None:
+            return lists.fetch_chunked(self, parameters, *chunked)
+        
+        if self.sql_cache is not None:
+            results = self.sql_cache.fetch(parameters)
+            if results is not None:
+                return results
+        
+        return list(self._build_queryset(parameters))
+    
+    def _fetch_routed(self, parameters):
+        alias = self.routing.choose(parameters)
+        if alias is None:
+            return databases.fan_out(self, parameters,
+                self.routing.fan_out(parameters))
+        
+        def fetch():
+            if self.sql_cache is not None:
+                results = self.sql_cache.fetch(parameters, alias)
+                if results is not None:
+                    return results
+            return list(self._build_queryset(parameters, alias))
+        
+        return databases.timed(self.routing, alias, fetch)
+    
+    def get_querysets_many(self, parameter_sets):
+        '''
+        Evaluate the serialization for many parameter dicts, in as few
+        queries as possible. Returns a list of results, one per
+        parameter dict, like fetch() would return them.
+        
+        See dqs.batching for the chains which can be coalesced into a
+        single query.
+        '''
+        self.plan or self.compile()
+        return self._measured(lambda:batching.get_many(self,
+                list(parameter_sets)),
+            lambda results:sum(len(result) for result in results))
+    
+    def count_many(self, parameter_sets):
+        '''
+        Count the rows for many parameter dicts, in as few queries as
+        possible. Returns a list of counts.
+        '''
+        self.plan or self.compile()
+        return self._measured(lambda:batching.count_many(self,
+            list(parameter_sets)))
+    
+    def invalidate_cache(self, sender=None, **kwargs):
+        '''
+        Forget the cached results, and the refresher's. Connected to
+        the model signals of the models the serializer touches.
+        '''
+        if self.coalesce is not None:
+            self.coalesce.forget(self.cache_name)
+        if self.result_cache is not None:
+            self.result_cache.invalidate(self.cache_name)
+        if self.refresher is not None:
+            self.refresher.expire(self.cache_name)
+        if self.snapshots is not None:
+            self.snapshots.drop(self.cache_name)
+    
+    def refresh_snapshot(self, parameters={}):
+        'Build the snapshot for these parameters again'
+        plan = self.plan or self.compile()
+        self.snapshots.build(self, plan.bind(parameters))
+    
+    def refresh_snapshots(self):
+        'Build every saved snapshot of this serialization again'
+        self.plan or self.compile()
+        for parameters in self.snapshots.saved_parameters(self.cache_name):
+            self.snapshots.build(self, parameters)
+    
+    def snapshot_usage(self):
+        '''
+        The snapshots of this serialization, as a list of dicts with
+        their parameters, number of keys, and size in bytes.
+        '''
+        return self.snapshots.usage(self.cache_name)
     
     def from_iterable_parameters(self, iterable):
-        parameters = utils.parameters_to_dict(
-            self.serializer._placeholders, iterable)
+        return self.get_queryset(self.parameters_from_components(iterable))
+    
+    def accepts(self, count):
+        'Whether this serialization can take `count` positional parameters'
+        placeholders = self.placeholders
+        required = len(placeholders)
+        while required and placeholders[required - 1] in self.defaults:
+            required -= 1
+        return required <= count <= len(placeholders)
+    
+    def parameters_from_components(self, components):
+        '''
+        Map positional parameters to the placeholders. Trailing
+        placeholders with defaults can be left out.
+        '''
+        components = list(components)
+        placeholders = self.placeholders
+        if len(components) < len(placeholders) and self.accepts(
+                len(components)):
+            placeholders = placeholders[:len(components)]
+        return utils.parameters_to_dict(placeholders, components)
+    
+    def stream(self, parameters={}, format='ndjson', chunk_size=2000):
+        '''
+        Iterate over the rows of a values() or values_list() chain, and
+        yield them as JSON chunks for a StreamingHttpResponse. `format`
+        is 'ndjson' or 'json'. See dqs.streaming.
+        
+        The rows are fetched while the chunks are iterated over, so
+        only the replay is measured by dqs.instrumentation.
+        '''
+        return streaming.stream_rows(self.get_queryset(parameters),
+            format=format, chunk_size=chunk_size)
+    
+    def export(self, parameters={}, format='json', batch_size=2000):
+        '''
+        Run a values() or values_list() chain and return its rows as
+        columnar JSON or CSV, without building a dict or tuple for
+        every row. `format` is 'json' or 'csv'. See dqs.exporting.
         
+        With the sql_cache option, the cached SQL is run directly when
+        possible.
+        '''
+        
+        plan = self.plan or self.compile()
+        parameters = plan.bind(parameters)
+        
+        if self.sql_cache is not None and self.routing is None:
+            compiled = self.sql_cache.compiled_query(parameters)
+            if compiled is not None and compiled.kind != sqlcache.MODELS:
+                params = compiled.bind(parameters)
+                if params is not None:
+                    return self._measured(lambda:exporting.export_compiled(
+                        compiled, params, format=format,
+                        batch_size=batch_size))
+        
+        return self._measured(lambda:exporting.export(self._build_queryset(
+            parameters), format=format, batch_size=batch_size))
+    
+    def get_page(self, parameters={}, after=None, size=20):
+        '''
+        Get a page of results using keyset pagination, and the token to
+        pass as `after` to get the next page. The token is None on the
+        last page. See dqs.pagination.
+        '''
+        plan = self.plan or self.compile()
+        if self.keyset_ordering is None:
+            raise ValueError('This serialization has no deterministic '
+                + 'ordering to paginate by')
+        return self._measured(lambda:pagination.get_page(
+                self._build_queryset(plan.bind(parameters)),
+                self.keyset_ordering, after=after, size=size),
+            lambda page:len(page[0]))
+    
+    def count(self, parameters={}, mode='exact'):
+        '''
+        Count the rows for these parameters. `mode` is one of:
+         - 'exact': count, leaving out order_by(), select_related() and
+        prefetch_related(). The ordering is kept when it is part of the
+        GROUP BY (see dqs.counting).
+         - 'cached': like 'exact', but the count is kept for count_ttl
+        seconds.
+         - 'estimated': return a dqs.counting.Estimate of the count,
+        from the database planner when it has one. Its `approximate`
+        flag is False when the count had to be exact.
+        
+        '''
+        
+        plan = self.plan or self.compile()
+        parameters = plan.bind(parameters)
+        return self._measured(lambda:self._count(parameters, mode))
+    
+    def _count(self, parameters, mode='exact'):
+        'count, given bound parameters'
+        plan = self.plan
+        if mode == 'cached':
+            generation = self.count_cache.generation(self.cache_name)
+            count = self.count_cache.get(self.cache_name, parameters,
+                generation)
+            if count is caching.MISSING:
+                count = self._count(parameters)
+                self.count_cache.set(self.cache_name, parameters, count,
+                    generation)
+            return count
+        
+        if mode not in ('exact', 'estimated'):
+            raise ValueError('Unknown count mode: %s' % mode)
+        
+        queryset = counting.count_queryset(plan, self.base_queryset,
+            parameters)
+        aliases = ()
+        if self.routing is not None:
+            alias = self.routing.choose(parameters)
+            if alias is None:
+                aliases = self.routing.fan_out(parameters)
+            else:
+                queryset = queryset.using(alias)
+        
+        if mode == 'estimated':
+            if aliases:
+                raise ValueError('Counts on every shard can\'t be estimated')
+            return counting.estimate(queryset)
+        
+        if aliases:
+            return databases.fan_out_count(self, queryset, aliases)
+        return counting.count_rows(queryset)
+    
+    def change_token(self, parameters={}):
+        '''
+        A dqs.changes.ChangeToken for these parameters, which changes
+        when the results may have changed. It is computed with one
+        aggregate query, or with none when the serialization has the
+        versions option. The results are never fetched.
+        
+        Raises ValueError unless the serialization has the versions or
+        the updated_field option, since the count and largest pk alone
+        don't change when rows are updated.
+        '''
+        
+        if self.versions is None and self.updated_field is None:
+            raise ValueError('Change tokens need the versions or the '
+                + 'updated_field option')
+        
+        plan = self.plan or self.compile()
+        parameters = plan.bind(parameters)
+        
+        if self.versions is not None:
+            return changes.make_token(self, parameters, self.versions.get(
+                self.touched_models))
+        
+        queryset = counting.count_queryset(plan, self.base_queryset,
+            parameters)
+        alias = None
+        if self.routing is not None:
+            alias = self.routing.choose(parameters)
+        if self.routing is not None and alias is None:
+            state = changes.combine_states(self.routing.map(
+                lambda alias:changes.aggregate_state(queryset.using(alias),
+                    self.updated_field),
+                self.routing.fan_out(parameters)))
+        else:
+            if alias is not None:
+                queryset = queryset.using(alias)
+            state = changes.aggregate_state(queryset, self.updated_field)
+        
+        return changes.make_token(self, parameters, state,
+            changes.timestamp(state[2]))
+    
+    def first(self, parameters={}):
+        return self.get_queryset(parameters).first()
+    
+    async def aget_queryset(self, parameters={}):
+        '''
+        Async get_queryset. Building the queryset doesn't touch the
+        database, but snapshots and refreshers may load results, and
+        then it runs in a worker thread.
+        '''
+        if self.snapshots is not None or self.refresher is not None:
+            return await sync_to_async(self.get_queryset)(parameters)
         return self.get_queryset(parameters)
+    
+    async def afetch(self, parameters={}):
+        'Async fetch, going through the SQL and result caches'
+        return await sync_to_async(self.fetch)(parameters)
+    
+    async def acount(self, parameters={}, mode='exact'):
+        return await sync_to_async(self.count)(parameters, mode)
+    
+    async def afirst(self, parameters={}):
+        return await sync_to_async(self.first)(parameters)
+
+
+
+def is_lazy(value):
+    'Whether a serializer or base queryset is given as a path or factory'
+    return isinstance(value, str) or callable(value)
+
+
+
+def resolve_serializer(serializer):
+    if isinstance(serializer, str):
+        serializer = import_string(serializer)
+    if callable(serializer):
+        serializer = serializer()
+    return serializer
+
+
+
+def resolve_queryset(queryset):
+    if isinstance(queryset, str):
+        queryset = import_string(queryset)
+    if hasattr(queryset, '_default_manager'):
+        'a model'
+        return queryset._default_manager.all()
+    if hasattr(queryset, 'get_queryset'):
+        'a manager'
+        return queryset.all()
+    if callable(queryset):
+        queryset = queryset()
+    return queryset
 
 
 
@@ -41,28 +696,235 @@ class DjangoQuerysetSerialization(dict):
     
     Internal description:
     Dictionary mapping serialization names to Serialization objects.
+    The names are also indexed in a dqs.routes.RouteTable, for
+    from_url, which every method adding or removing names keeps up to
+    date. Registered chains are interned by a dqs.interning.Interner.
     
     '''
     
+    def __init__(self, *args, **kwargs):
+        self.routes = routes.RouteTable()
+        self.interner = interning.Interner()
+        self.lock = threading.Lock()
+        super(DjangoQuerysetSerialization, self).__init__(*args, **kwargs)
+        for name in self:
+            self.routes.add(name)
+    
+    def __setitem__(self, name, serialization):
+        super(DjangoQuerysetSerialization, self).__setitem__(name,
+            serialization)
+        self.routes.add(name)
+    
+    def __getitem__(self, name):
+        '''
+        Get a serialization, compiling it first if it was registered
+        lazily.
+        '''
+        serialization = super(DjangoQuerysetSerialization,
+            self).__getitem__(name)
+        if serialization.plan is None:
+            with self.lock:
+                if serialization.plan is None:
+                    serialization.compile()
+        return serialization
+    
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+    
+    def __delitem__(self, name):
+        super(DjangoQuerysetSerialization, self).__delitem__(name)
+        self.routes.remove(name)
+    
+    def update(self, *args, **kwargs):
+        for name, serialization in dict(*args, **kwargs).items():
+            self[name] = serialization
+    
+    def __ior__(self, other):
+        self.update(other)
+        return self
+    
+    def setdefault(self, name, serialization=None):
+        if name not in self:
+            self[name] = serialization
+        return self[name]
+    
+    def pop(self, name, *default):
+        if name not in self:
+            return super(DjangoQuerysetSerialization, self).pop(name,
+                *default)
+        serialization = super(DjangoQuerysetSerialization, self).pop(name)
+        self.routes.remove(name)
+        return serialization
+    
+    def popitem(self):
+        name, serialization = super(DjangoQuerysetSerialization,
+            self).popitem()
+        self.routes.remove(name)
+        return name, serialization
+    
+    def clear(self):
+        super(DjangoQuerysetSerialization, self).clear()
+        self.routes = routes.RouteTable()
+    
     def make_serializer(self):
         return FilterChain()
     
-    def instant(self, serializer, queryset):
-        return Serialization(serializer, queryset)
+    def instant(self, serializer, queryset, **options):
+        return Serialization(serializer, queryset, **options)
     
-    def register(self, name, serializer, queryset):
+    def register(self, name, serializer, queryset, compile=True, **options):
+        '''
+        Register a serializer under `name`. Keyword options are passed
+        on to Serialization. With compile=False, it is compiled on
+        first use instead.
+        
+        The serializer and the queryset can be dotted paths or zero
+        argument factories. Then nothing is imported or built until
+        the serialization is first looked up here, or warmup() runs.
+        
+        Chains equal to one registered before are replaced by it, so
+        duplicate registrations share one copy.
+        '''
         if name in self:
             raise Exception(('%s was already registered in this '
                 + 'django-queryset-serialization instance') % name)
-        serialization = Serialization(serializer, queryset)
+        if isinstance(serializer, FilterChain):
+            serializer = self.interner.intern(serializer)
+        serialization = Serialization(serializer, queryset, name=name,
+            **options)
+        if compile and not (is_lazy(serializer) or is_lazy(queryset)):
+            serialization.compile()
         self[name] = serialization
         return serialization
-
+    
+    def resolve_url(self, url, name=None):
+        '''
+        Find the serialization a URL is for, and its parameters. The
+        name is the start of the URL, unless given. When several names
+        match, the longest one taking that many parameters wins.
+        
+        Raises KeyError for unknown names, and ValueError for malformed
+        URLs or URLs with the wrong number of parameters.
+        '''
+        
+        if name is not None:
+            url = url.strip().strip('/')
+            serialization = self[name]
+            return serialization, serialization.parameters_from_components(
+                url.split('/'))
+        
+        resolved = self.routes.resolve(url)
+        if not resolved:
+            raise KeyError(url)
+        
+        for name, components in resolved:
+            if self[name].accepts(len(components)):
+                break
+        else:
+            name, components = resolved[0]
+        
+        serialization = self[name]
+        return serialization, serialization.parameters_from_components(
+            components)
+    
     def from_url(self, url, name=None):
-        url = url.strip().strip('/')
-        components = url.split('/')
-        name = name or components.pop(0)
-        return self[name].from_iterable_parameters(components)
+        serialization, parameters = self.resolve_url(url, name)
+        return serialization.get_queryset(parameters)
+    
+    def fetch_url(self, url, name=None):
+        '''
+        Like from_url, but evaluate the queryset, going through the
+        serialization's result cache if it has one.
+        '''
+        serialization, parameters = self.resolve_url(url, name)
+        return serialization.fetch(parameters)
+    
+    def warmup(self, delay=0):
+        '''
+        Resolve and compile every serialization registered lazily, in
+        a background thread, after waiting `delay` seconds. Returns the
+        thread.
+        
+        Errors are left for the lookups of the serializations that
+        failed, which will raise them again.
+        '''
+        
+        def warm():
+            time.sleep(delay)
+            for name in list(self.keys()):
+                try:
+                    self[name]
+                except Exception:
+                    pass
+        
+        thread = threading.Thread(target=warm, name='dqs-warmup',
+            daemon=True)
+        thread.start()
+        return thread
+    
+    def dumps(self):
+        '''
+        Save the registered serializations as a string. See dqs.dumping
+        for what can be saved.
+        '''
+        return dumping.dump_registry(self)
+    
+    def dump(self, file):
+        file.write(self.dumps())
+    
+    def loads(self, data, **options):
+        '''
+        Register the serializations saved by dumps(). Keyword options
+        are passed on to every Serialization.
+        '''
+        return dumping.load_registry(data, self, **options)
+    
+    def load(self, file, **options):
+        return self.loads(file.read(), **options)
+    
+    def stats(self):
+        '''
+        A snapshot of the statistics of the serializations registered
+        here, by name. Statistics are only kept while
+        dqs.instrumentation is enabled.
+        '''
+        return instrumentation.instruments.snapshot(set(self.keys()))
+    
+    async def afrom_url(self, url, name=None):
+        'Async from_url. See aget_queryset'
+        serialization, parameters = self.resolve_url(url, name)
+        return await serialization.aget_queryset(parameters)
+    
+    async def afetch_url(self, url, name=None):
+        return await sync_to_async(self.fetch_url)(url, name)
+    
+    async def agather(self, *requests, concurrent=True):
+        '''
+        Evaluate several registered serializations concurrently. Each
+        request is a (name, parameters) tuple, or (name, parameters,
+        method), where method is 'fetch' (the default), 'count' or
+        'first'. Returns the results in the same order.
+        
+        Django's async ORM runs every query in the same thread, one
+        after the other. Here every request runs in its own worker
+        thread, with its own database connection, so their round
+        trips overlap. The connections are closed when the request is
+        done, as no request_finished signal reaches those threads.
+        Pass concurrent=False to run them in the main thread instead,
+        for example inside a transaction.
+        
+        '''
+        
+        def evaluate(name, parameters, method='fetch'):
+            try:
+                return getattr(self[name], method)(parameters)
+            finally:
+                if concurrent:
+                    connections.close_all()
+        
+        return list(await asyncio.gather(*[
+            sync_to_async(evaluate, thread_sensitive=not concurrent)(
+                *request) for request in requests]))
 
 dqs = DjangoQuerysetSerialization()
 
@@ -93,100 +955,89 @@ class FilterChain(object):
     
     ''' #TODO fix docstring
     
-    __slots__ = ['_placeholders', '_stack']
+    __slots__ = ['_tail', '__weakref__']
     
     def __init__(self):
-        self._placeholders = []
-        self._stack = []
+        self._tail = None
     
     placeholders = property(lambda s:s._placeholders)
     
-    def _copy(self):
+    @property
+    def fingerprint(self):
+        '''
+        A digest of the operations of this chain, the same for equal
+        chains in any process. See dqs.interning.
+        '''
+        if self._tail is None:
+            return interning.EMPTY_FINGERPRINT
+        return self._tail.fingerprint
+    
+    def __eq__(self, other):
+        if not isinstance(other, FilterChain):
+            return NotImplemented
+        return self.fingerprint == other.fingerprint
+    
+    def __hash__(self):
+        return hash(self.fingerprint)
+    
+    @property
+    def _placeholders(self):
+        return list(self._tail.placeholders) if self._tail else []
+    
+    @property
+    def _stack(self):
         '''
-        Make a copy of this class. very useful for immutability
+        The operations of this chain as a list of dicts, oldest first.
+        Built on demand from the operation nodes, so changing it does
+        not change the chain.
         '''
-        copied = self.__class__()
-        copied._stack = copy.deepcopy(self._stack)
-        copied._placeholders = copy.copy(self._placeholders)
-        return copied
+        return [{
+            'name':operation.name,
+            'args':operation.args,
+            'kwargs':dict(operation.kwargs)
+        } for operation in self._operations()]
+    
+    def _operations(self):
+        'The operation nodes of this chain, oldest first'
+        operations = []
+        operation = self._tail
+        while operation is not None:
+            operations.append(operation)
+            operation = operation.parent
+        operations.reverse()
+        return operations
     
     def get_queryset(self, base_queryset, parameters):
         'called by Serializer.get_queryset()'
-        
-        parameters = parameters if parameters else {}
-        
-        param_keys = map(utils.unescape, parameters.keys())
-        param_vals = parameters.values()
-        parameters = dict(zip(param_keys, param_vals))
-        
-        missing_params = set(self._placeholders) - set(param_keys)
-        
-        if missing_params:
-            raise Exception('Parameters are missing: %s' % ', '.join( 
-                missing_params))
-        
-        'copy the placeholders. we are going to consume them'
-        placeholders_left = list(self._placeholders)
-        
-        def replace_placeholders(val):
-            'Replace placeholder args in the input with user params'
-            if val in placeholders_left:
-                placeholders_left.remove(val)
-                return parameters[val]
-            else:
-                return val
-        
-        def replace_placeholders_in_dict(d):
-            vals = map(replace_placeholders, d.values())
-            keys = d.keys()
-            return dict(zip(keys,vals))
-        
-        calls = []
-        for operation in self._stack:
-            args = map(replace_placeholders, operation['args'])
-            kwargs = replace_placeholders_in_dict(operation['kwargs'])
-            name = operation['name']
-            calls.append((name,args,kwargs))
-        
-        queryset = base_queryset
-        for name, args, kwargs in calls:
-            method = getattr(queryset, name)
-            queryset = method(*args, **kwargs)
-        
-        return queryset
+        return self.compile().execute(base_queryset, parameters)
     
-    def _register(self, fname, *args, **kwargs):
+    def compile(self):
         '''
-        add a configurable queryset function call. Takes the queryset
-        method name (ie: 'filter', 'all', 'exclude'...), and
-        positional and keyword arguments for the call. Parameters
-        will be replaced by any given input parameters when
-        unserializing.
+        Turn this chain into an ExecutionPlan, which can be replayed
+        against a base queryset many times without looking at the
+        operations again.
         
+        The plan is kept by the last operation node, so equal chains
+        sharing it (see dqs.interning) share their plan too. Plans
+        must not be changed.
         '''
-        
-        def find_placeholder(arg):
-            if utils.is_placeholder(arg):
-                arg = utils.clean_placeholder(arg)
-                if arg in self._placeholders:
-                    raise ValueError(
-                        '%s was already used as a placeholder!' % arg)
-                self._placeholders.append(arg)
-                return arg
-            else:
-                return utils.unescape_non_placeholder(arg)
-        
-        args = map(find_placeholder, args)
-        kwargs_keys = map(find_placeholder, kwargs.keys())
-        kwargs_values = map(find_placeholder, kwargs.values())
-        
-        kwargs = dict(zip(kwargs_keys, kwargs_values))
-        
-        self._stack.append({
-            'name':fname,
-            'args':tuple(args),
-            'kwargs':kwargs
-        })
+        operation = self._tail
+        if operation is None:
+            return plan.ExecutionPlan([])
+        if operation.plan is None:
+            operation.plan = plan.ExecutionPlan(self._operations())
+        return operation.plan
+    
+    def dumps(self):
+        '''
+        Save this chain as a compact JSON string, which loads() turns
+        back into a chain. See dqs.dumping.
+        '''
+        return dumping.dumps_chain(self)
+    
+    @classmethod
+    def loads(cls, data):
+        return dumping.loads_chain(data, cls())
     
     def filter(self, **kwargs):
         return self.method('filter', **kwargs)
@@ -264,9 +1115,94 @@ class FilterChain(object):
         
         '''
         
-        copy = self._copy()
+        chained = self.__class__()
+        chained._tail = _Operation(self._tail, method_name, args, kwargs)
+        return chained
+
+
+
+class _Operation(object):
+    '''
+    A single queryset method call in a FilterChain.
+    
+    Operations are immutable and point to the operation before them,
+    so chains that were built from the same serializer share their
+    common prefix instead of copying it. Arguments are kept as they
+    were given, never copied.
+    
+    '''
+    
+    __slots__ = ['parent', 'name', 'args', 'kwargs', 'placeholders',
+        'slots', 'types', 'digest', 'plan', '__weakref__']
+    
+    def __init__(self, parent, name, args, kwargs):
+        '''
+        Takes the previous operation (or None), the queryset method
+        name (ie: 'filter', 'all', 'exclude'...), and positional and
+        keyword arguments for the call. Parameters will be replaced by
+        any given input parameters when unserializing.
+        
+        Where each placeholder was found is kept in `slots`, as
+        (kind, position, placeholder) tuples. `kind` is one of 'arg',
+        'key' or 'value', and `position` is the index in `args` or
+        `kwargs`.
+        
+        Typed placeholders ($name:type) are kept by name, and their
+        types in `types`, as (placeholder, type) tuples.
+        
+        '''
+        
+        inherited = parent.placeholders if parent else ()
+        found = []
+        slots = []
+        types = []
+        
+        def find_placeholder(arg, kind, position):
+            if utils.is_placeholder(arg):
+                arg, type = utils.split_placeholder(
+                    utils.clean_placeholder(arg))
+                if arg in inherited or arg in found:
+                    raise ValueError(
+                        '%s was already used as a placeholder!' % arg)
+                if type is not None:
+                    converters.get_converter(type)
+                    types.append((arg, type))
+                found.append(arg)
+                slots.append((kind, position, arg))
+                return arg
+            else:
+                return utils.unescape_non_placeholder(arg)
         
-        copy._register(method_name, *args, **kwargs)
+        self.parent = parent
+        self.name = name
+        self.args = tuple([find_placeholder(arg, 'arg', i)
+            for i, arg in enumerate(args)])
+        self.kwargs = tuple([(find_placeholder(key, 'key', i),
+                find_placeholder(val, 'value', i))
+            for i, (key, val) in enumerate(kwargs.items())])
+        self.slots = tuple(slots)
+        self.types = tuple(types)
         
-        return copy
+        'only build a new placeholder tuple when this call adds some'
+        self.placeholders = inherited + tuple(found) if found else inherited
+        self.digest = None
+        self.plan = None
+    
+    @property
+    def fingerprint(self):
+        'Computed the first time it is needed'
+        if self.digest is None:
+            self.digest = interning.fingerprint(self)
+        return self.digest
+    
+    def with_parent(self, parent):
+        '''
+        A copy of this operation following `parent`, which must be
+        equal to this operation's parent.
+        '''
+        operation = object.__new__(_Operation)
+        for name in _Operation.__slots__[:-1]:
+            setattr(operation, name, getattr(self, name))
+        operation.parent = parent
+        return operation
 
@@ -0,0 +1,286 @@
+'''
+Snapshots of the primary keys a serialization matches.
+
+With the `snapshots` option, a serialization evaluates its chain once
+per set of parameters, and keeps the ordered primary keys in a file
+of 64 bit integers. The file is memory-mapped, so every process using
+the same directory shares it.
+
+get_queryset() then returns a SnapshotList. Its length is known
+without a query, and slicing it gives a queryset of that slice of the
+keys (pk__in), ordered by their position in the snapshot. This works
+with Django's Paginator. Only annotations and the steps shaping the
+results (values(), values_list(), select_related()...) are replayed on
+those querysets, so filters are not. Chains annotating aggregates
+after a filter can't have snapshots, as the aggregates would then
+count the rows the filter left out.
+
+Snapshots are rebuilt:
+ 
+ - by Serialization.refresh_snapshot() and refresh_snapshots().
+ - when they are older than the store's `max_age`, if it has one.
+ - after an instance of a model the chain touches is saved or
+ deleted. This removes the files, and the snapshots are built again
+ when they are next used, in whichever process uses them first.
+
+Only integer primary keys are supported.
+
+'''
+
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+import time
+
+from django.db.models import Case, IntegerField, Value, When
+
+from dqs import dumping, utils
+
+MAGIC = b'DQSS'
+VERSION = 1
+
+'magic, version, count of keys, length of the parameters'
+HEADER = struct.Struct('=4sIqI')
+
+SHAPE_METHODS = frozenset(['values', 'values_list', 'select_related',
+    'prefetch_related', 'only', 'defer', 'using'])
+
+ANNOTATION_METHODS = frozenset(['annotate', 'alias'])
+
+'the steps replayed on the querysets of a SnapshotList'
+REPLAYED_METHODS = SHAPE_METHODS | ANNOTATION_METHODS
+
+
+
+def check_plan(plan):
+    '''
+    Raise ValueError if the rows of a plan's snapshots would not get
+    the same annotations: when it annotates aggregates after a filter.
+    '''
+    filtered = False
+    for step in plan.steps:
+        if step.name in ('filter', 'exclude'):
+            filtered = True
+        elif step.name in ANNOTATION_METHODS and filtered and any(
+                getattr(value, 'contains_aggregate', False)
+                for value in list(step.args) + list(step.values)):
+            raise ValueError('Chains annotating aggregates after a filter '
+                + 'can\'t have snapshots')
+
+
+
+class Snapshot(object):
+    'An open snapshot file'
+    
+    __slots__ = ['path', 'stat', 'map', 'pks', 'parameters']
+    
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self.stat = os.fstat(file.fileno())
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.path = path
+        
+        magic, version, count, length = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not a snapshot file: %s' % path)
+        
+        start = padded(HEADER.size + length)
+        self.parameters = json.loads(self.map[HEADER.size:HEADER.size
+            + length].decode('utf-8'), object_hook=dumping.decode_tagged)
+        self.pks = memoryview(self.map)[start:start + count * 8].cast('q')
+    
+    size = property(lambda s:len(s.map))
+    
+    def is_current(self, stat):
+        return (stat.st_ino, stat.st_mtime_ns) == (self.stat.st_ino,
+            self.stat.st_mtime_ns)
+
+
+
+def padded(length):
+    return (length + 7) // 8 * 8
+
+
+
+def write(path, pks, parameters):
+    'Write a snapshot file, atomically replacing any older one'
+    
+    encoded = json.dumps(dumping.encode(parameters),
+        separators=(',', ':')).encode('utf-8')
+    header = HEADER.pack(MAGIC, VERSION, len(pks), len(encoded)) + encoded
+    header += b'\0' * (padded(len(header)) - len(header))
+    
+    try:
+        data = struct.pack('=%dq' % len(pks), *pks)
+    except struct.error:
+        raise ValueError('Only integer primary keys can be snapshotted')
+    
+    directory = os.path.dirname(path)
+    fd, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(header)
+            file.write(data)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+
+class SnapshotStore(object):
+    '''
+    Keeps snapshot files in `directory`. Snapshots older than `max_age`
+    seconds are rebuilt when they are used, if it is given.
+    '''
+    
+    def __init__(self, directory, max_age=None):
+        self.directory = directory
+        self.max_age = max_age
+        self.snapshots = {}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+    
+    def prefix(self, name):
+        return re.sub(r'[^\w-]', '_', name) + '-'
+    
+    def path(self, name, parameters):
+        digest = hashlib.sha1(repr(utils.parameters_key(parameters))
+            .encode('utf-8')).hexdigest()[:20]
+        return os.path.join(self.directory, self.prefix(name) + digest
+            + '.pks')
+    
+    def paths(self, name):
+        prefix = self.prefix(name)
+        return [os.path.join(self.directory, filename)
+            for filename in os.listdir(self.directory)
+            if filename.startswith(prefix) and filename.endswith('.pks')]
+    
+    def get(self, serialization, parameters):
+        'The snapshot for bound parameters, built if needed'
+        
+        path = self.path(serialization.cache_name, parameters)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return self.build(serialization, parameters)
+        
+        if self.max_age is not None and time.time() - stat.st_mtime > \
+                self.max_age:
+            return self.build(serialization, parameters)
+        
+        snapshot = self.snapshots.get(path)
+        if snapshot is None or not snapshot.is_current(stat):
+            try:
+                snapshot = Snapshot(path)
+            except (FileNotFoundError, ValueError, struct.error):
+                return self.build(serialization, parameters)
+            with self.lock:
+                self.snapshots[path] = snapshot
+        return snapshot
+    
+    def build(self, serialization, parameters):
+        'Evaluate the primary keys, and write and open their snapshot'
+        
+        pks = list(serialization._build_queryset(parameters)
+            .values_list('pk', flat=True))
+        path = self.path(serialization.cache_name, parameters)
+        write(path, pks, parameters)
+        
+        snapshot = Snapshot(path)
+        with self.lock:
+            self.snapshots[path] = snapshot
+        return snapshot
+    
+    def drop(self, name):
+        'Remove the snapshot files of the serialization called `name`'
+        for path in self.paths(name):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+    
+    def saved_parameters(self, name):
+        'The parameters of every snapshot of a serialization'
+        parameters = []
+        for path in self.paths(name):
+            try:
+                parameters.append(Snapshot(path).parameters)
+            except (FileNotFoundError, ValueError, struct.error):
+                pass
+        return parameters
+    
+    def usage(self, name):
+        '''
+        The snapshots of a serialization, as a list of dicts with their
+        parameters, number of keys, and size in bytes.
+        '''
+        usage = []
+        for path in self.paths(name):
+            try:
+                snapshot = Snapshot(path)
+            except (FileNotFoundError, ValueError, struct.error):
+                continue
+            usage.append({
+                'parameters':snapshot.parameters,
+                'count':len(snapshot.pks),
+                'bytes':snapshot.size,
+            })
+        return usage
+
+
+
+class SnapshotList(object):
+    '''
+    What get_queryset() returns for serializations with snapshots.
+    Slices are querysets of the rows at those positions of the
+    snapshot, and iterating goes through it `chunk_size` rows at a
+    time.
+    '''
+    
+    chunk_size = 1000
+    
+    def __init__(self, serialization, parameters, snapshot):
+        self.serialization = serialization
+        self.parameters = parameters
+        self.snapshot = snapshot
+    
+    pks = property(lambda s:s.snapshot.pks)
+    
+    def count(self):
+        return len(self.pks)
+    
+    def __len__(self):
+        return len(self.pks)
+    
+    def __iter__(self):
+        for start in range(0, len(self.pks), self.chunk_size):
+            for row in self.rows(self.pks[start:start + self.chunk_size]):
+                yield row
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.step not in (None, 1):
+                raise ValueError('Snapshots can\'t be sliced with a step')
+            return self.rows(self.pks[index])
+        return self.rows(self.pks[index:index + 1 or None])[0]
+    
+    def rows(self, pks):
+        'A queryset of the rows with these keys, in this order'
+        pks = pks.tolist()
+        serialization = self.serialization
+        plan = serialization.plan
+        skip = set(step.name for step in plan.steps) - REPLAYED_METHODS
+        
+        queryset = plan.replay(serialization.base_queryset.filter(
+            pk__in=pks), self.parameters, skip=skip)
+        if not pks:
+            return queryset
+        return queryset.order_by(Case(*[When(pk=pk, then=Value(position))
+            for position, pk in enumerate(pks)],
+            output_field=IntegerField()))
@@ -0,0 +1,270 @@
+'''
+Compiled SQL cache for registered serializations.
+
+The first time a serialization is fetched on a database, its query
+template (see dqs.templating) is compiled to SQL once. The position of
+the parameters of every placeholder's lookup in the SQL parameter list
+is recorded. Later fetches compile only those lookups, splice their
+parameters into the cached list, and run the cached SQL directly.
+
+If a lookup compiles to different SQL for a new value (for example an
+__in lookup given a list of another length), the SQL depends on the
+values, and the fetch falls back to evaluating the queryset.
+
+The SQL selects annotations after the fields, so values_list() rows
+are put back in the order the fields were asked for by name, like
+Django does.
+
+'''
+
+from django.core.exceptions import EmptyResultSet
+from django.db import connections
+
+from dqs import templating
+
+CACHEABLE_METHODS = frozenset(['filter', 'exclude', 'order_by', 'values',
+    'values_list', 'only', 'defer', 'using', 'all'])
+
+MODELS, VALUES, VALUES_LIST, FLAT_VALUES_LIST = range(4)
+
+RESULT_KINDS = {
+    'ModelIterable':MODELS,
+    'ValuesIterable':VALUES,
+    'ValuesListIterable':VALUES_LIST,
+    'FlatValuesListIterable':FLAT_VALUES_LIST,
+}
+
+
+
+def is_cacheable(plan, base_queryset):
+    'Whether the SQL of a plan can be cached at all'
+    if base_queryset.query.select_related or base_queryset.query.combinator:
+        return False
+    if base_queryset._prefetch_related_lookups:
+        return False
+    return all(step.name in CACHEABLE_METHODS for step in plan.steps)
+
+
+
+class Marker(object):
+    'Stands in for a slot parameter in the cached parameter list'
+    
+    __slots__ = ['slot']
+    
+    def __init__(self, slot):
+        self.slot = slot
+
+
+
+class MarkedLookup(object):
+    '''
+    Wraps a slot's lookup while the query is compiled for the first
+    time, and hands out Markers instead of its parameters.
+    '''
+    
+    contains_aggregate = False
+    contains_over_clause = False
+    
+    def __init__(self, lookup, slot):
+        self.lookup = lookup
+        self.slot = slot
+        self.sql = None
+    
+    def as_sql(self, compiler, connection):
+        sql, params = compiler.compile(self.lookup)
+        self.sql = sql
+        return sql, [Marker(self.slot) for param in params]
+
+
+
+class CompiledQuery(object):
+    __slots__ = ['alias', 'query', 'sql', 'params', 'slots', 'kind',
+        'select', 'col_count', 'klass_info', 'annotation_col_map', 'names',
+        'row_order', 'export_converters']
+    
+    def __init__(self, queryset, template):
+        '''
+        Compile a queryset built by `template` to SQL. Raises
+        ValueError if the SQL can't be cached.
+        '''
+        
+        self.kind = RESULT_KINDS.get(queryset._iterable_class.__name__)
+        if self.kind is None or queryset.query.select_related:
+            raise ValueError('Unsupported result type')
+        
+        self.alias = queryset.db
+        self.query = queryset.query
+        
+        marked = []
+        for index, (path, placeholder) in enumerate(template.slots):
+            node = self.query.where
+            for child in path[:-1]:
+                node = node.children[child]
+            lookup = node.children[path[-1]]
+            marked.append(MarkedLookup(lookup, index))
+            node.children[path[-1]] = marked[-1]
+        
+        try:
+            compiler = self.query.get_compiler(using=self.alias)
+            self.sql, params = compiler.as_sql()
+        finally:
+            'put the real lookups back'
+            for (path, placeholder), lookup in zip(template.slots, marked):
+                node = self.query.where
+                for child in path[:-1]:
+                    node = node.children[child]
+                node.children[path[-1]] = lookup.lookup
+        
+        self.params = list(params)
+        self.slots = []
+        for index, (path, placeholder) in enumerate(template.slots):
+            positions = [position for position, param in enumerate(params)
+                if isinstance(param, Marker) and param.slot == index]
+            if not positions or positions != list(range(positions[0],
+                    positions[0] + len(positions))):
+                raise ValueError('Placeholder parameters are not contiguous')
+            lookup = marked[index].lookup
+            self.slots.append((placeholder, lookup.__class__, lookup.lhs,
+                marked[index].sql, positions[0], len(positions)))
+        
+        self.select = compiler.select
+        self.col_count = compiler.col_count
+        self.klass_info = compiler.klass_info
+        self.annotation_col_map = compiler.annotation_col_map
+        self.export_converters = None
+        self.names = (list(self.query.extra_select)
+            + list(self.query.values_select)
+            + list(self.query.annotation_select))
+        
+        if self.kind == VALUES_LIST and len(self.names) != self.col_count:
+            raise ValueError('Unsupported values_list() columns')
+        
+        self.row_order = None
+        fields = list(queryset._fields or ())
+        fields += [name for name in self.query.annotation_select
+            if name not in fields]
+        if self.kind == VALUES_LIST and fields and fields != self.names:
+            try:
+                self.row_order = [self.names.index(name) for name in fields]
+            except ValueError:
+                raise ValueError('Unsupported values_list() columns')
+    
+    def execute(self, parameters):
+        '''
+        Bind the parameters and run the cached SQL. Returns None if the
+        SQL for these parameters is different from the cached SQL.
+        '''
+        
+        params = self.bind(parameters)
+        if params is None:
+            return None
+        
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute(self.sql, params)
+            rows = cursor.fetchall()
+        
+        compiler = self.query.get_compiler(using=self.alias)
+        compiler.select = self.select
+        compiler.col_count = self.col_count
+        rows = compiler.results_iter([[row[:self.col_count]
+            for row in rows]])
+        
+        return self.build_results(rows)
+    
+    def bind(self, parameters):
+        '''
+        The SQL parameters for bound parameters, or None if the SQL for
+        them is different from the cached SQL.
+        '''
+        
+        compiler = self.query.get_compiler(using=self.alias)
+        params = list(self.params)
+        for placeholder, lookup_class, lhs, sql, start, count in self.slots:
+            value = parameters[placeholder]
+            if templating.changes_shape(value):
+                return None
+            try:
+                lookup_sql, lookup_params = compiler.compile(
+                    lookup_class(lhs, value))
+            except Exception:
+                return None
+            if lookup_sql != sql or len(lookup_params) != count:
+                return None
+            params[start:start + count] = lookup_params
+        
+        return params
+    
+    def build_results(self, rows):
+        if self.kind == VALUES:
+            return [dict(zip(self.names, row)) for row in rows]
+        if self.kind == VALUES_LIST and self.row_order is not None:
+            return [tuple([row[index] for index in self.row_order])
+                for row in rows]
+        if self.kind == VALUES_LIST:
+            return [tuple(row) for row in rows]
+        if self.kind == FLAT_VALUES_LIST:
+            return [row[0] for row in rows]
+        
+        model = self.klass_info['model']
+        select_fields = self.klass_info['select_fields']
+        start, end = select_fields[0], select_fields[-1] + 1
+        init_list = [column[0].target.attname
+            for column in self.select[start:end]]
+        
+        results = []
+        for row in rows:
+            obj = model.from_db(self.alias, init_list, row[start:end])
+            for name, position in self.annotation_col_map.items():
+                setattr(obj, name, row[position])
+            results.append(obj)
+        return results
+
+
+
+class SQLCache(object):
+    '''
+    The compiled queries of one serialization, by database alias.
+    Aliases whose SQL can't be cached map to None.
+    '''
+    
+    def __init__(self, template):
+        self.template = template
+        self.compiled = {}
+    
+    def fetch(self, parameters, alias=None):
+        '''
+        Get the results for bound parameters as a list, or None when
+        the cache can't be used and the queryset must be evaluated.
+        The query runs on the template's database, unless `alias` is
+        given.
+        '''
+        compiled = self.compiled_query(parameters, alias)
+        if compiled is None:
+            return None
+        return compiled.execute(parameters)
+    
+    def compiled_query(self, parameters, alias=None):
+        '''
+        The CompiledQuery for the database, compiled with these bound
+        parameters the first time. None if the SQL can't be cached.
+        '''
+        
+        alias = alias or self.template.queryset.db
+        compiled = self.compiled.get(alias, False)
+        
+        if compiled is False:
+            queryset = self.template.execute(parameters)
+            if queryset is None:
+                return None
+            if queryset.db != alias:
+                queryset = queryset.using(alias)
+            try:
+                compiled = CompiledQuery(queryset, self.template)
+            except EmptyResultSet:
+                'only for these values. try again next time'
+                return None
+            except ValueError:
+                compiled = None
+            self.compiled[alias] = compiled
+        
+        return compiled
@@ -0,0 +1,71 @@
+'''
+Streaming the rows of values() and values_list() chains as JSON.
+
+The queryset is evaluated with .iterator(chunk_size=...), which uses
+a server-side cursor on backends that support them, so only one chunk
+of rows is in memory at any time. Rows are encoded a chunk at a time
+and yielded as strings, ready to be given to StreamingHttpResponse:
+    
+    return StreamingHttpResponse(
+        dqs['people-search'].stream({'q':'a'}, format='ndjson'),
+        content_type='application/x-ndjson')
+
+'''
+
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+FORMATS = ('ndjson', 'json')
+
+
+
+def stream_rows(queryset, format='ndjson', chunk_size=2000):
+    '''
+    Iterate over the rows of a values() or values_list() queryset as
+    chunks of newline delimited JSON, or of a single JSON array. The
+    arguments are checked here, before the first chunk is asked for.
+    '''
+    
+    if format not in FORMATS:
+        raise ValueError('Unknown stream format: %s' % format)
+    if getattr(queryset, '_fields', None) is None:
+        raise ValueError('Only values() and values_list() chains can be '
+            + 'streamed')
+    return encode_rows(queryset, format, chunk_size)
+
+
+
+def encode_rows(queryset, format, chunk_size):
+    'The generator of stream_rows'
+    
+    encode = DjangoJSONEncoder(separators=(',', ':')).encode
+    separator = '\n' if format == 'ndjson' else ','
+    
+    rows = queryset.iterator(chunk_size=chunk_size)
+    
+    if format == 'json':
+        yield '['
+    
+    first = True
+    chunk = []
+    for row in rows:
+        chunk.append(encode(row))
+        if len(chunk) >= chunk_size:
+            yield chunk_to_string(chunk, separator, format, first)
+            first = False
+            chunk = []
+    
+    if chunk:
+        yield chunk_to_string(chunk, separator, format, first)
+    
+    if format == 'json':
+        yield ']'
+
+
+
+def chunk_to_string(chunk, separator, format, first):
+    joined = separator.join(chunk)
+    if format == 'ndjson':
+        return joined + '\n'
+    return joined if first else ',' + joined
@@ -0,0 +1,141 @@
+'''
+Query templates for registered serializations.
+
+A QueryTemplate is a queryset built once from the serialization's
+chain, with sentinel objects where the placeholders go. Django parses
+the lookups, sets up the joins and builds the WHERE tree only that
+one time. Later, the template is cloned and the lookups holding
+sentinels are replaced by lookups of the same class holding the real
+values.
+
+Only chains where every placeholder is the value of a filter() or
+exclude() keyword argument can be templated. Serialization falls back
+to replaying the chain for anything else.
+
+'''
+
+from dqs import lists
+
+TEMPLATABLE_METHODS = frozenset(['filter', 'exclude'])
+
+
+
+class Sentinel(object):
+    '''
+    Stands in for a placeholder's value while the template is built.
+    
+    It looks like an expression to Django, so the lookups keep it as
+    their right hand side untouched instead of preparing it.
+    '''
+    
+    filterable = True
+    contains_aggregate = False
+    contains_over_clause = False
+    
+    def __init__(self, placeholder):
+        self.placeholder = placeholder
+    
+    def resolve_expression(self, *args, **kwargs):
+        return self
+    
+    def __repr__(self):
+        return '<Sentinel: $%s>' % self.placeholder
+
+
+
+class QueryTemplate(object):
+    __slots__ = ['queryset', 'slots']
+    
+    def __init__(self, queryset, slots):
+        self.queryset = queryset
+        self.slots = slots
+    
+    @classmethod
+    def build(cls, plan, base_queryset):
+        '''
+        Build the template for the plan, or return None if the plan
+        can't be templated.
+        '''
+        
+        for step in plan.steps:
+            if step.call is not None:
+                continue
+            if not (step.arg_slots or step.key_slots or step.value_slots):
+                'list parameters filled in by bind() are always replayed'
+                return None
+            if (step.name not in TEMPLATABLE_METHODS
+                    or step.arg_slots or step.key_slots):
+                return None
+            for position, placeholder in step.value_slots:
+                if step.keys[position].endswith('__isnull'):
+                    'isnull changes the joins depending on its value'
+                    return None
+        
+        sentinels = dict((placeholder, Sentinel(placeholder))
+            for placeholder in plan.placeholders)
+        
+        try:
+            queryset = plan.replay(base_queryset, sentinels)
+        except Exception:
+            return None
+        
+        slots = []
+        find_sentinels(queryset.query.where, (), slots)
+        
+        found = [placeholder for path, placeholder in slots]
+        if sorted(found) != sorted(plan.placeholders):
+            'some sentinel ended up elsewhere, for example in a subquery'
+            return None
+        
+        return cls(queryset, tuple(slots))
+    
+    def execute(self, parameters):
+        '''
+        Get a queryset from the template, given bound parameters.
+        Returns None when the values would change the shape of the
+        query, and the chain must be replayed instead.
+        '''
+        
+        for path, placeholder in self.slots:
+            if changes_shape(parameters[placeholder]):
+                return None
+        
+        queryset = self.queryset.all()
+        where = queryset.query.where
+        for path, placeholder in self.slots:
+            node = where
+            for index in path[:-1]:
+                node = node.children[index]
+            
+            lookup = node.children[path[-1]]
+            node.children[path[-1]] = lookup.__class__(lookup.lhs,
+                parameters[placeholder])
+        
+        return queryset
+
+
+
+def changes_shape(value):
+    '''
+    Whether a value changes the shape of the query it is given to, so
+    it can't be put in a template. None and (on Oracle) the empty
+    string become isnull lookups, expressions must be resolved, and
+    list parameters may be bound another way (see dqs.lists).
+    '''
+    return (value is None or hasattr(value, 'resolve_expression')
+        or (isinstance(value, str) and value == '')
+        or isinstance(value, lists.ListParameter))
+
+
+
+def find_sentinels(node, path, slots):
+    '''
+    Walk a WHERE tree, and append (path, placeholder) to `slots` for
+    every lookup holding a Sentinel. `path` is the list of child
+    indexes leading to the lookup.
+    '''
+    for index, child in enumerate(node.children):
+        if hasattr(child, 'children'):
+            find_sentinels(child, path + (index,), slots)
+        elif isinstance(getattr(child, 'rhs', None), Sentinel):
+            slots.append((path + (index,), child.rhs.placeholder))
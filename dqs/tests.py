@@ -51,7 +51,53 @@ class BasicTests(TestCase):
         used.
         '''
         
-        #TODO Add serialization capabilities to the serializers
+        import datetime
+        import decimal
+        from io import StringIO
+        FilterChain = serialization.FilterChain
+        
+        someone = Person(name='$someone', gender=GENDER_VALUES['male'])
+        someone.save()
+        friend = Person(name='friend', gender=GENDER_VALUES['male'],
+            best_friend=someone)
+        friend.save()
+        
+        serializer = (self.dqs.make_serializer()
+            .filter(gender='$gender:int', best_friend__in=[someone])
+            .exclude(name='$$someone')
+            .filter(pk__gte=decimal.Decimal('0'), name__in=('friend',)))
+        
+        loaded = FilterChain.loads(serializer.dumps())
+        self.assertEqual(loaded.placeholders, ['gender'])
+        self.assertEqual(loaded.dumps(), serializer.dumps())
+        self.assertEqual(list(loaded.get_queryset(Person.objects.all(),
+            {'gender':str(GENDER_VALUES['male'])})), [friend])
+        
+        day = datetime.date(2000, 1, 1)
+        self.assertEqual(FilterChain.loads(FilterChain().filter(day=day)
+            .dumps())._stack[0]['kwargs'], {'day':day})
+        
+        self.dqs.register('saved', serializer, Person.objects.all(),
+            defaults={'gender':GENDER_VALUES['male']})
+        
+        saved = StringIO()
+        self.dqs.dump(saved)
+        saved.seek(0)
+        
+        registry = serialization.DjangoQuerysetSerialization()
+        registry.load(saved)
+        self.assertEqual(list(registry.from_url('/saved')), [friend])
+        
+        'live objects in the options are not dropped silently'
+        from dqs.coalescing import SingleFlight
+        self.dqs.register('coalesced', self.dqs.make_serializer(),
+            Person.objects.all(), coalesce=SingleFlight())
+        self.assertRaises(ValueError, self.dqs.dumps)
+        del self.dqs['coalesced']
+        
+        self.dqs.register('unsaveable', self.dqs.make_serializer(),
+            Person.objects.filter(gender=GENDER_VALUES['male']))
+        self.assertRaises(ValueError, self.dqs.dumps)
     
     def test_serializers_can_have_their_parameters_changed(self):
         '''
@@ -80,9 +126,26 @@ class BasicTests(TestCase):
             .filter(name__icontains='this-string-not-in-name'))
         'Still the same result, even though the serializer changed'
         self.assertTrue(self.dqs[name].get_queryset().count() == 1)
-    
-    
-    
+
+    def test_serializers_share_structure(self):
+        '''
+        Chaining does not copy the previous operations, nor the
+        arguments given to them.
+        '''
+        names = ['a', 'b', 'c']
+        serializer = self.dqs.make_serializer().filter(name__in=names)
+        serializer2 = serializer.exclude(gender='$gender')
+        serializer3 = serializer.order_by('name')
+
+        self.assertTrue(serializer2._tail.parent is serializer._tail)
+        self.assertTrue(serializer3._tail.parent is serializer._tail)
+        self.assertTrue(serializer2._stack[0]['kwargs']['name__in'] is names)
+        self.assertEqual(serializer.placeholders, [])
+        self.assertEqual(serializer2.placeholders, ['gender'])
+        self.assertEqual(serializer3.placeholders, [])
+
+
+
     def test_placeholder_escaping(self):
         p = Person(name='Person with a $weird name',
             gender=GENDER_VALUES['male'])
@@ -95,6 +158,887 @@ class BasicTests(TestCase):
         
         self.assertTrue(p in qs)
     
+    def test_literals_are_not_placeholders(self):
+        '''
+        Literal arguments which happen to be equal to a placeholder's
+        name are never replaced.
+        '''
+        p = Person(name='gender', gender=GENDER_VALUES['female'])
+        p.save()
+        
+        s = self.dqs.register('literal-test', self.dqs.make_serializer()
+                .filter(name='gender')
+                .filter(gender='$gender'),
+            Person.objects.all())
+        
+        self.assertTrue(s.plan is not None)
+        self.assertTrue(p in s.get_queryset({
+            'gender':GENDER_VALUES['female']}))
+        self.assertTrue(p not in s.get_queryset({
+            'gender':GENDER_VALUES['male']}))
+    
+    def test_query_template(self):
+        male = Person(name='someone', gender=GENDER_VALUES['male'])
+        female = Person(name='someoneelse', gender=GENDER_VALUES['female'])
+        male.save()
+        female.save()
+        
+        s = self.dqs.register('template-test', self.dqs.make_serializer()
+                .filter(name__icontains='$name')
+                .exclude(gender='$gender'),
+            Person.objects.all(), query_template=True)
+        
+        self.assertTrue(s.query_template is not None)
+        
+        for gender, expected in [('male', female), ('female', male)]:
+            qs = s.get_queryset({'name':'someone',
+                'gender':GENDER_VALUES[gender]})
+            self.assertEqual(list(qs), [expected])
+        
+        'None changes the shape of the query, so the chain is replayed'
+        qs = s.get_queryset({'name':'someone', 'gender':None})
+        self.assertEqual(qs.count(), 2)
+        
+        'placeholders outside of filter values can not be templated'
+        s = self.dqs.register('template-test-2', self.dqs.make_serializer()
+                .order_by('$order'),
+            Person.objects.all(), query_template=True)
+        
+        self.assertTrue(s.query_template is None)
+        self.assertEqual(s.get_queryset({'order':'name'})[0], male)
+    
+    def test_sql_cache(self):
+        p1 = Person(name='someone', gender=GENDER_VALUES['male'])
+        p2 = Person(name='someoneelse', gender=GENDER_VALUES['female'])
+        p1.save()
+        p2.save()
+        
+        s = self.dqs.register('sql-cache-test', self.dqs.make_serializer()
+                .filter(gender='$gender')
+                .order_by('name'),
+            Person.objects.all(), sql_cache=True)
+        
+        self.assertEqual(s.fetch({'gender':GENDER_VALUES['male']}), [p1])
+        self.assertTrue(s.sql_cache.compiled['default'] is not None)
+        self.assertEqual(s.fetch({'gender':GENDER_VALUES['female']}), [p2])
+        
+        s = self.dqs.register('sql-cache-test-2', self.dqs.make_serializer()
+                .filter(pk__in='$pks')
+                .values_list('name'),
+            Person.objects.all(), sql_cache=True)
+        
+        self.assertEqual(s.fetch({'pks':[p1.pk]}), [('someone',)])
+        self.assertEqual(s.fetch({'pks':[p2.pk]}), [('someoneelse',)])
+        'a longer list changes the SQL, so the queryset is evaluated'
+        self.assertEqual(len(s.fetch({'pks':[p1.pk, p2.pk]})), 2)
+        
+        'annotations of the base queryset come back in their place'
+        from django.db.models.functions import Upper
+        s = self.dqs.register('sql-cache-test-3', self.dqs.make_serializer()
+                .filter(pk='$pk')
+                .values_list('upper', 'name', 'gender'),
+            Person.objects.annotate(upper=Upper('name')), sql_cache=True)
+        for person in [p1, p2, p1]:
+            self.assertEqual(s.fetch({'pk':person.pk}), [(person.name.upper(),
+                person.name, person.gender)])
+        self.assertTrue(s.sql_cache.compiled['default'] is not None)
+    
+    def test_result_cache(self):
+        from django.db.models import Count, F, Q
+        from dqs.caching import MISSING, LocMemResultCache
+        
+        cache = LocMemResultCache(max_size=10, ttl=60)
+        s = self.dqs.register('cache-test', self.dqs.make_serializer()
+                .filter(gender='$gender'),
+            Person.objects.all(), cache=cache)
+        
+        p1 = Person(name='someone', gender=GENDER_VALUES['male'])
+        p1.save()
+        
+        self.assertEqual(s.fetch({'gender':GENDER_VALUES['male']}), [p1])
+        self.assertEqual(self.dqs.fetch_url('/cache-test/%d'
+            % GENDER_VALUES['male']), [p1])
+        self.assertEqual(len(cache.entries), 2)
+        
+        'saving a Person invalidates the cached results'
+        p2 = Person(name='someoneelse', gender=GENDER_VALUES['male'])
+        p2.save()
+        
+        self.assertEqual(len(cache.entries), 0)
+        self.assertEqual(len(s.fetch({'gender':GENDER_VALUES['male']})), 2)
+        
+        'cached results are handed out as copies'
+        s.fetch({'gender':GENDER_VALUES['male']}).append(None)
+        self.assertEqual(len(s.fetch({'gender':GENDER_VALUES['male']})), 2)
+        
+        'results of queries started before an invalidation are dropped'
+        male = s.plan.bind({'gender':GENDER_VALUES['male']})
+        generation = cache.generation('cache-test')
+        s.invalidate_cache()
+        cache.set('cache-test', male, [p1], generation)
+        self.assertIs(cache.get('cache-test', male), MISSING)
+        
+        'models joined by Q objects, expressions and the base queryset'
+        through = Person.friends.through
+        for name, serializer, base_queryset in [
+                ('touched-q', self.dqs.make_serializer()
+                    .annotate(named=Count('pk',
+                        filter=Q(friends__name='someone'))),
+                    Person.objects.all()),
+                ('touched-f', self.dqs.make_serializer()
+                    .annotate(friend_name=F('friends__name')),
+                    Person.objects.all()),
+                ('touched-base', self.dqs.make_serializer()
+                    .filter(name='$name'),
+                    Person.objects.filter(friends__name='someone'))]:
+            s = self.dqs.register(name, serializer, base_queryset,
+                cache=cache)
+            self.assertIn(through, s.touched_models)
+    
+    def test_many_parameter_sets(self):
+        p1 = Person(name='someone', gender=GENDER_VALUES['male'])
+        p2 = Person(name='someoneelse', gender=GENDER_VALUES['female'])
+        p1.save()
+        p2.save()
+        
+        s = self.dqs.register('many-test', self.dqs.make_serializer()
+                .filter(gender='$gender')
+                .order_by('name'),
+            Person.objects.all())
+        
+        parameter_sets = [{'gender':GENDER_VALUES['male']},
+            {'gender':GENDER_VALUES['female']}, {'gender':3}]
+        
+        'a single equality placeholder varies, so it takes one query'
+        with self.assertNumQueries(1):
+            self.assertEqual(s.get_querysets_many(parameter_sets),
+                [[p1], [p2], []])
+        with self.assertNumQueries(1):
+            self.assertEqual(s.count_many(parameter_sets), [1, 1, 0])
+        
+        s = self.dqs.register('many-test-2', self.dqs.make_serializer()
+                .filter(name__startswith='$start')
+                .exclude(gender='$gender')
+                .order_by('name'),
+            Person.objects.all())
+        
+        parameter_sets = [
+            {'start':'someone', 'gender':GENDER_VALUES['male']},
+            {'start':'someoneelse', 'gender':GENDER_VALUES['male']},
+            {'start':'someone', 'gender':3}]
+        
+        'the rest are combined with UNION ALL'
+        with self.assertNumQueries(1):
+            self.assertEqual(s.get_querysets_many(parameter_sets),
+                [[p2], [p2], [p1, p2]])
+        with self.assertNumQueries(1):
+            self.assertEqual(s.count_many(parameter_sets), [1, 1, 2])
+        
+        'text fields are not coalesced on, whatever their collation'
+        from dqs.batching import prepare_coalescing
+        s = self.dqs.register('many-test-3', self.dqs.make_serializer()
+                .filter(name='$name'),
+            Person.objects.all())
+        parameter_sets = [{'name':'someone'}, {'name':'SOMEONE'},
+            {'name':'someoneelse'}]
+        self.assertIsNone(prepare_coalescing(s, parameter_sets))
+        with self.assertNumQueries(1):
+            self.assertEqual(s.get_querysets_many(parameter_sets),
+                [[p1], [], [p2]])
+        self.assertEqual(s.count_many(parameter_sets), [1, 0, 1])
+    
+    async def test_async_api(self):
+        s = self.dqs.register('async-test', self.dqs.make_serializer()
+                .filter(gender='$gender'),
+            Person.objects.all())
+        
+        p = Person(name='someone', gender=GENDER_VALUES['male'])
+        await p.asave()
+        
+        male = {'gender':GENDER_VALUES['male']}
+        
+        qs = await s.aget_queryset(male)
+        self.assertEqual(await qs.acount(), 1)
+        self.assertEqual(await s.afetch(male), [p])
+        self.assertEqual(await s.acount(male), 1)
+        self.assertEqual(await s.afirst(male), p)
+        self.assertEqual(await self.dqs.afetch_url('/async-test/%d'
+            % GENDER_VALUES['male']), [p])
+        
+        'snapshots are taken in a worker thread'
+        import shutil
+        import tempfile
+        from dqs.snapshots import SnapshotStore
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.dqs.register('async-snapshot', self.dqs.make_serializer()
+                .filter(gender='$gender')
+                .values('name'),
+            Person.objects.all(), snapshots=SnapshotStore(directory))
+        people = await self.dqs.afrom_url('/async-snapshot/%d'
+            % GENDER_VALUES['male'])
+        self.assertEqual(len(people), 1)
+        'let it go before the directory is removed'
+        del self.dqs['async-snapshot']
+        
+        'the test transaction is only seen from this thread'
+        results = await self.dqs.agather(
+            ('async-test', male),
+            ('async-test', male, 'count'),
+            ('async-test', {'gender':GENDER_VALUES['female']}, 'first'),
+            concurrent=False)
+        self.assertEqual(results, [[p], 1, None])
+    
+    def test_streaming(self):
+        for name in ['a', 'b', 'c']:
+            Person(name=name, gender=GENDER_VALUES['male']).save()
+        
+        s = self.dqs.register('stream-test', self.dqs.make_serializer()
+                .filter(gender='$gender')
+                .order_by('name')
+                .values('name'),
+            Person.objects.all())
+        
+        male = {'gender':GENDER_VALUES['male']}
+        
+        chunks = list(s.stream(male, chunk_size=2))
+        self.assertEqual(chunks, ['{"name":"a"}\n{"name":"b"}\n',
+            '{"name":"c"}\n'])
+        
+        self.assertEqual(json.loads(''.join(s.stream(male, format='json'))),
+            [{'name':'a'}, {'name':'b'}, {'name':'c'}])
+        
+        'bad arguments raise before iterating'
+        self.assertRaises(ValueError, s.stream, male, format='xml')
+        models = self.dqs.instant(self.dqs.make_serializer(),
+            Person.objects.all())
+        self.assertRaises(ValueError, models.stream)
+    
+    def test_keyset_pagination(self):
+        people = [Person(name=name, gender=GENDER_VALUES['male'])
+            for name in ['d', 'a', 'c', 'a', 'b']]
+        for person in people:
+            person.save()
+        
+        s = self.dqs.register('page-test', self.dqs.make_serializer()
+                .filter(gender='$gender')
+                .order_by('name'),
+            Person.objects.all(), keyset=True)
+        
+        male = {'gender':GENDER_VALUES['male']}
+        
+        pages = []
+        token = None
+        while True:
+            page, token = s.get_page(male, after=token, size=2)
+            pages.append([person.name for person in page])
+            if token is None:
+                break
+        
+        self.assertEqual(pages, [['a', 'a'], ['b', 'c'], ['d']])
+        
+        'tokens keep the type and precision of the sort keys'
+        import base64
+        import datetime
+        import decimal
+        from dqs import pagination
+        
+        ordering = [('when', False), ('amount', True), ('pk', False)]
+        keys = [datetime.datetime(2020, 1, 31, 12, 30, 15, 123456),
+            decimal.Decimal('1.10'), 7]
+        self.assertEqual(pagination.decode_token(
+            pagination.encode_token(keys), ordering), keys)
+        self.assertRaises(ValueError, pagination.decode_token,
+            pagination.encode_token([{'a':1}, 1, 2]), ordering)
+        overflowing = base64.urlsafe_b64encode(
+            b'[{"~":"timedelta","v":[1000000000000,0,0]},1]').decode()
+        self.assertRaises(ValueError, pagination.decode_token, overflowing,
+            ordering[1:])
+        
+        'chains without an ordering are rejected when registered'
+        self.assertRaises(ValueError, self.dqs.register, 'page-test-2',
+            self.dqs.make_serializer().filter(gender='$gender'),
+            Person.objects.all(), keyset=True)
+    
+    def test_count_modes(self):
+        for name in ['a', 'b']:
+            Person(name=name, gender=GENDER_VALUES['male']).save()
+        
+        s = self.dqs.register('count-test', self.dqs.make_serializer()
+                .filter(gender='$gender')
+                .order_by('name'),
+            Person.objects.all())
+        
+        male = {'gender':GENDER_VALUES['male']}
+        
+        self.assertEqual(s.count(male), 2)
+        
+        'the count cache is only made when needed'
+        self.assertIsNone(s._count_cache)
+        self.assertEqual(s.count(male, mode='cached'), 2)
+        self.assertIsNotNone(s._count_cache)
+        Person(name='c', gender=GENDER_VALUES['male']).save()
+        with self.assertNumQueries(0):
+            self.assertEqual(s.count(male, mode='cached'), 2)
+        
+        estimate = s.count(male, mode='estimated')
+        self.assertTrue(estimate.count >= 0)
+        if not estimate.approximate:
+            self.assertEqual(estimate.count, 3)
+        
+        self.assertRaises(ValueError, s.count, male, mode='wrong')
+        
+        'the ordering is part of the GROUP BY of annotated values()'
+        from django.db.models import Count
+        Person(name='d', gender=GENDER_VALUES['male']).save()
+        s = self.dqs.register('count-grouped', self.dqs.make_serializer()
+                .order_by('name')
+                .values('gender')
+                .annotate(n=Count('id'))
+                .filter(gender='$g'),
+            Person.objects.all())
+        male = {'g':GENDER_VALUES['male']}
+        self.assertEqual(len(s.get_queryset(male)), 4)
+        self.assertEqual(s.count(male), 4)
+        self.assertEqual(s.count(male, mode='estimated').count, 4)
+        self.assertEqual(s.count_many([male, {'g':GENDER_VALUES['female']}]),
+            [4, 0])
+    
+    def test_instrumentation(self):
+        from dqs import instrumentation
+        
+        Person(name='someone', gender=GENDER_VALUES['male']).save()
+        
+        s = self.dqs.register('stats-test', self.dqs.make_serializer()
+                .filter(gender='$gender'),
+            Person.objects.all())
+        
+        male = {'gender':GENDER_VALUES['male']}
+        
+        instrumentation.reset()
+        s.fetch(male)
+        self.assertEqual(self.dqs.stats(), {})
+        
+        events = []
+        hook = lambda name, event: events.append((name, event))
+        instrumentation.enable()
+        instrumentation.add_hook(hook)
+        try:
+            s.fetch(male)
+            s.fetch(male)
+            s.get_queryset(male)
+        finally:
+            instrumentation.disable()
+            instrumentation.remove_hook(hook)
+        
+        stats = self.dqs.stats()['stats-test']
+        self.assertEqual(stats['calls'], 3)
+        self.assertEqual(stats['queries']['sum'], 2)
+        self.assertEqual(stats['rows']['sum'], 2)
+        self.assertEqual(stats['replay_time']['count'], 1)
+        self.assertEqual(len(events), 3)
+        self.assertEqual(events[0][0], 'stats-test')
+        
+        'specializations made by bind() count as their parent'
+        instrumentation.reset()
+        instrumentation.enable()
+        try:
+            s.bind(male).fetch()
+            s.bind({'gender':GENDER_VALUES['female']}).fetch()
+        finally:
+            instrumentation.disable()
+        self.assertEqual(list(instrumentation.instruments.snapshot()),
+            ['stats-test'])
+        self.assertEqual(self.dqs.stats()['stats-test']['calls'], 2)
+        
+        'counts, batches and unnamed serializations are measured too'
+        instrumentation.reset()
+        instrumentation.enable()
+        try:
+            s.count(male)
+            s.count_many([male, {'gender':GENDER_VALUES['female']}])
+            self.assertEqual(len(s.get_querysets_many([male, male])), 2)
+            for i in range(3):
+                self.dqs.instant(self.dqs.make_serializer()
+                        .filter(gender='$gender'),
+                    Person.objects.all()).fetch(male)
+        finally:
+            instrumentation.disable()
+        snapshot = instrumentation.instruments.snapshot()
+        self.assertEqual(sorted(snapshot), ['<unnamed>', 'stats-test'])
+        self.assertEqual(snapshot['stats-test']['calls'], 3)
+        self.assertEqual(snapshot['stats-test']['queries']['count'], 3)
+        self.assertEqual(snapshot['stats-test']['rows']['sum'], 2)
+        self.assertEqual(snapshot['<unnamed>']['calls'], 3)
+        instrumentation.reset()
+    
+    def test_optimizer(self):
+        chain = (self.dqs.make_serializer()
+            .all()
+            .filter(gender=GENDER_VALUES['male'])
+            .filter(name__isnull=False)
+            .order_by('name')
+            .filter(name='$name')
+            .order_by('-pk')
+            .filter(friends__name='$friend')
+            .filter(friends__gender='$friend_gender'))
+        
+        s = self.dqs.register('optimized', chain, Person.objects.all())
+        
+        self.assertEqual([step.name for step in s.plan.steps],
+            ['filter', 'filter', 'order_by', 'filter', 'filter'])
+        self.assertEqual(s.plan.steps[0].keys, ('gender', 'name__isnull'))
+        self.assertEqual(s.plan.steps[3].keys, ('friends__name',))
+        self.assertEqual(s.plan.steps[4].keys, ('friends__gender',))
+        self.assertEqual(s.prepared_steps, 1)
+        
+        someone = Person(name='someone', gender=GENDER_VALUES['male'])
+        someone.save()
+        friend = Person(name='friend', gender=GENDER_VALUES['female'])
+        friend.save()
+        other = Person(name='other', gender=GENDER_VALUES['male'])
+        other.save()
+        someone.friends.add(friend, other)
+        
+        'no one friend matches both, so merged filters would find nobody'
+        parameters = {'name':'someone', 'friend':'friend',
+            'friend_gender':GENDER_VALUES['male']}
+        self.assertEqual(list(s.get_queryset(parameters)), [someone])
+        self.assertEqual(list(s.get_queryset(parameters)),
+            list(chain.get_queryset(Person.objects.all(), parameters)))
+        
+        everyone = self.dqs.register('prepared', self.dqs.make_serializer()
+            .filter(gender=GENDER_VALUES['male']), Person.objects.all())
+        
+        self.assertIsNot(everyone.get_queryset(), everyone.get_queryset())
+    
+    def test_bind(self):
+        s = self.dqs.register('bind-test', self.dqs.make_serializer()
+                .filter(gender='$gender')
+                .filter(name='$name'),
+            Person.objects.all())
+        
+        Person(name='someone', gender=GENDER_VALUES['male']).save()
+        Person(name='someone', gender=GENDER_VALUES['female']).save()
+        
+        male = s.bind({'gender':GENDER_VALUES['male']})
+        
+        self.assertEqual(male.placeholders, ['name'])
+        self.assertEqual(male.prepared_steps, 1)
+        self.assertIs(male, s.bind({'gender':GENDER_VALUES['male']}))
+        self.assertIsNot(male, s.bind({'gender':GENDER_VALUES['female']}))
+        
+        people = list(male.from_iterable_parameters(['someone']))
+        self.assertEqual(len(people), 1)
+        self.assertEqual(people[0].gender, GENDER_VALUES['male'])
+        
+        self.assertRaises(ValueError, male.from_iterable_parameters,
+            [GENDER_VALUES['male'], 'someone'])
+    
+    def test_typed_placeholders_and_routes(self):
+        from dqs.converters import InvalidParameter
+        
+        someone = Person(name='someone', gender=GENDER_VALUES['male'])
+        someone.save()
+        
+        self.dqs.register('people', self.dqs.make_serializer()
+            .filter(pk='$id:int'), Person.objects.all())
+        self.dqs.register('people/search', self.dqs.make_serializer()
+                .filter(name='$name:slug')
+                .filter(gender='$gender:int'),
+            Person.objects.all(), defaults={'gender':GENDER_VALUES['male']})
+        
+        self.assertEqual(list(self.dqs.from_url('/people/%d' % someone.pk)),
+            [someone])
+        self.assertEqual(list(self.dqs.from_url('/people/search/someone')),
+            [someone])
+        self.assertEqual(list(self.dqs.from_url('/people/search/someone/%d'
+            % GENDER_VALUES['female'])), [])
+        
+        with self.assertNumQueries(0):
+            self.assertRaises(InvalidParameter, self.dqs.from_url,
+                '/people/someone')
+            self.assertRaises(InvalidParameter, self.dqs.from_url,
+                '/people/search/some one')
+            self.assertRaises(ValueError, self.dqs.from_url, '/people//1')
+            self.assertRaises(KeyError, self.dqs.from_url, '/nobody/1')
+        
+        self.assertRaises(ValueError, self.dqs.make_serializer().filter,
+            pk='$id:nonsense')
+        
+        'every dict method keeps the routes up to date'
+        search = self.dqs.pop('people/search')
+        self.assertRaises((KeyError, ValueError), self.dqs.from_url,
+            '/people/search/someone')
+        self.dqs.update({'people/search':search})
+        self.assertEqual(list(self.dqs.from_url('/people/search/someone')),
+            [someone])
+        people = self.dqs.pop('people')
+        self.dqs.setdefault('people', people)
+        self.assertEqual(list(self.dqs.from_url('/people/%d' % someone.pk)),
+            [someone])
+        self.dqs.clear()
+        self.assertRaises(KeyError, self.dqs.from_url, '/people/1')
+    
+    def test_lazy_registration(self):
+        built = []
+        
+        def serializer():
+            built.append('serializer')
+            return self.dqs.make_serializer().filter(name='$name')
+        
+        self.dqs.register('lazy', serializer, lambda: Person.objects.all())
+        self.dqs.register('lazy-path', 'dqs.serialization.FilterChain',
+            __name__ + '.Person')
+        self.dqs.register('lazy-broken', 'dqs.serialization.Nothing',
+            Person.objects.all())
+        self.assertEqual(built, [])
+        
+        Person(name='someone', gender=GENDER_VALUES['male']).save()
+        
+        self.assertEqual(len(self.dqs.from_url('/lazy/someone')), 1)
+        self.assertEqual(built, ['serializer'])
+        
+        self.dqs.warmup().join()
+        self.assertEqual(len(self.dqs['lazy-path'].get_queryset()), 1)
+        self.assertEqual(built, ['serializer'])
+        self.assertRaises(ImportError, lambda: self.dqs['lazy-broken'])
+        
+        self.dqs.register('lazy-keyset', serializer, Person.objects.all(),
+            keyset=True, compile=False)
+        for attempt in range(2):
+            self.assertRaises(ValueError, lambda: self.dqs['lazy-keyset'])
+        self.assertIsNone(dict.__getitem__(self.dqs, 'lazy-keyset').plan)
+    
+    def test_database_routing(self):
+        from dqs import databases
+        
+        for name in ['b', 'a', 'c']:
+            Person(name=name, gender=GENDER_VALUES['male']).save()
+        
+        serializer = (self.dqs.make_serializer()
+            .filter(gender='$gender')
+            .order_by('-name'))
+        male = {'gender':GENDER_VALUES['male']}
+        
+        replicas = self.dqs.register('replicas', serializer,
+            Person.objects.all(), routing=databases.RoundRobin(['default']))
+        self.assertEqual(replicas.get_queryset(male).db, 'default')
+        self.assertEqual(len(replicas.fetch(male)), 3)
+        female = {'gender':GENDER_VALUES['female']}
+        with self.assertNumQueries(1):
+            self.assertEqual([len(results) for results in
+                replicas.get_querysets_many([male, female])], [3, 0])
+        
+        policy = databases.LeastLatency(['default'])
+        self.dqs.register('fastest', serializer, Person.objects.all(),
+            routing=policy).fetch(male)
+        self.assertEqual(list(policy.latencies), ['default'])
+        
+        shards = self.dqs.register('shards', serializer, Person.objects.all(),
+            routing=databases.ShardKey('shard', ['default', 'default'],
+                parallel=False))
+        
+        self.assertEqual([person.name for person in shards.fetch(male)],
+            ['c', 'c', 'b', 'b', 'a', 'a'])
+        self.assertEqual(shards.count(male), 6)
+        self.assertEqual(len(shards.fetch(dict(male, shard=1))), 3)
+        self.assertRaises(ValueError, shards.get_queryset, male)
+        many = [male, dict(male, shard=1), dict(male, shard=0)]
+        self.assertEqual([len(results)
+            for results in shards.get_querysets_many(many)], [6, 3, 3])
+        self.assertEqual(shards.count_many(many), [6, 3, 3])
+        
+        policy = databases.ShardKey('shard', ['a', 'b', 'c'])
+        self.assertEqual(policy.choose({'shard':1}),
+            policy.choose({'shard':'1'}))
+        
+        policy = databases.LeastLatency(['fast', 'slow'], explore=2)
+        policy.record('slow', 1)
+        policy.record('fast', 0.1)
+        self.assertEqual([policy.choose({}) for i in range(4)],
+            ['fast', 'slow', 'fast', 'slow'])
+        
+        class Everywhere(databases.RoutingPolicy):
+            def choose(self, parameters):
+                return None
+            
+            def fan_out(self, parameters):
+                return ['default']
+        
+        everywhere = self.dqs.register('everywhere', serializer,
+            Person.objects.all(), routing=Everywhere())
+        self.assertEqual(len(everywhere.fetch(male)), 3)
+        self.assertEqual(everywhere.count(male), 3)
+    
+    def test_refresher(self):
+        from dqs.refreshing import Refresher
+        
+        s = self.dqs.register('refreshed', self.dqs.make_serializer()
+                .filter(gender='$gender'),
+            Person.objects.all(), refresher=Refresher(refresh_after=60))
+        male = {'gender':GENDER_VALUES['male']}
+        
+        Person(name='someone', gender=GENDER_VALUES['male']).save()
+        
+        self.assertEqual(len(s.fetch(male)), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(len(s.fetch(male)), 1)
+            self.assertEqual(len(s.get_queryset(male)), 1)
+        
+        'saving a Person expires the results'
+        Person(name='someone else', gender=GENDER_VALUES['male']).save()
+        with self.assertNumQueries(1):
+            self.assertEqual(len(s.fetch(male)), 2)
+    
+    def test_snapshots(self):
+        import shutil
+        import tempfile
+        from dqs.snapshots import SnapshotStore
+        
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        
+        for name in ['c', 'a', 'b']:
+            Person(name=name, gender=GENDER_VALUES['male']).save()
+        
+        s = self.dqs.register('snapshot', self.dqs.make_serializer()
+                .filter(gender='$gender')
+                .order_by('name')
+                .values('name'),
+            Person.objects.all(), snapshots=SnapshotStore(directory))
+        male = {'gender':GENDER_VALUES['male']}
+        
+        people = s.get_queryset(male)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(people), 3)
+            self.assertEqual(list(people[1:3]), [{'name':'b'}, {'name':'c'}])
+        
+        self.assertEqual(s.snapshot_usage(), [{'parameters':male,
+            'count':3, 'bytes':s.snapshot_usage()[0]['bytes']}])
+        
+        'saving a Person drops the snapshot'
+        Person(name='d', gender=GENDER_VALUES['male']).save()
+        self.assertEqual(len(s.get_queryset(male)), 4)
+        
+        Person.objects.filter(name='d').update(gender=None)
+        s.refresh_snapshots()
+        self.assertEqual(len(s.fetch(male)), 3)
+        
+        'annotations are replayed on the rows'
+        from django.db.models import Count
+        from django.db.models.functions import Upper
+        s = self.dqs.register('snapshot-annotated', self.dqs.make_serializer()
+                .filter(gender='$gender')
+                .annotate(upper=Upper('name'))
+                .order_by('name')
+                .values('name', 'upper'),
+            Person.objects.all(), snapshots=SnapshotStore(directory))
+        self.assertEqual(list(s.get_queryset(male)[0:2]), [
+            {'name':'a', 'upper':'A'}, {'name':'b', 'upper':'B'}])
+        
+        'aggregates over filtered rows are refused'
+        self.assertRaises(ValueError, self.dqs.register, 'snapshot-counted',
+            self.dqs.make_serializer()
+                .filter(friends__name='$name')
+                .annotate(friend_count=Count('friends')),
+            Person.objects.all(), snapshots=SnapshotStore(directory))
+    
+    def test_export(self):
+        import json
+        
+        for name in ['b', 'a']:
+            Person(name=name, gender=GENDER_VALUES['male']).save()
+        
+        for options in [{}, {'sql_cache':True}]:
+            s = self.dqs.instant(self.dqs.make_serializer()
+                    .filter(gender='$gender')
+                    .order_by('name')
+                    .values('name', 'gender'),
+                Person.objects.all(), **options)
+            male = {'gender':GENDER_VALUES['male']}
+            
+            self.assertEqual(json.loads(s.export(male)), {
+                'name':['a', 'b'],
+                'gender':[GENDER_VALUES['male']] * 2,
+            })
+            self.assertEqual(s.export(male, format='csv').splitlines(),
+                ['name,gender', 'a,%d' % GENDER_VALUES['male'],
+                    'b,%d' % GENDER_VALUES['male']])
+        
+        self.assertRaises(ValueError, self.dqs.instant(
+            self.dqs.make_serializer(), Person.objects.all()).export)
+    
+    def test_list_placeholders(self):
+        people = [Person(name='person %d' % i, gender=GENDER_VALUES['male'])
+            for i in range(150)]
+        for person in people:
+            person.save()
+        
+        s = self.dqs.instant(self.dqs.make_serializer()
+                .filter(pk__in='$ids:int[]')
+                .order_by('name'),
+            Person.objects.all(), query_template=True, sql_cache=True)
+        
+        self.assertEqual(list(s.fetch({'ids':[people[1].pk, people[0].pk]})),
+            people[:2])
+        self.assertEqual(list(s.fetch({'ids':'%d,%d' % (people[1].pk,
+            people[0].pk)})), people[:2])
+        self.assertEqual(list(s.fetch({'ids':''})), [])
+        self.assertEqual(len(s.fetch({'ids':[p.pk for p in people]})), 150)
+        self.assertRaises(ValueError, s.fetch, {'ids':'1,x'})
+        
+        bound = s.bind({'ids':[p.pk for p in people]})
+        self.assertIn('json_each', str(bound.get_queryset().query))
+        self.assertEqual(list(bound.fetch()), sorted(people,
+            key=lambda person: person.name))
+        
+        people[0].friends.add(people[1])
+        excluded = self.dqs.instant(self.dqs.make_serializer()
+                .method('exclude', friends__pk__in='$ids:int[]'),
+            Person.objects.all())
+        for ids in [[people[1].pk], [people[1].pk] + [0] * 200]:
+            self.assertEqual(excluded.fetch({'ids':ids}),
+                list(Person.objects.exclude(friends__pk__in=ids)))
+    
+    def test_coalescing(self):
+        import threading
+        import time
+        from dqs.coalescing import SingleFlight
+        
+        Person(name='a', gender=GENDER_VALUES['male']).save()
+        single_flight = SingleFlight(timeout=5)
+        s = self.dqs.instant(self.dqs.make_serializer()
+                .filter(gender='$gender'),
+            Person.objects.all(), coalesce=single_flight)
+        
+        self.assertEqual(len(s.fetch({'gender':GENDER_VALUES['male']})), 1)
+        
+        started, release, calls = threading.Event(), threading.Event(), []
+        def fetch(parameters):
+            calls.append(parameters)
+            started.set()
+            release.wait(5)
+            return ['results']
+        
+        results = []
+        def run():
+            results.append(single_flight.fetch(s, {'gender':1}, fetch))
+        threads = [threading.Thread(target=run) for i in range(5)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.2)
+        release.set()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [['results']] * 5)
+        self.assertEqual(single_flight.stats()[s.stats_name],
+            {'executions':2, 'shared':4, 'timeouts':0})
+    
+    def test_chain_fingerprints(self):
+        def make_chain():
+            return (self.dqs.make_serializer()
+                .filter(gender='$gender', name__in={'a', 'b'})
+                .order_by('name'))
+        
+        chain = make_chain()
+        self.assertEqual(chain, make_chain())
+        self.assertEqual(hash(chain), hash(make_chain()))
+        self.assertEqual(chain.fingerprint, make_chain().fingerprint)
+        self.assertNotEqual(chain, chain.order_by('gender'))
+        self.assertNotEqual(self.dqs.make_serializer().filter(name='$name'),
+            self.dqs.make_serializer().filter(name='$$name'))
+        
+        first = self.dqs.register('fingerprints-1', make_chain(),
+            Person.objects.all())
+        second = self.dqs.register('fingerprints-2', make_chain(),
+            Person.objects.all())
+        self.assertTrue(first.serializer is second.serializer)
+        self.assertTrue(first.source_plan is second.source_plan)
+    
+    def test_chain_fingerprints_of_subqueries(self):
+        def make_chain(gender):
+            return self.dqs.make_serializer().filter(
+                pk__in=Person.objects.filter(gender=gender))
+        
+        with self.assertNumQueries(0):
+            male = self.dqs.register('subquery-male',
+                make_chain(GENDER_VALUES['male']), Person.objects.all())
+            female = self.dqs.register('subquery-female',
+                make_chain(GENDER_VALUES['female']), Person.objects.all())
+        
+        self.assertNotEqual(male.serializer, female.serializer)
+        self.assertEqual(male.serializer, make_chain(GENDER_VALUES['male']))
+        
+        someone = Person(name='someone', gender=GENDER_VALUES['male'])
+        someone.save()
+        self.assertEqual(list(male.get_queryset()), [someone])
+        self.assertEqual(list(female.get_queryset()), [])
+    
+    def test_change_tokens(self):
+        from django.test import RequestFactory
+        from dqs import views
+        from dqs.changes import ModelVersions
+        
+        Person(name='a', gender=GENDER_VALUES['male']).save()
+        by_gender = self.dqs.make_serializer().filter(gender='$gender')
+        aggregated = self.dqs.register('tokens', by_gender,
+            Person.objects.all(), updated_field='name')
+        versioned = self.dqs.register('versioned-tokens', by_gender,
+            Person.objects.all(), versions=ModelVersions())
+        male = {'gender':GENDER_VALUES['male']}
+        
+        for s in [aggregated, versioned]:
+            token = s.change_token(male)
+            self.assertEqual(s.change_token(male), token)
+            self.assertNotEqual(s.change_token({'gender':
+                GENDER_VALUES['female']}), token)
+        
+        with self.assertNumQueries(0):
+            versioned.change_token(male)
+        
+        self.assertRaises(ValueError, self.dqs.register('untokened',
+            by_gender, Person.objects.all()).change_token, male)
+        
+        request = RequestFactory().get('/')
+        response = views.serve(request, 'tokens/%d' % GENDER_VALUES['male'],
+            registry=self.dqs)
+        self.assertEqual(response.status_code, 200)
+        
+        request = RequestFactory().get('/',
+            HTTP_IF_NONE_MATCH=response['ETag'])
+        with self.assertNumQueries(1):
+            not_modified = views.serve(request, 'tokens/%d'
+                % GENDER_VALUES['male'], registry=self.dqs)
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified['ETag'], response['ETag'])
+        
+        versioned_token = versioned.change_token(male)
+        Person(name='b', gender=GENDER_VALUES['male']).save()
+        self.assertNotEqual(versioned.change_token(male), versioned_token)
+        self.assertEqual(views.serve(request, 'tokens/%d'
+            % GENDER_VALUES['male'], registry=self.dqs).status_code, 200)
+        
+        request = RequestFactory().get('/', HTTP_IF_MODIFIED_SINCE=
+            'Fri, 01 Jan 2100 00:00:00 GMT')
+        self.assertEqual(views.serve(request, 'tokens/%d'
+            % GENDER_VALUES['male'], registry=self.dqs).status_code, 200)
+        
+        'in-process counters miss the saves of other processes'
+        self.assertRaises(ValueError, views.serve, request,
+            'versioned-tokens/%d' % GENDER_VALUES['male'], registry=self.dqs)
+        for versions in [ModelVersions(single_process=True),
+                ModelVersions(cache='default')]:
+            self.dqs.register('shared-tokens', by_gender,
+                Person.objects.all(), versions=versions)
+            self.assertEqual(views.serve(request, 'shared-tokens/%d'
+                % GENDER_VALUES['male'], registry=self.dqs).status_code, 200)
+            del self.dqs['shared-tokens']
+    
     def test_pass_advanced(self):
         '''
         test that we can pass more than strings as parameters, even though the placeholder itself is a string
@@ -7,9 +7,14 @@ def parameters_to_dict(placeholders, parameters):
     given that these params have the same order than the placeholder
     list.
 
-    They also must have the same length. There are NO optional
-    parameters, and no way to define an optional placeholder
+    They also must have the same length. Placeholders with defaults
+    can be left out at the end, but that is up to the caller, which
+    passes only the placeholders it has parameters for (see
+    Serialization.parameters_from_components).
 
+    Parameters of list placeholders are lists, or comma separated
+    strings, which are split when the parameters are bound.
+    
     '''
     
     'raise TypeErrors and evaluate generators.'
@@ -61,6 +66,14 @@ def clean_placeholder(s):
     if is_string_placeholder(s):
         return s[1:] # $XXXXXX
 
+def split_placeholder(name):
+    '''
+    Split a cleaned placeholder into its name and its type, which is
+    None for untyped placeholders. See dqs.converters.
+    '''
+    name, colon, type = name.partition(':')
+    return name, type or None
+
 def unescape(s):
     if is_placeholder(s):
         return clean_placeholder(s)
@@ -68,3 +81,40 @@ def unescape(s):
         return unescape_non_placeholder(s)
 
 
+def unescape_parameters(parameters):
+    '''
+    Takes a parameters dict, as given to Serialization.get_queryset,
+    and returns a dict keyed by the bare placeholder names. Both
+    `$name` and `name` keys are accepted.
+    '''
+    if not parameters:
+        return {}
+    return dict((unescape(key), val) for key, val in parameters.items())
+
+def freeze(value):
+    '''
+    Make a parameter value hashable, and comparable across processes.
+    Lists, tuples, sets and dicts become tuples, and model instances
+    become their label and pk.
+    '''
+    if isinstance(value, dict):
+        return ('dict',) + tuple(sorted(
+            ((freeze(key), freeze(val)) for key, val in value.items()),
+            key=repr))
+    if isinstance(value, (set, frozenset)):
+        return ('set',) + tuple(sorted((freeze(val) for val in value),
+            key=repr))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(val) for val in value)
+    if hasattr(value, '_meta') and hasattr(value, 'pk'):
+        return ('model', value._meta.label_lower, value.pk)
+    return value
+
+def parameters_key(parameters):
+    '''
+    Normalize bound parameters into a hashable key, which is the same
+    for the same values whichever order they were given in.
+    '''
+    return tuple(sorted((key, freeze(val))
+        for key, val in parameters.items()))
+
@@ -0,0 +1,100 @@
+'''
+Views answering with the results of registered serializations.
+
+serve() looks up the serialization a URL is for, like from_url(), and
+answers with its results as JSON. Responses carry the serialization's
+change token (see dqs.changes) as their ETag, and as Last-Modified
+when it is known. When the client already has the current results,
+the answer is 304 Not Modified, and the results are never fetched.
+
+Only the ETag is checked: Last-Modified is the latest time of the
+rows still there, so it moves backwards when the newest row is
+deleted, and If-Modified-Since can't be trusted with it.
+
+Serializations whose tokens come from a ModelVersions need it to keep
+its counters in a shared cache, unless it is marked single_process or
+settings.DEBUG is on (see dqs.changes).
+    
+    urlpatterns = [
+        path('api/<path:url>', dqs.views.serve),
+    ]
+
+'''
+
+from django.conf import settings
+from django.core import serializers
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import Http404, HttpResponse
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date
+
+from dqs import converters, serialization
+
+
+
+def render_json(target, parameters):
+    '''
+    Fetch the results and answer with them as JSON. Model instances
+    are written with Django's json serializer.
+    '''
+    results = target.fetch(parameters)
+    if results and hasattr(results[0], '_meta'):
+        content = serializers.serialize('json', results)
+    else:
+        content = DjangoJSONEncoder().encode(list(results))
+    return HttpResponse(content, content_type='application/json')
+
+
+
+def conditional_response(request, target, parameters, render=render_json):
+    '''
+    Answer 304 Not Modified (or 412 Precondition Failed) when the
+    request's If-None-Match (or If-Match) header matches the
+    serialization's change token, and otherwise call
+    render(target, parameters).
+    '''
+    
+    versions = target.versions
+    if (versions is not None and versions.cache is None
+            and not versions.single_process and not settings.DEBUG):
+        raise ValueError('Conditional responses need ModelVersions to use '
+            + 'a shared cache, or single_process=True')
+    
+    token = target.change_token(parameters)
+    etag = quote_etag(token.etag)
+    
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = render(target, parameters)
+    
+    if request.method in ('GET', 'HEAD') and response.status_code in (200,
+            304):
+        if not response.has_header('ETag'):
+            response['ETag'] = etag
+        if (token.last_modified is not None
+                and not response.has_header('Last-Modified')):
+            response['Last-Modified'] = http_date(token.last_modified)
+    return response
+
+
+
+def serve(request, url, name=None, registry=None, render=render_json):
+    '''
+    The view of a URL of a registered serialization. `registry` is the
+    DjangoQuerysetSerialization to look it up in, dqs.serialization.dqs
+    by default. Unknown names, malformed URLs and invalid parameters
+    are answered with 404.
+    '''
+    
+    if registry is None:
+        registry = serialization.dqs
+    
+    try:
+        target, parameters = registry.resolve_url(url, name)
+    except (KeyError, ValueError):
+        raise Http404('No serialization for %s' % url)
+    
+    try:
+        return conditional_response(request, target, parameters, render)
+    except converters.InvalidParameter as error:
+        raise Http404(str(error))